@@ -14,7 +14,7 @@ def get_args():
     parser.add_argument('input_file',
                         type=workflow.ui.vtkfile, help='Input VTK file')
     parser.add_argument('output_file',
-                        type=str, help='Output VTK file')
+                        type=str, help='Output VTK file, VTK XML if it ends in .vtu')
     parser.add_argument('--outlet_node', type=int,
                         help='Outlet node index (default searches boundary for lowest point).')
 
@@ -28,7 +28,7 @@ if __name__ == '__main__':
     logging.info("Reading file: {}".format(args.input_file))
     m2 = workflow.extrude.Mesh2D.read_VTK(args.input_file)
 
-    coords_old = m2.coords[:]
+    coords_old = m2.coords.copy()
     workflow.condition.condition(m2, args.outlet_node)
     coords_new = m2.coords
     
@@ -2,10 +2,19 @@
 """Downloads and meshes HUCs based on hydrography data."""
 
 from matplotlib import pyplot as plt
+import os
+import copy
+import json
+import time
 import logging
+import multiprocessing
 
 import workflow
 import workflow.ui
+import workflow.conf
+import workflow.utils
+import workflow.warp
+import workflow.profiling
 import workflow.source_list
 import workflow.bin_utils
 
@@ -19,6 +28,7 @@ def get_args():
     workflow.ui.simplify_options(parser)
     workflow.ui.triangulate_options(parser)
     workflow.ui.plot_options(parser)
+    workflow.ui.batch_options(parser)
 
     data_ui = parser.add_argument_group('Data Sources')
     workflow.ui.huc_source_options(data_ui)
@@ -38,7 +48,7 @@ def mesh_hucs(args):
         logging.info('Target projection: "{}"'.format(args.projection['init']))
     except TypeError:
         pass
-    
+
     # collect data
     crs, hucs = workflow.get_split_form_hucs(sources['HUC'], args.HUC, crs=args.projection)
     args.projection = crs
@@ -46,15 +56,17 @@ def mesh_hucs(args):
     # hydrography
     _, rivers = workflow.get_reaches(sources['hydrography'], args.HUC, None, crs)
     rivers = workflow.simplify_and_prune(hucs, rivers, args.simplify, args.prune_reach_size, args.cut_intersections)
-    
+
     # make 2D mesh
     mesh_points2, mesh_tris = workflow.triangulate(hucs, rivers,
                                                    verbosity=args.verbosity,
                                                    refine_max_area=args.refine_max_area,
                                                    refine_distance=args.refine_distance,
+                                                   refine_distance_tol=args.refine_distance_tol,
                                                    refine_max_edge_length=args.refine_max_edge_length,
                                                    refine_min_angle=args.refine_min_angle,
-                                                   enforce_delaunay=args.enforce_delaunay)
+                                                   enforce_delaunay=args.enforce_delaunay,
+                                                   plot_diagnostics=(args.verbosity > 0 and args.batch_level is None))
 
     # elevate to 3D
     dem_profile, dem = workflow.get_raster_on_shape(sources['DEM'], hucs.exterior(), crs)
@@ -63,12 +75,121 @@ def mesh_hucs(args):
     return hucs, rivers, (mesh_points3, mesh_tris)
 
 
+def batch_output_file(output_file, huc):
+    """Per-HUC output filename, i.e. mesh.vtk --> mesh_060102080101.vtk"""
+    root, ext = os.path.splitext(output_file)
+    return '{}_{}{}'.format(root, huc, ext)
+
+def prefetch(args):
+    """Downloads all files needed by the batch, returning the list of HUCs.
+
+    This is done once, serially, so that workers only ever read the
+    shared, already-downloaded HUC, hydrography, and DEM files.
+    """
+    sources = workflow.source_list.get_sources(args)
+
+    # HUC file(s), which also provides the list of HUCs to mesh
+    profile, hus = sources['HUC'].get_hucs(args.HUC, args.batch_level)
+    key = 'HUC{:d}'.format(args.batch_level)
+    hucs = sorted(hu['properties'][key] for hu in hus)
+    logging.info('Batch: found {} level {} HUCs in {}'.format(len(hucs), args.batch_level, args.HUC))
+
+    # hydrography file(s), one per file-level prefix
+    hydro = sources['hydrography']
+    prefixes = dict()
+    for hu in hus:
+        prefixes.setdefault(hu['properties'][key][0:hydro.file_level], hu)
+    for prefix, hu in prefixes.items():
+        hydro.get_hydro(prefix, workflow.utils.bounds(hu), profile['crs'])
+
+    # DEM tiles covering all HUCs, feathered as in get_raster()
+    if hasattr(sources['DEM'], 'download') and len(hus) > 0:
+        all_bounds = [workflow.utils.bounds(hu) for hu in hus]
+        bounds = [min(b[0] for b in all_bounds), min(b[1] for b in all_bounds),
+                  max(b[2] for b in all_bounds), max(b[3] for b in all_bounds)]
+        bounds = list(workflow.warp.warp_bounds(bounds, profile['crs'], workflow.conf.latlon_crs()))
+        bounds = [bounds[0] - .01, bounds[1] - .01, bounds[2] + .01, bounds[3] + .01]
+        sources['DEM'].download(bounds)
+    return hucs
+
+def mesh_one_huc(args):
+    """Worker: meshes and saves a single HUC, returning a summary entry."""
+    result = {'HUC' : args.HUC,
+              'output_file' : args.output_file}
+    start = time.time()
+    workflow.profiling.reset()
+    try:
+        hucs, rivers, triangulation = mesh_hucs(args)
+        workflow.bin_utils.save(args, triangulation)
+    except Exception as err:
+        logging.error('Batch: failed meshing HUC {}: {}'.format(args.HUC, err))
+        result['status'] = 'failed'
+        result['error'] = '{}: {}'.format(type(err).__name__, str(err))
+    else:
+        result['status'] = 'success'
+        result['num_points'] = int(triangulation[0].shape[0])
+        result['num_triangles'] = int(len(triangulation[1]))
+        result['num_reaches'] = len(rivers)
+    result['wall_time'] = time.time() - start
+    return result
+
+def mesh_hucs_batch(args):
+    """Meshes each HUC at args.batch_level in args.HUC on a process pool.
+
+    Writes one VTK (and readme) per HUC and a JSON summary report, and
+    returns the list of summary entries.
+    """
+    start = time.time()
+    hucs = prefetch(args)
+
+    jobs = []
+    for huc in hucs:
+        job = copy.copy(args)
+        job.HUC = huc
+        job.output_file = batch_output_file(args.output_file, huc)
+        jobs.append(job)
+
+    processes = args.processes
+    if processes is None:
+        processes = os.cpu_count()
+    processes = max(1, min(processes, len(jobs)))
+    logging.info('Batch: meshing {} HUCs on {} processes'.format(len(jobs), processes))
+
+    results = []
+    with multiprocessing.Pool(processes) as pool:
+        for result in pool.imap_unordered(mesh_one_huc, jobs):
+            results.append(result)
+            logging.info('Batch: [{}/{}] HUC {} {} in {:.1f}s'.format(len(results), len(jobs),
+                            result['HUC'], result['status'], result['wall_time']))
+    results.sort(key=lambda r : r['HUC'])
+
+    summary = {'HUC' : args.HUC,
+               'batch_level' : args.batch_level,
+               'processes' : processes,
+               'num_success' : sum(1 for r in results if r['status'] == 'success'),
+               'num_failed' : sum(1 for r in results if r['status'] != 'success'),
+               'wall_time' : time.time() - start,
+               'hucs' : results}
+    summary_file = os.path.splitext(args.output_file)[0]+'_summary.json'
+    logging.info("Saving batch summary: %s"%summary_file)
+    with open(summary_file, 'w') as fid:
+        json.dump(summary, fid, indent=2)
+    return results
+
+
 if __name__ == '__main__':
     args = get_args()
     workflow.ui.setup_logging(args.verbosity, args.logfile)
-    hucs, rivers, triangulation = mesh_hucs(args)
-    fig, ax = workflow.bin_utils.plot_with_triangulation(args, hucs, rivers, triangulation)
-    workflow.bin_utils.save(args, triangulation)
-    logging.info("SUCESS")
-    plt.show()
-        
+    if args.batch_level is not None:
+        results = mesh_hucs_batch(args)
+        if any(r['status'] != 'success' for r in results):
+            logging.warning("Batch: some HUCs failed, see summary report")
+        else:
+            logging.info("SUCESS")
+    else:
+        hucs, rivers, triangulation = mesh_hucs(args)
+        fig, ax = workflow.bin_utils.plot_with_triangulation(args, hucs, rivers, triangulation)
+        workflow.bin_utils.save(args, triangulation)
+        logging.info("SUCESS")
+        plt.show()
+
@@ -59,6 +59,7 @@ def mesh_shapes(args):
                                                    verbosity=args.verbosity,
                                                    refine_max_area=args.refine_max_area,
                                                    refine_distance=args.refine_distance,
+                                                   refine_distance_tol=args.refine_distance_tol,
                                                    refine_max_edge_length=args.refine_max_edge_length,
                                                    refine_min_angle=args.refine_min_angle,
                                                    enforce_delaunay=args.enforce_delaunay)
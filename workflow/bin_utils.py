@@ -11,6 +11,7 @@ import cartopy.feature
 import workflow.plot
 import workflow.conf
 import workflow.utils
+import workflow.profiling
 
 
 def plot_with_triangulation(args, hucs, rivers, triangulation,
@@ -135,8 +136,15 @@ def save(args, triangulation):
     logging.info("File I/O")
     logging.info("-"*30)
     logging.info("Saving mesh: %s"%args.output_file)
-    vtk_io.write(args.output_file, mesh_points3, {'triangle':mesh_tris})
+    if args.output_file.endswith('.vtu'):
+        vtk_io.write_vtu(args.output_file, mesh_points3, {'triangle':mesh_tris}, compression='zlib')
+    else:
+        vtk_io.write(args.output_file, mesh_points3, {'triangle':mesh_tris})
 
     logging.info("Saving README: %s"%args.output_file+'.readme') 
     with open(args.output_file+'.readme','w') as fid:
         fid.write('\n'.join(metadata_lines))
+
+    if workflow.profiling.enabled():
+        workflow.profiling.log_report()
+        workflow.profiling.write_report(args.output_file+'.profile.json')
@@ -0,0 +1,207 @@
+"""On-disk cache of preprocessed HUC and reach geometry.
+
+Reading a WBD or NHD geodatabase, warping every feature into the
+output coordinate system, and rounding is the bulk of the cost of
+get_hucs() and get_reaches().  The results of these are cached here,
+under rcParams['data dir']/cache, so that repeated runs on the same
+HUC skip all of that work.
+
+Each entry is addressed by a hash of the arguments that determine its
+contents (source, HUC, level, bounds, crs, digits, ...) and is stored
+as an npz file containing the shapes as WKB, along with their
+properties and the output crs as JSON.  For sources that read a known
+file per HUC (e.g. the WBD and NHD managers), the path, size and
+modification time of that file are part of the key, so re-downloading
+or editing it invalidates the entry.  For any other source, the
+source is only identified by its type and name.
+
+The cache is on by default; set rcParams['cache'] to False to turn it
+off, or call clear() to remove stale entries, e.g. after the files
+read by such a source have changed.
+"""
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+import numpy as np
+
+import fiona.crs
+import pyproj
+import shapely.wkb
+
+import workflow.conf
+import workflow.sources.utils
+
+_version = 1
+
+
+def enabled():
+    """Is the cache on?"""
+    return workflow.conf.rcParams.get('cache', True)
+
+def cache_dir(kind=None):
+    """Directory of the cache, or of the entries of a given kind."""
+    dirname = os.path.join(workflow.conf.rcParams['data dir'], 'cache')
+    if kind is not None:
+        dirname = os.path.join(dirname, kind)
+    return dirname
+
+def clear(kind=None):
+    """Removes all cache entries, or all entries of a given kind."""
+    dirname = cache_dir(kind)
+    if os.path.isdir(dirname):
+        logging.info("Clearing cache: %s"%dirname)
+        shutil.rmtree(dirname)
+
+
+def _source_key(source):
+    """A string identifying a source object."""
+    return '{}.{}: {}'.format(type(source).__module__, type(source).__name__,
+                              getattr(source, 'name', repr(source)))
+
+def _source_files(source, huc):
+    """Files a source reads for a HUC, or an empty list if not known."""
+    if huc is None:
+        return []
+    huc = workflow.sources.utils.huc_str(huc)
+    try:
+        return [source.name_manager.file_name(huc[0:source.file_level]),]
+    except AttributeError:
+        return []
+
+def _file_key(fname):
+    """Path, size and modification time of a file, if it exists."""
+    try:
+        stat = os.stat(fname)
+    except OSError:
+        return [fname, None, None]
+    return [fname, stat.st_size, stat.st_mtime_ns]
+
+def _crs_key(crs):
+    """A string identifying a crs, or None."""
+    if crs is None:
+        return None
+    if hasattr(pyproj, 'CRS'):
+        try:
+            return pyproj.CRS.from_user_input(crs).to_wkt()
+        except pyproj.exceptions.CRSError:
+            return str(crs)
+    else:
+        # pyproj < 2 has no CRS; dicts are sorted by the JSON dump
+        return crs if isinstance(crs, dict) else str(crs)
+
+def _crs_to_json(crs):
+    if crs is None or isinstance(crs, dict):
+        return {'dict' : crs}
+    return {'wkt' : crs.to_wkt()}
+
+def _crs_from_json(crs):
+    if 'dict' in crs:
+        return crs['dict']
+    return fiona.crs.CRS.from_wkt(crs['wkt'])
+
+
+def key(kind, source, **params):
+    """Key of a cache entry.
+
+    This is a hash of the parameters, the source's type and name and,
+    if the source reads a known file for this HUC, that file's path,
+    size and modification time.
+
+    Parameters
+    ----------
+    kind : str
+        Kind of object cached, e.g. 'hucs' or 'reaches'.
+    source : :obj:`source-type`
+        Source object the shapes are read from.
+    params : dict
+        All other arguments that determine the shapes, e.g. huc,
+        level, crs, digits.  Must be JSON serializable, except the
+        crs, which is converted.
+
+    Returns
+    -------
+    str
+        Hex digest of the parameters.
+    """
+    params = dict(params)
+    if 'crs' in params:
+        params['crs'] = _crs_key(params['crs'])
+    params['kind'] = kind
+    params['source'] = _source_key(source)
+    params['files'] = [_file_key(f) for f in _source_files(source, params.get('huc'))]
+    params['version'] = _version
+    data = json.dumps(params, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode('utf-8')).hexdigest()
+
+def filename(kind, hashkey):
+    """Filename of a cache entry."""
+    return os.path.join(cache_dir(kind), hashkey+'.npz')
+
+
+def save(kind, hashkey, crs, shapes):
+    """Saves shapely shapes, and their properties, to the cache.
+
+    Writes to a temporary file which is then moved into place, so
+    concurrent readers (e.g. batch workers) never see a partial entry.
+    """
+    if not enabled():
+        return
+    wkbs = [shapely.wkb.dumps(shp) for shp in shapes]
+    offsets = np.cumsum([0,]+[len(w) for w in wkbs], dtype=np.int64)
+    meta = {'crs' : _crs_to_json(crs),
+            'properties' : [(dict(shp.properties) if getattr(shp, 'properties', None) is not None else None)
+                            for shp in shapes]}
+    meta = json.dumps(meta, default=str).encode('utf-8')
+
+    dirname = cache_dir(kind)
+    os.makedirs(dirname, exist_ok=True)
+    fid, tmpname = tempfile.mkstemp(dir=dirname, suffix='.npz')
+    try:
+        with os.fdopen(fid, 'wb') as fout:
+            np.savez(fout, wkb=np.frombuffer(b''.join(wkbs), dtype=np.uint8),
+                     offsets=offsets, meta=np.frombuffer(meta, dtype=np.uint8))
+        os.replace(tmpname, filename(kind, hashkey))
+    except Exception:
+        if os.path.exists(tmpname):
+            os.remove(tmpname)
+        raise
+    logging.debug("Cached {} {}: {}".format(len(shapes), kind, filename(kind, hashkey)))
+
+def load(kind, hashkey):
+    """Loads shapely shapes from the cache.
+
+    Returns
+    -------
+    :obj:`crs`
+        Coordinate system of the shapes.
+    :obj:`list(shapely)`
+        The shapes, with properties.
+
+    or None if the entry is not in the cache (or the cache is off).
+    """
+    if not enabled():
+        return None
+    fname = filename(kind, hashkey)
+    if not os.path.isfile(fname):
+        return None
+
+    try:
+        with np.load(fname) as data:
+            wkb = data['wkb'].tobytes()
+            offsets = data['offsets']
+            meta = json.loads(data['meta'].tobytes().decode('utf-8'))
+    except (OSError, ValueError, KeyError) as err:
+        logging.warning("Ignoring unreadable cache entry {}: {}".format(fname, err))
+        return None
+
+    shapes = []
+    for i, properties in enumerate(meta['properties']):
+        shp = shapely.wkb.loads(wkb[offsets[i]:offsets[i+1]])
+        shp.properties = properties
+        shapes.append(shp)
+    logging.info("  loaded {} {} from cache: {}".format(len(shapes), kind, fname))
+    return _crs_from_json(meta['crs']), shapes
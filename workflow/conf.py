@@ -7,6 +7,7 @@ import fiona
 rcParams = {'packages data dir' : 'packages',
             'epsg' : 5070, # default Albers equal area conic
             'digits' : 7, # roundoff precision
+            'cache' : True, # cache preprocessed HUCs and reaches, see workflow.cache
             }
 try:
     rcParams['data dir'] = os.path.join(os.environ['ATS_MESHING_DIR'], 'data')
@@ -2,7 +2,7 @@
 
 Works with and assumes all polyhedra cells (and polygon faces).
 
-Requires building a reasonably recent version of Exodus to get 
+Writing requires building a reasonably recent version of Exodus to get
 the associated exodus.py wrappers.
 
 Note that this is typically done in your standard ATS installation,
@@ -15,12 +15,88 @@ your PYTHONPATH.
 
 import numpy as np
 import collections
+import itertools
 import logging
-import exodus
 
 def _list_or_array(obj):
     return type(obj) == list or type(obj) == np.ndarray
-    
+
+def _is_padded(conn):
+    """Is conn a fixed-stride connectivity array, padded with -1?"""
+    return type(conn) == np.ndarray and len(conn.shape) == 2
+
+def _pad_connectivity(conn, fill=-1):
+    """Converts a list of lists of indices into a fixed-stride array.
+
+    Returns the (NENTITIES, MAX_SIZE) integer array, padded with fill,
+    and the (NENTITIES,) array of the number of valid entries per row.
+    """
+    if _is_padded(conn):
+        return conn, (conn != fill).sum(axis=1)
+
+    sizes = np.array([len(c) for c in conn], dtype='i')
+    padded = np.full((len(conn), sizes.max() if len(sizes) > 0 else 0), fill, dtype='i')
+    mask = np.arange(padded.shape[1]) < sizes[:,None]
+    padded[mask] = np.fromiter(itertools.chain.from_iterable(conn), dtype='i', count=sizes.sum())
+    return padded, sizes
+
+def _unpad_connectivity(conn, sizes):
+    """Converts a fixed-stride connectivity array into a list of lists of indices."""
+    if len(sizes) > 0 and np.all(sizes == conn.shape[1]):
+        return conn.tolist()
+    return [row[:n] for (row, n) in zip(conn.tolist(), sizes.tolist())]
+
+def _ravel_padded(conn, sizes, rows=None, renumber=None, offset=0, chunk_size=1000000):
+    """Flattens the valid entries of rows of a fixed-stride connectivity array.
+
+    conn        | (NENTITIES, MAX_SIZE) integer array, padded with -1
+    sizes       | (NENTITIES,) number of valid entries in each row
+    rows        | indices of the rows to flatten, in order (default all)
+    renumber    | optional array mapping each entry to a new index
+    offset      | added to each entry, e.g. 1 for 1-based output
+    chunk_size  | max number of rows processed at once
+
+    Rows are processed in chunks, so the only large allocation is the
+    output array itself.
+    """
+    if rows is None:
+        rows = np.arange(len(conn))
+    out = np.empty((sizes[rows].sum(),), dtype=conn.dtype)
+    pos = 0
+    for start in range(0, len(rows), chunk_size):
+        chunk = conn[rows[start:start+chunk_size]]
+        vals = chunk[chunk >= 0]
+        if renumber is not None:
+            vals = renumber[vals]
+        out[pos:pos+len(vals)] = vals + offset
+        pos += len(vals)
+    assert(pos == len(out))
+    return out
+
+def _first_use_order(flat, num):
+    """Unique entries of flat in order of first appearance, and the inverse map.
+
+    Returns (new_to_old, old_to_new, first), where first is the position in
+    flat of each entry of new_to_old and old_to_new is -1 for unused entries.
+    """
+    used, first = np.unique(flat, return_index=True)
+    order = np.argsort(first, kind='stable')
+    new_to_old = used[order]
+    old_to_new = np.full((num,), -1, dtype=flat.dtype)
+    old_to_new[new_to_old] = np.arange(len(new_to_old))
+    return new_to_old, old_to_new, first[order]
+
+def _validate_padded(conn, size):
+    """Checks a fixed-stride connectivity array, or throws an AssertionError."""
+    assert np.issubdtype(conn.dtype, np.integer)
+    valid = conn >= 0
+    # -- padding only at the end of each row
+    assert np.all(valid[:,1:] <= valid[:,:-1])
+    assert np.all(conn < size)
+    # -- no repeated entries in a row
+    srt = np.sort(conn, axis=1)
+    assert not np.any((srt[:,1:] == srt[:,:-1]) & (srt[:,1:] >= 0))
+
 
 class SideSet(object):
     """A collection of faces in elements."""
@@ -75,28 +151,25 @@ class Mesh2D(object):
             self.labeled_sets = []
 
         self.validate()
-        self.edge_counts()
         if check_handedness:
             self.check_handedness()
+        self.edge_counts()
 
     def validate(self):
         """Checks the validity of the mesh, or throws an AssertionError."""
         assert self.coords.shape[1] == 2 or self.coords.shape[1] == 3
         assert(_list_or_array(self.conn))
-        for f in self.conn:
-            assert(_list_or_array(f))
-            assert len(set(f)) == len(f)
-            for i in f:
-                assert i < self.coords.shape[0]
+        if not _is_padded(self.conn):
+            for f in self.conn:
+                assert(_list_or_array(f))
+        _validate_padded(self.padded_conn()[0], self.coords.shape[0])
 
         for ls in self.labeled_sets:
             if ls.entity == "NODE":
                 size = len(self.coords)
             elif ls.entity == "CELL":
                 size = len(self.conn)
-
-            for i in ls.ent_ids:
-                assert i < size
+            assert np.all(ls.ent_ids < size)
         return True
 
     def num_cells(self):
@@ -117,63 +190,214 @@ class Mesh2D(object):
         return self.edge_counts().keys()
 
     def edge_counts(self):
+        """Counter of the number of cells each edge, as hashed by edge_hash(), is in."""
         try:
             return self._edges
         except AttributeError:
-            self._edges = collections.Counter(self.edge_hash(f[i], f[(i+1)%len(f)]) for f in self.conn for i in range(len(f)))
+            conn, sizes = self.padded_conn()
+            local = np.arange(conn.shape[1])
+            valid = local[None,:] < sizes[:,None]
+            nxt = np.take_along_axis(conn, (local[None,:] + 1) % np.maximum(sizes, 1)[:,None], axis=1)
+            lo = np.minimum(conn, nxt)[valid].astype(np.int64)
+            hi = np.maximum(conn, nxt)[valid].astype(np.int64)
+
+            # count, keeping edges in order of first appearance
+            _, first, counts = np.unique(lo * self.num_nodes() + hi, return_index=True, return_counts=True)
+            order = np.argsort(first, kind='stable')
+            first = first[order]
+            self._edges = collections.Counter(dict(zip(zip(lo[first].tolist(), hi[first].tolist()),
+                                                       counts[order].tolist())))
         return self._edges
 
-    def boundary_edges(self):
-        """Return edges in the boundary of the mesh, ordered around the boundary."""
+    def boundary_loops(self):
+        """Return the boundary of the mesh as loops of edges.
+
+        Each loop is a list of (i,j) node pairs, ordered around the loop
+        so that each edge starts where the previous one ends, and ends
+        where the first one starts.  Meshes with holes or disjoint
+        pieces have more than one loop.  Loops are ordered by, and
+        start from, their lowest numbered node.
+        """
+        try:
+            return self._boundary_loops
+        except AttributeError:
+            pass
+
         be = sorted([k for (k,count) in self.edge_counts().items() if count == 1], key=lambda a : a[0])
-        seed = be.pop(0)
-        be_ordered = [seed,]
 
-        done = False
-        while not done:
-            try:
-                new_e = next( e for e in be if e[0] == be_ordered[-1][1])
-                be.remove(new_e)
-            except StopIteration:
-                new_e = next( e for e in be if e[1] == be_ordered[-1][1])
-                be.remove(new_e)
-                new_e = list(reversed(new_e))
-
-            be_ordered.append(new_e)
-            done = len(be) == 0
-        assert(be_ordered[-1][-1] == be_ordered[0][0])
-        return be_ordered
+        # map from node to the boundary edges starting and ending there
+        starting = collections.defaultdict(collections.deque)
+        ending = collections.defaultdict(collections.deque)
+        for k, e in enumerate(be):
+            starting[e[0]].append(k)
+            ending[e[1]].append(k)
+        used = np.zeros((len(be),), dtype=bool)
+
+        def next_unused(edges):
+            while len(edges) > 0:
+                k = edges.popleft()
+                if not used[k]:
+                    return k
+            return None
+
+        loops = []
+        for seed in range(len(be)):
+            if used[seed]:
+                continue
+            used[seed] = True
+            loop = [be[seed],]
+            while loop[-1][1] != loop[0][0]:
+                node = loop[-1][1]
+                k = next_unused(starting[node])
+                if k is not None:
+                    new_e = be[k]
+                else:
+                    k = next_unused(ending[node])
+                    if k is None:
+                        raise RuntimeError("Boundary of the mesh is not closed at node %d"%node)
+                    new_e = be[k][::-1]
+                used[k] = True
+                loop.append(new_e)
+            loops.append(loop)
+
+        self._boundary_loops = loops
+        return self._boundary_loops
+
+    def boundary_edges(self):
+        """Return edges in the outer boundary of the mesh, ordered around the boundary.
+
+        If the boundary has more than one loop, this is the loop of
+        boundary_loops() enclosing the largest area; holes and other
+        pieces are only available through boundary_loops().
+        """
+        loops = self.boundary_loops()
+        if len(loops) == 1:
+            return loops[0]
+
+        def loop_area(loop):
+            xy = self.coords[[e[0] for e in loop],0:2]
+            return 0.5 * abs(np.dot(xy[:,0], np.roll(xy[:,1], -1)) - np.dot(xy[:,1], np.roll(xy[:,0], -1)))
+        return max(loops, key=loop_area)
 
     def boundary_nodes(self):
         return [e[0] for e in self.boundary_edges()]
-        
-        
-    
+
+    def padded_conn(self):
+        """Cell-to-node connectivity as a fixed-stride array.
+
+        Returns the (NCELLS, MAX_NODES) integer array, padded with -1, and
+        the (NCELLS,) array of the number of nodes in each cell.  If the
+        connectivity is already a padded array, it is returned as is.
+        """
+        try:
+            return self._padded
+        except AttributeError:
+            self._padded = _pad_connectivity(self.conn)
+        return self._padded
+
+    def _cell_points(self):
+        """Map view (x,y) coordinates of each node of each cell, and its neighbors.
+
+        Returns the (NCELLS, MAX_NODES) mask of valid entries, and three
+        (NCELLS, MAX_NODES, 2) arrays: the coordinates of each node, of
+        the next node around the cell, and of the previous node around
+        the cell.  Padded entries repeat the first node of the cell.
+        """
+        conn, sizes = self.padded_conn()
+        local = np.arange(conn.shape[1])
+        valid = local[None,:] < sizes[:,None]
+        nodes = np.where(valid, conn, conn[:,0:1])
+        nsides = np.maximum(sizes, 1)[:,None]
+        nxt = np.take_along_axis(nodes, (local[None,:] + 1) % nsides, axis=1)
+        prv = np.take_along_axis(nodes, (local[None,:] - 1) % nsides, axis=1)
+        xy = self.coords[:,0:2]
+        return valid, xy[nodes], xy[nxt], xy[prv]
+
+    def signed_areas(self):
+        """Signed map view area of each cell, positive if counterclockwise."""
+        valid, p, pn, _ = self._cell_points()
+        cross = p[:,:,0] * pn[:,:,1] - pn[:,:,0] * p[:,:,1]
+        return 0.5 * np.where(valid, cross, 0.).sum(axis=1)
+
     def check_handedness(self):
         """Ensures all cells are oriented via the right-hand-rule, i.e. in the +z direction."""
-        for conn in self.conn:
-            points = np.array([self.coords[c] for c in conn])
-            cross = 0
-            for i in range(len(points)):
-                im = i - 1
-                ip = i + 1
-                if ip == len(points):
-                    ip = 0
-
-                p = points[ip] - points[i]
-                m = points[i] - points[im]
-                cross = cross + p[1] * m[0] - p[0] * m[1]
-            if cross < 0:
-                conn.reverse()
+        reverse = np.nonzero(self.signed_areas() < 0)[0]
+        if len(reverse) == 0:
+            return
+
+        conn, sizes = self.padded_conn()
+        local = np.arange(conn.shape[1])
+        n = sizes[reverse,None]
+        flipped = np.take_along_axis(conn[reverse], np.maximum(n - 1 - local[None,:], 0), axis=1)
+        conn[reverse] = np.where(local[None,:] < n, flipped, -1)
+
+        # conn is self.conn if that is padded, otherwise flip the lists too
+        if not _is_padded(self.conn):
+            for c in reverse:
+                f = self.conn[c]
+                f[:] = f[::-1]
 
     def centroids(self):
-        """Calculate surface mesh centroids."""
+        """Calculate surface mesh centroids, as the mean of each cell's nodes."""
+        conn, sizes = self.padded_conn()
+        valid = conn >= 0
+        points = np.where(valid[:,:,None], self.coords[np.where(valid, conn, 0)], 0.)
         result = np.zeros((self.num_cells(),3),'d')
-        for c, conn in enumerate(self.conn):
-            points = np.array([self.coords[c] for c in conn])
-            result[c,:] = points.mean(axis=0)
+        result[:,0:self.dim] = points.sum(axis=1) / sizes[:,None]
         return result
-    
+
+    def edge_lengths(self):
+        """Map view length of each edge of each cell.
+
+        Returns an (NCELLS, MAX_NODES) array, where entry (c,i) is the
+        length of the edge from node i to node i+1 of cell c, padded
+        with NaN.
+        """
+        valid, p, pn, _ = self._cell_points()
+        return np.where(valid, np.linalg.norm(pn - p, axis=2), np.nan)
+
+    def angles(self):
+        """Map view interior angle, in degrees, at each node of each cell.
+
+        Returns an (NCELLS, MAX_NODES) array, padded with NaN.  Angles
+        are interior regardless of the orientation of the cell, so
+        reflex angles of non-convex cells are larger than 180.
+        """
+        valid, p, pn, pp = self._cell_points()
+        e_out = pn - p
+        e_in = pp - p
+        cross = e_out[:,:,0] * e_in[:,:,1] - e_out[:,:,1] * e_in[:,:,0]
+        dot = (e_out * e_in).sum(axis=2)
+        orientation = np.where(self.signed_areas() < 0, -1., 1.)
+        angles = np.degrees(np.arctan2(orientation[:,None] * cross, dot)) % 360.
+        return np.where(valid, angles, np.nan)
+
+    def min_angles(self):
+        """Smallest interior angle of each cell, in degrees."""
+        return np.nanmin(self.angles(), axis=1)
+
+    def max_angles(self):
+        """Largest interior angle of each cell, in degrees."""
+        return np.nanmax(self.angles(), axis=1)
+
+    def aspect_ratios(self):
+        """Aspect ratio of each cell.
+
+        This is L_max * P / (4 tan(pi/n) A), where L_max is the longest
+        edge, P the perimeter, A the area and n the number of nodes of
+        the cell.  For triangles this is the usual ratio of the longest
+        edge to the inradius, normalized so that a regular polygon of
+        any number of sides has an aspect ratio of 1.  Degenerate cells
+        have an infinite aspect ratio.
+        """
+        lengths = self.edge_lengths()
+        sizes = self.padded_conn()[1]
+        regular = 4 * np.tan(np.pi / np.maximum(sizes, 3))
+        with np.errstate(divide='ignore', invalid='ignore'):
+            ratio = np.nanmax(lengths, axis=1) * np.nansum(lengths, axis=1) \
+                / (regular * np.abs(self.signed_areas()))
+        return np.where(np.isnan(ratio), np.inf, ratio)
+
     def plot(self, color=None, ax=None):
         """Plot the flattened 2D mesh."""
         if color is None:
@@ -193,10 +417,13 @@ class Mesh2D(object):
         ax.autoscale_view()
 
     def write_VTK(self, filename):
-        """Writes to VTK."""
+        """Writes to VTK, or to VTK XML if filename ends in .vtu."""
         assert(all(len(c) == 3 for c in self.conn))
         from workflow_tpls import vtk_io
-        vtk_io.write(filename, self.coords, {'triangle':np.array(self.conn)})
+        if filename.endswith('.vtu'):
+            vtk_io.write_vtu(filename, self.coords, {'triangle':np.array(self.conn)}, compression='zlib')
+        else:
+            vtk_io.write(filename, self.coords, {'triangle':np.array(self.conn)})
         
 
     @classmethod
@@ -210,72 +437,54 @@ class Mesh2D(object):
     @classmethod
     def read_VTK_Unstructured(cls, filename):
         """Constructor from an unstructured VTK file."""
-        with open(filename,'rb') as fid:
-            points_found = False
-            polygons_found = False
-            while True:
-                line = fid.readline().decode('utf-8')
-                if not line:
-                    # EOF
-                    break
-
-                line = line.strip()
-                if len(line) == 0:
-                    continue
-
-                split = line.split()
-                section = split[0]
-
-                if section == 'POINTS':
-                    ncoords = int(split[1])
-                    points = np.fromfile(fid, count=ncoords*3, sep=' ', dtype='d')
-                    points = points.reshape(ncoords, 3)
-                    points_found = True
-
-                elif section == 'POLYGONS':
-                    ncells = int(split[1])
-                    n_to_read = int(split[2])
-
-                    gons = []
-                    
-                    data = np.fromfile(fid, count=n_to_read, sep=' ', dtype='i')
-                    idx = 0
-                    for i in range(ncells):
-                        n_in_gon = data[idx]
-                        gon = list(data[idx+1:idx+1+n_in_gon])
-
-                        # check handedness -- need normals to point up!
-                        cross = []
-                        for i in range(len(gon)):
-                            if i == len(gon)-1:
-                                ip = 0
-                                ipp = 1
-                            elif i == len(gon)-2:
-                                ip = i+1
-                                ipp = 0
-                            else:
-                                ip = i+1
-                                ipp = i+2
-                            d2 = points[gon[ipp]] - points[gon[ip]]
-                            d1 = points[gon[i]] - points[gon[ip]]
-                            cross.append(np.cross(d2, d1))
-                        if (np.array([c[2] for c in cross]).mean() < 0):
-                            gon.reverse()
-
-                        gons.append(gon)
-
-                        idx += n_in_gon + 1
-                    assert(idx == n_to_read)
-                    polygons_found = True
-                        
-
-        if not points_found:
-            raise RuntimeError("Unstructured VTK must contain sections 'POINTS'")
-        if not polygons_found:
-            raise RuntimeError("Unstructured VTK must contain sections 'POLYGONS'")
-        return cls(points, gons)
+        from workflow_tpls import vtk_io
+        if vtk_io.is_binary(filename):
+            raw = vtk_io.read_raw(filename)
+            points = raw['points']
+            data = raw['polygons']
+            if points is None:
+                raise RuntimeError("Unstructured VTK must contain sections 'POINTS'")
+            if data is None:
+                raise RuntimeError("Unstructured VTK must contain sections 'POLYGONS'")
+            ncells = None
+
+        else:
+            with open(filename,'rb') as fid:
+                points = None
+                data = None
+                while True:
+                    line = fid.readline().decode('utf-8')
+                    if not line:
+                        # EOF
+                        break
+
+                    line = line.strip()
+                    if len(line) == 0:
+                        continue
+
+                    split = line.split()
+                    section = split[0]
+
+                    if section == 'POINTS':
+                        ncoords = int(split[1])
+                        points = np.fromfile(fid, count=ncoords*3, sep=' ', dtype='d')
+                        points = points.reshape(ncoords, 3)
+
+                    elif section == 'POLYGONS':
+                        ncells = int(split[1])
+                        n_to_read = int(split[2])
+                        data = np.fromfile(fid, count=n_to_read, sep=' ', dtype='i')
+                        assert(len(data) == n_to_read)
+
+            if points is None:
+                raise RuntimeError("Unstructured VTK must contain sections 'POINTS'")
+            if data is None:
+                raise RuntimeError("Unstructured VTK must contain sections 'POLYGONS'")
+
+        # orientation is fixed, in bulk, by the constructor
+        gons, sizes = vtk_io.padded_cells(data, vtk_io.cell_offsets(data, ncells))
+        return cls(points, _unpad_connectivity(gons, sizes))
 
-        
     @classmethod
     def read_VTK_Simplices(cls, filename):
         """Constructor from an structured VTK file.
@@ -283,36 +492,15 @@ class Mesh2D(object):
         Stolen from meshio, https://github.com/nschloe/meshio/blob/master/meshio/vtk_io.py
         """
         from workflow_tpls import vtk_io
-        with open(filename,'rb') as fid:
-            data = vtk_io.read_buffer(fid)
+        data = vtk_io.read(filename)
 
         points = data[0]
         if len(data[1]) != 1:
             raise RuntimeError("Simplex VTK file is readable by vtk_io but not by meshing_ats.  Includes: %r"%data[1].keys())
 
+        # orientation is fixed, in bulk, by the constructor
         gons = next(v for v in data[1].values())
-        gons = gons.tolist()
-
-        # check handedness
-        for gon in gons:
-            cross = []
-            for i in range(len(gon)):
-                if i == len(gon)-1:
-                    ip = 0
-                    ipp = 1
-                elif i == len(gon)-2:
-                    ip = i+1
-                    ipp = 0
-                else:
-                    ip = i+1
-                    ipp = i+2
-                d2 = points[gon[ipp]] - points[gon[ip]]
-                d1 = points[gon[i]] - points[gon[ip]]
-                cross.append(np.cross(d2, d1))
-            if (np.array([c[2] for c in cross]).mean() < 0):
-                gon.reverse()
-
-        return cls(points, gons)
+        return cls(points, gons.tolist())
             
     @classmethod
     def from_Transect(cls, x, z, width=1):
@@ -348,6 +536,9 @@ class Mesh3D(object):
                           | the face
         elem_to_face_conn | list of lists of integer indices into face_to_node_conn
                           | specifying a list of faces that make up the elem
+
+        Either connectivity may instead be given as a fixed-stride integer
+        array of shape (NENTITIES, MAX_SIZE), with rows padded by -1.
         """
         assert type(coords) == np.ndarray
         assert len(coords.shape) == 2
@@ -370,7 +561,12 @@ class Mesh3D(object):
             self.side_sets = []
             
         if material_ids is not None:
-            self.material_id_list = collections.Counter(material_ids).keys()
+            if type(material_ids) is np.ndarray:
+                # unique ids, in order of first appearance
+                ids, first = np.unique(material_ids, return_index=True)
+                self.material_id_list = [int(i) for i in ids[np.argsort(first)]]
+            else:
+                self.material_id_list = collections.Counter(material_ids).keys()
             self.material_ids = material_ids
         else:
             self.material_id_list = [10000,]
@@ -382,19 +578,25 @@ class Mesh3D(object):
     def validate(self):
         """Checks the validity of the mesh, or throws an AssertionError."""
         assert self.coords.shape[1] == 3
-        assert type(self.face_to_node_conn) is list
-        for f in self.face_to_node_conn:
-            assert type(f) is list
-            assert len(set(f)) == len(f)
-            for i in f:
-                assert i < self.coords.shape[0]
-
-        assert type(self.elem_to_face_conn) is list
-        for e in self.elem_to_face_conn:
-            assert type(e) is list
-            assert len(set(e)) == len(e)
-            for i in e:
-                assert i < len(self.face_to_node_conn)
+        if _is_padded(self.face_to_node_conn):
+            _validate_padded(self.face_to_node_conn, self.coords.shape[0])
+        else:
+            assert type(self.face_to_node_conn) is list
+            for f in self.face_to_node_conn:
+                assert type(f) is list
+                assert len(set(f)) == len(f)
+                for i in f:
+                    assert i < self.coords.shape[0]
+
+        if _is_padded(self.elem_to_face_conn):
+            _validate_padded(self.elem_to_face_conn, len(self.face_to_node_conn))
+        else:
+            assert type(self.elem_to_face_conn) is list
+            for e in self.elem_to_face_conn:
+                assert type(e) is list
+                assert len(set(e)) == len(e)
+                for i in e:
+                    assert i < len(self.face_to_node_conn)
 
         for ls in self.labeled_sets:
             if ls.entity == "NODE":
@@ -407,10 +609,17 @@ class Mesh3D(object):
             for i in ls.ent_ids:
                 assert i < size
 
-        for ss in self.side_sets:
-            for j,i in zip(ss.elem_list, ss.side_list):
-                assert j < self.num_cells()
-                assert i < len(self.elem_to_face_conn[j])
+        if _is_padded(self.elem_to_face_conn):
+            nfaces_per_elem = (self.elem_to_face_conn >= 0).sum(axis=1)
+            for ss in self.side_sets:
+                elems = np.asarray(ss.elem_list, dtype=int)
+                assert np.all(elems < self.num_cells())
+                assert np.all(np.asarray(ss.side_list) < nfaces_per_elem[elems])
+        else:
+            for ss in self.side_sets:
+                for j,i in zip(ss.elem_list, ss.side_list):
+                    assert j < self.num_cells()
+                    assert i < len(self.elem_to_face_conn[j])
 
 
 
@@ -424,8 +633,16 @@ class Mesh3D(object):
         return self.coords.shape[0]
 
 
-    def write_exodus(self, filename, face_block_mode="one block"):
-        """Write the 3D mesh to ExodusII using arbitrary polyhedra spec"""
+    def write_exodus(self, filename, face_block_mode="one block", chunk_size=1000000):
+        """Write the 3D mesh to ExodusII using arbitrary polyhedra spec
+
+        filename        | name of the file to write
+        face_block_mode | one of 'one block', 'n blocks, not duplicated',
+                        | 'n blocks, duplicated', 'one block, repeated'
+        chunk_size      | max number of faces or elems flattened at once
+                        | when assembling each block
+        """
+        import exodus
 
         # put cells in with blocks, which renumbers the cells, so we have to track sidesets.
         # Therefore we keep a map of old cell to new cell ordering
@@ -433,81 +650,71 @@ class Mesh3D(object):
         # also, though not required by the spec, paraview and visit
         # seem to crash if num_face_blocks != num_elem_blocks.  So
         # make face blocks here too, which requires renumbering the faces.
+        #
+        # All connectivity is kept as fixed-stride arrays, and blocks are
+        # index arrays into those.
+        faces, nodes_per_face = _pad_connectivity(self.face_to_node_conn)
+        elems, faces_per_elem = _pad_connectivity(self.elem_to_face_conn)
 
         # -- first pass, form all elem blocks and make the map from old-to-new
-        new_to_old_elems = []
-        elem_blks = []
-        for i_m,m_id in enumerate(self.material_id_list):
-            # split out elems of this material, save new_to_old map
-            elems_tuple = [(i,c) for (i,c) in enumerate(self.elem_to_face_conn) if self.material_ids[i] == m_id]
-            new_to_old_elems.extend([i for (i,c) in elems_tuple])
-            elems = [c for (i,c) in elems_tuple]
-            elem_blks.append(elems)
+        material_id_list = np.array(list(self.material_id_list), dtype=int)
+        sorter = np.argsort(material_id_list)
+        material_ids = np.asarray(self.material_ids, dtype=int)
+        material_rank = sorter[np.searchsorted(material_id_list, material_ids, sorter=sorter)]
+        assert np.all(material_id_list[material_rank] == material_ids)
+
+        new_to_old_elems = np.argsort(material_rank, kind='stable')
+        old_to_new_elems = np.empty_like(new_to_old_elems)
+        old_to_new_elems[new_to_old_elems] = np.arange(len(new_to_old_elems))
 
-        old_to_new_elems = sorted([(old,i) for (i,old) in enumerate(new_to_old_elems)], key=lambda a: a[0])
+        elem_blk_bounds = np.zeros((len(material_id_list)+1,), dtype=int)
+        elem_blk_bounds[1:] = np.cumsum(np.bincount(material_rank, minlength=len(material_id_list)))
+        elem_blks = [new_to_old_elems[elem_blk_bounds[i]:elem_blk_bounds[i+1]]
+                     for i in range(len(material_id_list))]
 
         # -- deal with faces, form all face blocks and make the map from old-to-new
+        #
+        # a face block of None is all faces, in the original order; a face
+        # map of None means elems refer to faces by their original index
         face_blks = []
+        face_maps = []
         if face_block_mode == "one block":
             # no reordering of faces needed
-            face_blks.append(self.face_to_node_conn)
-            
+            face_blks.append(None)
+            face_maps = [None,]*len(elem_blks)
+
         elif face_block_mode == "n blocks, not duplicated":
-            used_faces = np.zeros((len(self.face_to_node_conn),),'bool')
-            new_to_old_faces = []
-            for i_m,m_id in enumerate(self.material_id_list):
-                # split out faces of this material, save new_to_old map
-                def used(f):
-                    result = used_faces[f]
-                    used_faces[f] = True
-                    return result
-
-                elem_blk = elem_blks[i_m]
-                faces_tuple = [(f,self.face_to_node_conn[f]) for c in elem_blk for (j,f) in enumerate(c) if not used(f)]
-                new_to_old_faces.extend([j for (j,f) in faces_tuple])
-                faces = [f for (j,f) in faces_tuple]
-                face_blks.append(faces)
-
-            # get the renumbering in the elems
-            old_to_new_faces = sorted([(old,j) for (j,old) in enumerate(new_to_old_faces)], key=lambda a: a[0])
-            elem_blks = [[[old_to_new_faces[f][1] for f in c] for c in elem_blk] for elem_blk in elem_blks]
+            # faces are numbered by first use, and belong to the block of the
+            # elem that first uses them
+            elem_faces = _ravel_padded(elems, faces_per_elem, new_to_old_elems, chunk_size=chunk_size)
+            new_to_old_faces, old_to_new_faces, first = _first_use_order(elem_faces, len(faces))
+
+            elem_faces_bounds = np.zeros((len(new_to_old_elems)+1,), dtype=int)
+            elem_faces_bounds[1:] = np.cumsum(faces_per_elem[new_to_old_elems])
+            face_blk_bounds = np.searchsorted(first, elem_faces_bounds[elem_blk_bounds])
+            face_blks = [new_to_old_faces[face_blk_bounds[i]:face_blk_bounds[i+1]]
+                         for i in range(len(elem_blks))]
+            face_maps = [old_to_new_faces,]*len(elem_blks)
 
         elif face_block_mode == "n blocks, duplicated":
-            elem_blks_new = []
-            offset = 0
-            for i_m, m_id in enumerate(self.material_id_list):
-                used_faces = np.zeros((len(self.face_to_node_conn),),'bool')
-                def used(f):
-                    result = used_faces[f]
-                    used_faces[f] = True
-                    return result
-
-                elem_blk = elem_blks[i_m]
-
-                tuple_old_f = [(f,self.face_to_node_conn[f]) for c in elem_blk for f in c if not used(f)]
-                tuple_new_old_f = [(new,old,f) for (new,(old,f)) in enumerate(tuple_old_f)]
-
-                old_to_new_blk = np.zeros((len(self.face_to_node_conn),),'i')-1
-                for new,old,f in tuple_new_old_f:
-                    old_to_new_blk[old] = new + offset
-
-                elem_blk_new = [[old_to_new_blk[f] for f in c] for c in elem_blk]
-                #offset = offset + len(ftuple_new)
-
-                elem_blks_new.append(elem_blk_new)
-                face_blks.append([f for i,j,f in tuple_new_old_f])
-            elem_blks = elem_blks_new
+            # each block gets its own copy of the faces it uses, numbered
+            # within the block
+            for elem_blk in elem_blks:
+                elem_faces = _ravel_padded(elems, faces_per_elem, elem_blk, chunk_size=chunk_size)
+                new_to_old_faces, old_to_new_faces, _ = _first_use_order(elem_faces, len(faces))
+                face_blks.append(new_to_old_faces)
+                face_maps.append(old_to_new_faces)
+
         elif face_block_mode == "one block, repeated":
             # no reordering of faces needed, just repeat
-            for eblock in elem_blks:
-                face_blks.append(self.face_to_node_conn)
+            face_blks = [None,]*len(elem_blks)
+            face_maps = [None,]*len(elem_blks)
         else:
             raise RuntimeError("Invalid face_block_mode: '%s', valid='one block', 'n blocks, duplicated', 'n blocks, not duplicated'"%face_block_mode)
-                
 
         # open the mesh file
         num_elems = sum(len(elem_blk) for elem_blk in elem_blks)
-        num_faces = sum(len(face_blk) for face_blk in face_blks)
+        num_faces = sum(len(faces) if face_blk is None else len(face_blk) for face_blk in face_blks)
 
         ep = exodus.ex_init_params(title=filename.encode('ascii'),
                                    num_dim=3,
@@ -525,29 +732,32 @@ class Mesh3D(object):
 
         # put the face blocks
         for i_blk, face_blk in enumerate(face_blks):
-            face_raveled = [n for f in face_blk for n in f]
-            e.put_polyhedra_face_blk(i_blk+1, len(face_blk), len(face_raveled), 0)
-            e.put_node_count_per_face(i_blk+1, np.array([len(f) for f in face_blk]))
-            e.put_face_node_conn(i_blk+1, np.array(face_raveled)+1)
+            face_raveled = _ravel_padded(faces, nodes_per_face, face_blk, offset=1, chunk_size=chunk_size)
+            counts = nodes_per_face if face_blk is None else nodes_per_face[face_blk]
+            e.put_polyhedra_face_blk(i_blk+1, len(counts), len(face_raveled), 0)
+            e.put_node_count_per_face(i_blk+1, counts)
+            e.put_face_node_conn(i_blk+1, face_raveled)
+            del face_raveled
 
         # put the elem blocks
-        assert len(elem_blks) == len(self.material_id_list)
-        for i_blk, (m_id, elem_blk) in enumerate(zip(self.material_id_list, elem_blks)):
-            elems_raveled = [f for c in elem_blk for f in c]
+        assert len(elem_blks) == len(material_id_list)
+        for m_id, elem_blk, face_map in zip(material_id_list, elem_blks, face_maps):
+            m_id = int(m_id)
+            elems_raveled = _ravel_padded(elems, faces_per_elem, elem_blk, renumber=face_map,
+                                          offset=1, chunk_size=chunk_size)
 
             e.put_polyhedra_elem_blk(m_id, len(elem_blk), len(elems_raveled), 0)
             e.put_elem_blk_name(m_id, 'MATERIAL_ID_%d'%m_id)
-            e.put_face_count_per_polyhedra(m_id, np.array([len(c) for c in elem_blk]))
-            e.put_elem_face_conn(m_id, np.array(elems_raveled)+1)
+            e.put_face_count_per_polyhedra(m_id, faces_per_elem[elem_blk])
+            e.put_elem_face_conn(m_id, elems_raveled)
+            del elems_raveled
 
         # add sidesets
         e.put_side_set_names([ss.name for ss in self.side_sets])
         for ss in self.side_sets:
-            for elem in ss.elem_list:
-                assert old_to_new_elems[elem][0] == elem
-            new_elem_list = [old_to_new_elems[elem][1] for elem in ss.elem_list]                
+            new_elem_list = old_to_new_elems[np.asarray(ss.elem_list, dtype=int)]
             e.put_side_set_params(ss.setid, len(ss.elem_list), 0)
-            e.put_side_set(ss.setid, np.array(new_elem_list)+1, np.array(ss.side_list)+1)
+            e.put_side_set(ss.setid, new_elem_list+1, np.asarray(ss.side_list)+1)
 
         # finish and close
         e.close()
@@ -638,14 +848,14 @@ class Mesh3D(object):
                 assert len(ncells_per_layer) == len(layer_data)
 
         elif is_list(ncells_per_layer):
-            layer_type = [layer_type,]*len(ncells_per_layer)
+            layer_types = [layer_types,]*len(ncells_per_layer)
             layer_data = [layer_data,]*len(ncells_per_layer)
         else:
-            layer_type = [layer_type,]
+            layer_types = [layer_types,]
             layer_data = [layer_data,]
             ncells_per_layer = [ncells_per_layer,]
                 
-        # helper data and functions for mapping indices from 2D to 3D
+        # helper data for mapping indices from 2D to 3D
         # ------------------------------------------------------------------
         if min(ncells_per_layer) < 0:
             raise RuntimeError("Invalid number of cells, negative value provided.")
@@ -654,27 +864,12 @@ class Mesh3D(object):
         nfaces_total = (ncells_tall+1) * mesh2D.num_cells() + ncells_tall * mesh2D.num_edges()
         nnodes_total = (ncells_tall+1) * mesh2D.num_nodes()
 
-        np_mat_ids = np.array(mat_ids, dtype=int)
+        np_mat_ids = np.array(mat_ids, dtype=int, ndmin=1)
         if np_mat_ids.size == np.size(np_mat_ids, 0):
             if np_mat_ids.size == 1:
-                np_mat_ids = np.full((len(ncells_per_layer), mesh2D.num_cells()), mat_ids[0], dtype=int)
+                np_mat_ids = np.full((len(ncells_per_layer), mesh2D.num_cells()), np_mat_ids[0], dtype=int)
             else:
-                np_mat_ids = np.empty((len(ncells_per_layer), mesh2D.num_cells()), dtype=int)
-                for ilay in range(len(ncells_per_layer)):
-                    np_mat_ids[ilay, :] = np.full(mesh2D.num_cells(), mat_ids[ilay], dtype=int)
-
-
-        def col_to_id(column, z_cell):
-            """Maps 2D cell ID and index in the vertical to a 3D cell ID"""
-            return z_cell + column * ncells_tall
-
-        def node_to_id(node, z_node):
-            """Maps 2D node ID and index in the vertical to a 3D node ID"""
-            return z_node + node * (ncells_tall+1)
-
-        def edge_to_id(edge, z_cell):
-            """Maps 2D edge hash and index in the vertical to a 3D face ID of a vertical face"""
-            return (ncells_tall + 1) * mesh2D.num_cells() + z_cell + edge * ncells_tall
+                np_mat_ids = np.repeat(np_mat_ids[:,None], mesh2D.num_cells(), axis=1)
 
         # create coordinates
         # ---------------------------------
@@ -689,8 +884,8 @@ class Mesh3D(object):
         for layer_type, layer_datum, ncells in zip(layer_types, layer_data, ncells_per_layer):
             if layer_type.lower() == 'constant':
                 dz = float(layer_datum) / ncells
-                for i in range(1,ncells+1):
-                    coords[:,cell_layer_start+i,2] = coords[:,cell_layer_start,2] - i * dz
+                coords[:,cell_layer_start+1:cell_layer_start+ncells+1,2] = \
+                    coords[:,cell_layer_start,2,None] - dz * np.arange(1,ncells+1)
 
             else:
                 # allocate an array of coordinates for the bottom of the layer
@@ -702,8 +897,8 @@ class Mesh3D(object):
 
                 elif layer_type.lower() == 'function':
                     # layer thickness is given by a function evaluation of x,y
-                    for node_col in range(mesh2D.coords.shape[0]):
-                        layer_bottom[node_col] = coords[node_col,cell_layer_start,2] - layer_datum(coords[node_col,0,0], coords[node_col,0,1])
+                    thickness = np.array([layer_datum(x,y) for (x,y) in mesh2D.coords[:,0:2]])
+                    layer_bottom[:] = coords[:,cell_layer_start,2] - thickness
 
                 elif layer_type.lower() == 'node':
                     # layer bottom specifically provided through thickness
@@ -712,7 +907,7 @@ class Mesh3D(object):
                 elif layer_type.lower() == 'cell':
                     # interpolate cell thicknesses to node thicknesses
                     import scipy.interpolate
-                    centroids = mesh2D.cell_centroids()
+                    centroids = mesh2D.centroids()
                     interp = scipy.interpolate.interp2d(centroids[:,0], centroids[:,1], layer_datum, kind='linear')
                     layer_bottom[:] = coords[:,cell_layer_start,2] - interp(mesh2D.coords[:,0], mesh2D.coords[:,1])
 
@@ -720,77 +915,77 @@ class Mesh3D(object):
                     raise RuntimeError("Unrecognized layer_type '%s'"%layer_type)
 
                 # linspace from bottom of previous layer to bottom of this layer
-                for node_col in range(mesh2D.coords.shape[0]):
-                    coords[node_col,cell_layer_start:cell_layer_start+ncells+1,2] = np.linspace(coords[node_col,cell_layer_start,2], layer_bottom[node_col], ncells+1)
+                coords[:,cell_layer_start:cell_layer_start+ncells+1,2] = np.linspace(coords[:,cell_layer_start,2], layer_bottom, ncells+1, axis=1)
                 
             cell_layer_start = cell_layer_start + ncells
 
         # create faces, face sets, cells
-        bottom = []
-        surface = []
-        faces = []
-        cells = [list() for c in range(ncells_total)]
-
-        # -- loop over the columns, adding the horizontal faces
-        for col in range(mesh2D.num_cells()):
-            nodes_2 = mesh2D.conn[col]
-            surface.append(col_to_id(col,0))
-            for z_face in range(ncells_tall + 1):
-                i_f = len(faces)
-                f = [node_to_id(n, z_face) for n in nodes_2]
-
-                if z_face != ncells_tall:
-                    cells[col_to_id(col, z_face)].append(i_f)
-                if z_face != 0:
-                    cells[col_to_id(col, z_face-1)].append(i_f)
-
-                faces.append(f)
-            bottom.append(col_to_id(col,ncells_tall-1))
-
-        # -- loop over the columns, adding the vertical faces
-        added = dict()
-        vertical_side_cells = []
-        vertical_side_indices = []
-        for col in range(mesh2D.num_cells()):
-            nodes_2 = mesh2D.conn[col]
-            for i in range(len(nodes_2)):
-                edge = mesh2D.edge_hash(nodes_2[i], nodes_2[(i+1)%len(nodes_2)])
-                try:
-                    i_e = added[edge]
-                except KeyError:
-                    # faces not yet added to facelist
-                    i_e = len(added.keys())
-                    added[edge] = i_e
-                    
-                    for z_face in range(ncells_tall):
-                        i_f = len(faces)
-                        assert i_f == edge_to_id(i_e, z_face)
-                        f = [node_to_id(edge[0], z_face),
-                             node_to_id(edge[1], z_face),
-                             node_to_id(edge[1], z_face+1),
-                             node_to_id(edge[0], z_face+1)]
-                        faces.append(f)
-                        face_cell = col_to_id(col, z_face)
-                        cells[face_cell].append(i_f)
-
-                        # check if this is an external
-                        if mesh2D._edges[edge] == 1:
-                            vertical_side_cells.append(face_cell)
-                            vertical_side_indices.append(len(cells[face_cell])-1)
-                        
-                else:
-                    # faces already added from previous column
-                    for z_face in range(ncells_tall):
-                        i_f = edge_to_id(i_e, z_face)
-                        cells[col_to_id(col, z_face)].append(i_f)
-
+        #
+        # All connectivity is built as fixed-stride arrays, padded with -1.
+        # Node (n, z) is n * (ncells_tall+1) + z, cell (col, z) is
+        # col * ncells_tall + z.  Horizontal face (col, z) is
+        # col * (ncells_tall+1) + z, and vertical faces follow, ncells_tall
+        # per 2D edge, with edges numbered in order of first appearance.
+        conn2, sizes2 = _pad_connectivity(mesh2D.conn)
+        ncols = mesh2D.num_cells()
+        max_nodes = conn2.shape[1]
+        local = np.arange(max_nodes)
+        valid2 = local[None,:] < sizes2[:,None]
+
+        # -- 2D edges as (column, local index) --> unique edge id
+        nodes_a = conn2
+        nodes_b = np.take_along_axis(conn2, (local[None,:] + 1) % sizes2[:,None], axis=1)
+        edges_lo = np.minimum(nodes_a, nodes_b)
+        edges_hi = np.maximum(nodes_a, nodes_b)
+        keys = edges_lo[valid2].astype(np.int64) * mesh2D.num_nodes() + edges_hi[valid2]
+        _, first, inverse, counts = np.unique(keys, return_index=True, return_inverse=True,
+                                              return_counts=True)
+        rank = np.empty(len(first), dtype=np.int64)
+        rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+        edge_ids = np.full(conn2.shape, -1, dtype=np.int64)
+        edge_ids[valid2] = rank[inverse]
+        nedges = len(first)
+
+        edge_nodes = np.empty((nedges, 2), dtype=np.int64)
+        edge_nodes[rank,0] = edges_lo[valid2][first]
+        edge_nodes[rank,1] = edges_hi[valid2][first]
+        external = np.zeros(nedges, dtype=bool)
+        external[rank] = counts == 1
+
+        z_nodes = np.arange(ncells_tall+1)
+        z_cells = np.arange(ncells_tall)
+        nh_faces = ncols * (ncells_tall+1)
+
+        # -- faces
+        faces = np.full((nfaces_total, max(max_nodes,4)), -1, dtype='i')
+        horiz = conn2[:,None,:] * (ncells_tall+1) + z_nodes[None,:,None]
+        faces[:nh_faces,:max_nodes] = np.where(valid2[:,None,:], horiz, -1).reshape(nh_faces, max_nodes)
+
+        lo = edge_nodes[:,0,None] * (ncells_tall+1) + z_cells[None,:]
+        hi = edge_nodes[:,1,None] * (ncells_tall+1) + z_cells[None,:]
+        faces[nh_faces:,:4] = np.stack([lo, hi, hi+1, lo+1], axis=-1).reshape(-1, 4)
+
+        # -- cells: top face, bottom face, then vertical faces in 2D edge order
+        cells = np.full((ncells_total, 2+max_nodes), -1, dtype='i')
+        col_faces = (np.arange(ncols) * (ncells_tall+1))[:,None] + z_cells[None,:]
+        cells[:,0] = col_faces.ravel()
+        cells[:,1] = col_faces.ravel() + 1
+        vert = nh_faces + edge_ids[:,None,:] * ncells_tall + z_cells[None,:,None]
+        cells[:,2:] = np.where(valid2[:,None,:], vert, -1).reshape(ncells_total, max_nodes)
+
+        # -- side sets
+        surface = np.arange(ncols) * ncells_tall
+        bottom = surface + ncells_tall - 1
+
+        ext_cols, ext_local = np.nonzero(valid2 & external[np.maximum(edge_ids,0)])
+        vertical_side_cells = (ext_cols[:,None] * ncells_tall + z_cells[None,:]).ravel()
+        vertical_side_indices = np.repeat(ext_local + 2, ncells_tall)
 
         # Do some idiot checking
         # -- check we got the expected number of faces
         assert len(faces) == nfaces_total
         # -- check every cell is at least a tet
-        for c in cells:
-            assert len(c) > 4
+        assert np.all((cells >= 0).sum(axis=1) > 4)
         # -- check surface sideset has the right number of entries
         assert len(surface) == mesh2D.num_cells()
         # -- check bottom sideset has the right number of entries
@@ -802,32 +997,18 @@ class Mesh3D(object):
         assert num_sides == len(vertical_side_indices)
 
         # make the material ids
-        material_ids = np.zeros((len(cells),),'i')
-        for col in range(mesh2D.num_cells()):
-            z_cell = 0
-            for ilay in range(len(ncells_per_layer)):
-                ncells = ncells_per_layer[ilay]
-                for i in range(z_cell, z_cell+ncells):
-                    material_ids[col_to_id(col, i)] = np_mat_ids[ilay, col]
-                z_cell = z_cell + ncells
+        layer_of_z = np.repeat(np.arange(len(ncells_per_layer)), ncells_per_layer)
+        material_ids = np_mat_ids[layer_of_z,:].transpose().ravel().astype('i')
 
         # make the side sets
         side_sets = []
-        side_sets.append(SideSet("bottom", 1, bottom, [1,]*len(bottom)))
-        side_sets.append(SideSet("surface", 2, surface, [0,]*len(surface)))
+        side_sets.append(SideSet("bottom", 1, bottom, np.ones(len(bottom), dtype=int)))
+        side_sets.append(SideSet("surface", 2, surface, np.zeros(len(surface), dtype=int)))
         side_sets.append(SideSet("external_sides", 3, vertical_side_cells, vertical_side_indices))
 
         # reshape coords
-        coords = coords.reshape(nnodes_total, 3)        
-        
-        for e,s in zip(side_sets[0].elem_list, side_sets[0].side_list):
-            face = cells[e][s]
-            fz_coords = np.array([coords[n] for n in faces[face]])
+        coords = coords.reshape(nnodes_total, 3)
 
-        for e,s in zip(side_sets[1].elem_list, side_sets[1].side_list):
-            face = cells[e][s]
-            fz_coords = np.array([coords[n] for n in faces[face]])
-        
         # instantiate the mesh
         return cls(coords, faces, cells, side_sets=side_sets, material_ids=material_ids)
 
@@ -12,7 +12,6 @@ capability.
 import numpy as np
 import matplotlib.pyplot as plt
 import logging
-import math
 
 import rasterio
 import rasterio.transform
@@ -23,6 +22,8 @@ import shapely
 from workflow_tpls import vtk_io
 
 import workflow.conf
+import workflow.cache
+import workflow.profiling
 import workflow.triangulation
 import workflow.warp
 import workflow.plot
@@ -42,6 +43,7 @@ __all__ = ['get_huc', 'get_hucs', 'get_split_form_hucs',
 # functions for getting objects
 # -----------------------------------------------------------------------------
 
+@workflow.profiling.profiled()
 def get_huc(source, huc, crs=None, digits=None):
     """Get a HUC shape object from a given code.
 
@@ -69,6 +71,7 @@ def get_huc(source, huc, crs=None, digits=None):
     return crs, hu_shapes[0]
 
 
+@workflow.profiling.profiled()
 def get_hucs(source, huc, level, crs=None, digits=None):
     """Get a list of shape objects for all HUCs at level contained in huc.
 
@@ -96,12 +99,24 @@ def get_hucs(source, huc, level, crs=None, digits=None):
     huc = workflow.sources.utils.huc_str(huc)
     if level is None:
         level = len(huc)
+    if digits is None:
+        digits = workflow.conf.rcParams['digits']
 
     logging.info("")
     logging.info("Preprocessing HUC")
     logging.info("-"*30)
     logging.info("Loading level {} HUCs in {}.".format(level, huc))
-    
+
+    # check the cache of preprocessed HUCs
+    cache_key = workflow.cache.key('hucs', source, huc=huc, level=level, crs=crs, digits=digits)
+    cached = workflow.cache.load('hucs', cache_key)
+    if cached is not None:
+        cached_crs, hu_shapes = cached
+        if crs is None:
+            crs = cached_crs
+        workflow.profiling.record(hucs=len(hu_shapes), cached=True)
+        return crs, hu_shapes
+
     profile, hus = source.get_hucs(huc, level)
     logging.info('  found {} HUCs.'.format(len(hus)))
     for hu in hus:
@@ -109,21 +124,18 @@ def get_hucs(source, huc, level, crs=None, digits=None):
     
     # convert to destination crs
     if crs and crs != profile['crs']:
-        for hu in hus:
-            workflow.warp.warp_shape(hu, profile['crs'], crs)
+        workflow.warp.warp_shapes(hus, profile['crs'], crs)
     else:
         crs = profile['crs']
 
-    # round
-    if digits is None:
-        digits = workflow.conf.rcParams['digits']
-    workflow.utils.round(hus, digits)
-
-    # convert to shapely
-    hu_shapes = [workflow.utils.shply(hu) for hu in hus]
+    # round and convert to shapely
+    hu_shapes = workflow.utils.shplys(hus, digits)
+    workflow.cache.save('hucs', cache_key, crs, hu_shapes)
+    workflow.profiling.record(hucs=len(hu_shapes))
     return crs, hu_shapes
 
 
+@workflow.profiling.profiled()
 def get_split_form_hucs(source, huc, level=None, crs=None, digits=None):
     """Get a SplitHUCs object for all HUCs at level contained in huc.
 
@@ -156,6 +168,7 @@ def get_split_form_hucs(source, huc, level=None, crs=None, digits=None):
     return crs, workflow.split_hucs.SplitHUCs(hu_shapes)
 
 
+@workflow.profiling.profiled()
 def get_shapes(source, index_or_bounds=-1, crs=None, digits=None):
     """Read a shapefile.
 
@@ -196,20 +209,18 @@ def get_shapes(source, index_or_bounds=-1, crs=None, digits=None):
 
     # convert to destination crs
     if crs and crs != profile['crs']:
-        for shp in shps:
-            workflow.warp.warp_shape(shp, profile['crs'], crs)
+        workflow.warp.warp_shapes(shps, profile['crs'], crs)
     else:
         crs = profile['crs']
         
-    # round
+    # round and convert to shapely
     if digits is None:
         digits = workflow.conf.rcParams['digits']
-    workflow.utils.round(shps, digits)
-
-    # convert to shapely
-    shplys = [workflow.utils.shply(shp) for shp in shps]
+    shplys = workflow.utils.shplys(shps, digits)
+    workflow.profiling.record(shapes=len(shplys))
     return crs, shplys
 
+@workflow.profiling.profiled()
 def get_split_form_shapes(source, index_or_bounds=-1, crs=None, digits=None):
     """Read a shapefile.
 
@@ -240,6 +251,7 @@ def get_split_form_shapes(source, index_or_bounds=-1, crs=None, digits=None):
     return crs, workflow.split_hucs.SplitHUCs(shapes)
 
 
+@workflow.profiling.profiled()
 def get_reaches(source, huc, bounds=None, crs=None, digits=None, long=None, merge=True):
     """Get a list of reaches from hydrography data within a given HUC and/or bounding box.
 
@@ -288,23 +300,31 @@ def get_reaches(source, huc, bounds=None, crs=None, digits=None, long=None, merg
     logging.info("loading streams in HUC {}".format(huc))
     logging.info("and/or bounds {}".format(bounds))
 
-    # get the reaches
-    profile, reaches = source.get_hydro(huc, bounds, crs)
+    if digits is None:
+        digits = workflow.conf.rcParams['digits']
 
-    # convert to destination crs
-    if crs and crs != profile['crs']:
-        for reach in reaches:
-            workflow.warp.warp_shape(reach, profile['crs'], crs)
+    # check the cache of preprocessed reaches
+    cache_key = workflow.cache.key('reaches', source, huc=huc, crs=crs, digits=digits,
+                                  bounds=(None if bounds is None else [float(b) for b in bounds]))
+    cached = workflow.cache.load('reaches', cache_key)
+    if cached is not None:
+        cached_crs, reaches_s = cached
+        if crs is None:
+            crs = cached_crs
+        workflow.profiling.record(cached=True)
     else:
-        crs = profile['crs']
+        # get the reaches
+        profile, reaches = source.get_hydro(huc, bounds, crs)
 
-    # round
-    if digits is None:
-        digits = workflow.conf.rcParams['digits']
-    workflow.utils.round(reaches, digits)
+        # convert to destination crs
+        if crs and crs != profile['crs']:
+            workflow.warp.warp_shapes(reaches, profile['crs'], crs)
+        else:
+            crs = profile['crs']
 
-    # convert to shapely
-    reaches_s = [workflow.utils.shply(reach) for reach in reaches]
+        # round and convert to shapely
+        reaches_s = workflow.utils.shplys(reaches, digits)
+        workflow.cache.save('reaches', cache_key, crs, reaches_s)
 
     if merge:
         reaches_s = list(shapely.ops.linemerge(shapely.geometry.MultiLineString(reaches_s)))
@@ -313,9 +333,11 @@ def get_reaches(source, huc, bounds=None, crs=None, digits=None, long=None, merg
     if long is not None:
         reaches_s = [reach for reach in reaches_s if reach.length() < long]
 
+    workflow.profiling.record(reaches=len(reaches_s))
     return crs, reaches_s
 
 
+@workflow.profiling.profiled()
 def get_raster_on_shape(source, shape, crs, raster_crs=None, buffer=0.):
     """Collects a raster DEM that covers the requested shape.
 
@@ -357,9 +379,11 @@ def get_raster_on_shape(source, shape, crs, raster_crs=None, buffer=0.):
     if raster_crs is not None:
         profile, raster = workflow.warp.warp_raster(profile, raster, raster_crs)
 
+    workflow.profiling.record(pixels=int(raster.size))
     return profile, raster
 
 
+@workflow.profiling.profiled()
 def get_masked_raster_on_shape(source, shape, crs, nodata=-1, buffer=0.):
     """Collects a raster DEM that covers the requested shape, masked with 
     nodata value outside of the shape.
@@ -410,6 +434,7 @@ def get_masked_raster_on_shape(source, shape, crs, nodata=-1, buffer=0.):
 # functions for relating objects
 # -----------------------------------------------------------------------------
 
+@workflow.profiling.profiled()
 def find_huc(source, shape, crs, hint, shrink_factor=1.e-5):
     """Finds the smallest HUC containing shp.
 
@@ -454,8 +479,8 @@ def find_huc(source, shape, crs, hint, shrink_factor=1.e-5):
 
         profile, subhus = source.get_hucs(hint, search_level)
         
+        workflow.warp.warp_shapes(subhus, profile['crs'], crs)
         for subhu in subhus:
-            workflow.warp.warp_shape(subhu, profile['crs'], crs)
             subhu_shply = workflow.utils.shply(subhu['geometry'])        
             inhuc = _in_huc(shply, subhu_shply)
 
@@ -496,6 +521,7 @@ def find_huc(source, shape, crs, hint, shrink_factor=1.e-5):
     return result
 
 
+@workflow.profiling.profiled()
 def simplify_and_prune(hucs, reaches, simplify=10, prune_reach_size=0, cut_intersections=False):
     """Cleans up the HUC and river shapes.
 
@@ -526,6 +552,7 @@ def simplify_and_prune(hucs, reaches, simplify=10, prune_reach_size=0, cut_inter
     NOTE: This also may modify the hucs object in-place.
     """
     tol = simplify
+    workflow.profiling.record(reaches=len(reaches))
     
     logging.info("")
     logging.info("Simplifying and pruning")
@@ -579,11 +606,14 @@ def simplify_and_prune(hucs, reaches, simplify=10, prune_reach_size=0, cut_inter
         mins.append(np.min(dz))
     logging.info("  HUC min seg length: %g"%min(mins))
     logging.info("  HUC median seg length: %g"%np.median(np.array(mins)))
+    workflow.profiling.record(rivers=len(rivers), huc_segments=len(mins))
     return rivers
     
+@workflow.profiling.profiled()
 def triangulate(hucs, rivers, diagnostics=True, verbosity=1,
                 refine_max_area=None, refine_distance=None, refine_max_edge_length=None,
-                refine_min_angle=None, enforce_delaunay=False):
+                refine_min_angle=None, enforce_delaunay=False, refine_distance_tol=None,
+                plot_diagnostics=None):
     """Triangulates HUCs and rivers.
 
     Parameters
@@ -595,7 +625,12 @@ def triangulate(hucs, rivers, diagnostics=True, verbosity=1,
         The list of reaches from get_reaches()
 
     diagnostics : bool
-        Plot diagnostics graphs of the triangle refinement.    
+        Compute and log quality statistics of the triangles (area,
+        edge length, angles, distance from the river network).
+
+    plot_diagnostics : bool
+        Also plot diagnostics graphs of the triangle refinement.
+        Defaults to plotting if verbosity > 0.
 
     Refinement Parameters
     ---------------------
@@ -626,6 +661,14 @@ def triangulate(hucs, rivers, diagnostics=True, verbosity=1,
         of triangle distance from centroid and uses that as a max
         area criteria.
 
+    refine_distance_tol : float
+        If provided, distances used by refine_distance are approximated
+        to within this tolerance using a KD-tree over the densified
+        river network, which is much faster than the exact distance
+        for large river networks.  Diagnostics always approximate
+        distances, to this tolerance or, if not provided, to a tenth of
+        the smallest triangle edge length.
+
     refine_max_edge_length : float
         Refine a triangle if its max edge length is greater than
         this length.
@@ -660,10 +703,13 @@ def triangulate(hucs, rivers, diagnostics=True, verbosity=1,
     logging.info("-"*30)
 
     refine_funcs = []
+    distance_refine_func = None
     if refine_max_area is not None:
         refine_funcs.append(workflow.triangulation.refine_from_max_area(refine_max_area))
     if refine_distance is not None:
-        refine_funcs.append(workflow.triangulation.refine_from_river_distance(*refine_distance, rivers))
+        distance_refine_func = workflow.triangulation.refine_from_river_distance(*refine_distance, rivers,
+                                                                                 tol=refine_distance_tol)
+        refine_funcs.append(distance_refine_func)
     if refine_max_edge_length is not None:
         refine_funcs.append(workflow.triangulation.refine_from_max_edge_length(refine_max_edge_length))
     def my_refine_func(*args):
@@ -674,22 +720,38 @@ def triangulate(hucs, rivers, diagnostics=True, verbosity=1,
                                                               refinement_func=my_refine_func,
                                                               min_angle=refine_min_angle,
                                                               enforce_delaunay=enforce_delaunay)
+    workflow.profiling.record(points=len(mesh_points), triangles=len(mesh_tris))
 
     if diagnostics:
-        logging.info("Plotting triangulation diagnostics")
-        river_multiline = workflow.tree.forest_to_list(rivers)
-        distances = []
-        areas = []
-        needs_refine = []
-        for tri in mesh_tris:
-            vertices = mesh_points[tri]
-            bary = np.sum(np.array(vertices), axis=0)/3
-            bary_p = shapely.geometry.Point(bary[0], bary[1])
-            distances.append(bary_p.distance(river_multiline))
-            areas.append(workflow.utils.triangle_area(vertices))
-            needs_refine.append(my_refine_func(vertices, areas[-1]))
-
-        if verbosity > 0:
+        logging.info("Triangulation diagnostics")
+        quality = workflow.triangulation.triangle_quality(mesh_points, mesh_tris)
+        areas = quality['areas']
+
+        if rivers is not None and len(rivers) > 0 and len(areas) > 0:
+            tol = refine_distance_tol
+            if tol is None:
+                tol = 0.1 * quality['edge_lengths'].min()
+            distance_func = workflow.triangulation.river_distance(rivers, tol)
+            distances = distance_func(quality['centroids'])
+        else:
+            distances = None
+
+        needs_refine = np.zeros(areas.shape, bool)
+        for rf in refine_funcs:
+            if rf is distance_refine_func and distances is not None:
+                needs_refine |= rf.vectorized(quality['vertices'], areas, distances)
+            else:
+                needs_refine |= rf.vectorized(quality['vertices'], areas)
+
+        workflow.triangulation.log_triangle_quality(quality, distances, needs_refine)
+        if len(areas) > 0:
+            workflow.profiling.record(min_angle=float(quality['min_angles'].min()),
+                                      needs_refine=int(np.count_nonzero(needs_refine)))
+
+        if plot_diagnostics is None:
+            plot_diagnostics = verbosity > 0
+        if plot_diagnostics and distances is not None:
+            logging.info("Plotting triangulation diagnostics")
             plt.figure()
             plt.subplot(121)
             plt.hist(distances)
@@ -708,6 +770,7 @@ def triangulate(hucs, rivers, diagnostics=True, verbosity=1,
             # plt.title("triangle area [m^2]")
     return mesh_points, mesh_tris
 
+@workflow.profiling.profiled()
 def elevate(mesh_points, mesh_crs, dem, dem_profile, algorithm='piecewise bilinear'):
     """Elevate mesh_points onto the provided dem.
 
@@ -725,6 +788,7 @@ def elevate(mesh_points, mesh_crs, dem, dem_profile, algorithm='piecewise biline
         Algorithm used for interpolation.  One of:
         * "nearest"
         * "piecewise bilinear"
+        * "bicubic"
 
     Returns
     -------
@@ -735,6 +799,8 @@ def elevate(mesh_points, mesh_crs, dem, dem_profile, algorithm='piecewise biline
     logging.info("Elevating Triangulation to DEM")
     logging.info("-"*30)
 
+    workflow.profiling.record(points=len(mesh_points))
+
     # index the i,j of the points, pick the elevations
     elev = values_from_raster(mesh_points, mesh_crs, dem, dem_profile, algorithm)
 
@@ -745,9 +811,16 @@ def elevate(mesh_points, mesh_crs, dem, dem_profile, algorithm='piecewise biline
     return mesh_points_3
 
 
+@workflow.profiling.profiled()
 def values_from_raster(points, points_crs, raster, raster_profile, algorithm='nearest'):
     """Interpolate a raster onto a collection of unstructured points.
 
+    All algorithms are evaluated on whole arrays of points at once:
+    the points are mapped to fractional pixel indices in a single
+    batched inverse transform, and the pixel values needed by each
+    point are gathered with array indexing.  Points outside of the
+    raster are clamped to the nearest edge pixel.
+
     Parameters
     ----------
     points : np.array((n_points, 2), 'd')
@@ -762,47 +835,139 @@ def values_from_raster(points, points_crs, raster, raster_profile, algorithm='ne
         Algorithm used for interpolation.  One of:
         * "nearest"
         * "piecewise bilinear"
+        * "bicubic"
 
     Returns
     -------
     np.array((n_points,))
         Array of raster values interpolated onto the points.
 
+    .. note:
+        For the interpolating algorithms, pixels which are NaN or
+        equal to the profile's nodata value are ignored, and the
+        weights of the remaining pixels are renormalized.  Points
+        whose pixels are all nodata get NaN.  Bicubic interpolation
+        falls back to bilinear for points whose 4x4 stencil touches
+        nodata.
     """
+    workflow.profiling.record(points=len(points))
     points_raster_crs = np.array(workflow.warp.warp_xy(points[:,0], points[:,1], points_crs, raster_profile['crs'])).transpose()
+    i, j = _fractional_pixel_indices(points_raster_crs, raster_profile['transform'])
+
     if algorithm == 'nearest':
-        values = raster[rasterio.transform.rowcol(raster_profile['transform'], points_raster_crs[:,0], points_raster_crs[:,1])]
-    elif algorithm == 'piecewise bilinear':
-        eps = 1.e-10
-        
-        # get the index of the point
-        invtransform = ~raster_profile['transform']
-        mybox = np.zeros((2,2),'d')
-        values = np.zeros((len(points),),'d')
-        for k,xy in enumerate(points_raster_crs):
-            xy = tuple(xy)
-            j,i = invtransform * xy
-
-            # center on pixel
-            i -= 0.5
-            j -= 0.5
-            
-            i = max(eps, min(raster_profile['height']-1-eps, i))
-            j = max(eps, min(raster_profile['width']-1-eps, j))
-
-            mybox[0,0] = raster[math.floor(i), math.floor(j)]
-            mybox[0,1] = raster[math.floor(i), math.ceil(j)]
-            mybox[1,0] = raster[math.ceil(i), math.floor(j)]
-            mybox[1,1] = raster[math.ceil(i), math.ceil(j)]
-            ii = i%1
-            jj = j%1
-
-            up = mybox[0,0] + jj * (mybox[0,1] - mybox[0,0])
-            dn = mybox[1,0] + jj * (mybox[1,1] - mybox[1,0])
-            values[k] = up + (dn - up) * ii
+        return _sample_nearest(raster, i, j)
+
+    valid = _valid_pixels(raster, raster_profile.get('nodata', None))
+    if algorithm == 'piecewise bilinear':
+        return _sample_bilinear(raster, valid, i, j)
+    elif algorithm == 'bicubic':
+        return _sample_bicubic(raster, valid, i, j)
+    else:
+        raise ValueError('values_from_raster: algorithm "{}" unknown, must be one of "nearest", "piecewise bilinear", or "bicubic"'.format(algorithm))
+
+
+def _fractional_pixel_indices(xy, transform):
+    """Maps an array of points to fractional (row, col) pixel indices.
+
+    Index k is the edge of pixel k, so k + 0.5 is its center.
+    """
+    invtransform = ~transform
+    j = invtransform.a * xy[:,0] + invtransform.b * xy[:,1] + invtransform.c
+    i = invtransform.d * xy[:,0] + invtransform.e * xy[:,1] + invtransform.f
+    return i, j
+
+
+def _valid_pixels(raster, nodata=None):
+    """Boolean mask of pixels that hold data."""
+    if not np.issubdtype(raster.dtype, np.floating):
+        valid = np.ones(raster.shape, bool)
+    else:
+        valid = ~np.isnan(raster)
+    if nodata is not None and not np.isnan(nodata):
+        valid &= (raster != nodata)
+    return valid
+
+
+def _sample_nearest(raster, i, j):
+    """Value of the pixel containing each point."""
+    ii = np.clip(np.floor(i).astype(int), 0, raster.shape[0]-1)
+    jj = np.clip(np.floor(j).astype(int), 0, raster.shape[1]-1)
+    return raster[ii,jj]
+
+
+def _sample_bilinear(raster, valid, i, j, eps=1.e-10):
+    """Bilinear interpolation between the 4 pixel centers surrounding each point."""
+    # center on pixel
+    i = np.clip(i - 0.5, eps, raster.shape[0]-1-eps)
+    j = np.clip(j - 0.5, eps, raster.shape[1]-1-eps)
+
+    i0 = np.floor(i).astype(int)
+    j0 = np.floor(j).astype(int)
+    i1 = np.minimum(i0 + 1, raster.shape[0]-1)
+    j1 = np.minimum(j0 + 1, raster.shape[1]-1)
+    di = i - i0
+    dj = j - j0
+
+    corners = [(i0, j0, (1-di)*(1-dj)),
+               (i0, j1, (1-di)*dj),
+               (i1, j0, di*(1-dj)),
+               (i1, j1, di*dj)]
+    return _weighted_sum(raster, valid, corners)
+
+
+def _cubic_weights(t, a=-0.5):
+    """Keys' cubic convolution weights for the 4 nodes at offsets -1,0,1,2
+    from a point at fractional offset t in [0,1)."""
+    d = np.stack([1+t, t, 1-t, 2-t])
+    near = ((a+2)*d - (a+3))*d*d + 1
+    far = ((a*d - 5*a)*d + 8*a)*d - 4*a
+    return np.where(d <= 1, near, far)
+
+
+def _sample_bicubic(raster, valid, i, j):
+    """Bicubic convolution over the 4x4 pixel centers surrounding each point."""
+    i = np.clip(i - 0.5, 0, raster.shape[0]-1)
+    j = np.clip(j - 0.5, 0, raster.shape[1]-1)
+
+    i0 = np.floor(i).astype(int)
+    j0 = np.floor(j).astype(int)
+    wi = _cubic_weights(i - i0)
+    wj = _cubic_weights(j - j0)
+
+    # stencils are clamped at the edges of the raster
+    corners = []
+    for k in range(4):
+        ik = np.clip(i0 + k - 1, 0, raster.shape[0]-1)
+        for l in range(4):
+            jl = np.clip(j0 + l - 1, 0, raster.shape[1]-1)
+            corners.append((ik, jl, wi[k]*wj[l]))
+
+    values = np.zeros(i.shape, 'd')
+    complete = np.ones(i.shape, bool)
+    for ik, jl, w in corners:
+        complete &= valid[ik,jl]
+        values += w * np.where(valid[ik,jl], raster[ik,jl], 0.)
+
+    if not complete.all():
+        incomplete = ~complete
+        values[incomplete] = _sample_bilinear(raster, valid, i[incomplete] + 0.5, j[incomplete] + 0.5)
     return values
-    
 
+
+def _weighted_sum(raster, valid, corners):
+    """Sums weighted pixel values, renormalizing the weights over valid pixels."""
+    values = np.zeros(corners[0][2].shape, 'd')
+    weights = np.zeros(corners[0][2].shape, 'd')
+    for ii, jj, w in corners:
+        v = valid[ii,jj]
+        values += w * np.where(v, raster[ii,jj], 0.)
+        weights += w * v
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return np.where(weights > 0, values / weights, np.nan)
+
+
+@workflow.profiling.profiled()
 def color_raster_from_shapes(target_bounds, target_dx, shapes, shape_colors, shapes_crs, nodata=-1):
     """Color in a raster by filling in a collection of shapes.
 
@@ -842,6 +1007,7 @@ def color_raster_from_shapes(target_bounds, target_dx, shapes, shape_colors, sha
     """
     assert(len(shapes) == len(shape_colors))
     assert(len(shapes) > 0)
+    workflow.profiling.record(shapes=len(shapes))
     
     dtype = np.dtype(type(shape_colors[0]))
     
@@ -5,22 +5,28 @@ import numpy as np
 from matplotlib import pyplot as plt
 import scipy.spatial
 import itertools
+import collections
 
 import shapely.geometry
+import shapely.prepared
 
 import workflow.conf
+import workflow.profiling
 import workflow.utils
 import workflow.tree
 import workflow.split_hucs
 import workflow.plot
 
 
+@workflow.profiling.profiled()
 def snap(hucs, rivers, tol=0.1, tol_triples=None, cut_intersections=False):
     """Snap HUCs to rivers."""
     assert(type(hucs) is workflow.split_hucs.SplitHUCs)
     assert(type(rivers) is list)
     assert(all(workflow.tree.is_consistent(river) for river in rivers))
-    list(hucs.polygons())
+    assert(hucs.is_consistent())
+    if workflow.profiling.enabled():
+        workflow.profiling.record(rivers=len(rivers), reaches=sum(len(river) for river in rivers))
 
     if len(rivers) is 0:
         return True
@@ -34,9 +40,7 @@ def snap(hucs, rivers, tol=0.1, tol_triples=None, cut_intersections=False):
     if not all(workflow.tree.is_consistent(river) for river in rivers):
         logging.info("    ...resulted in inconsistent rivers!")
         return False
-    try:
-        list(hucs.polygons())
-    except AssertionError:
+    if not hucs.is_consistent():
         logging.info("    ...resulted in inconsistent HUCs")
         return False
 
@@ -53,9 +57,7 @@ def snap(hucs, rivers, tol=0.1, tol_triples=None, cut_intersections=False):
     if not all(workflow.tree.is_consistent(river) for river in rivers):
         logging.info("    ...resulted in inconsistent rivers!")
         return False
-    try:
-        list(hucs.polygons())
-    except AssertionError:
+    if not hucs.is_consistent():
         logging.info("    ...resulted in inconsistent HUCs")
         return False
 
@@ -71,9 +73,7 @@ def snap(hucs, rivers, tol=0.1, tol_triples=None, cut_intersections=False):
         if not consistent:
             logging.info("  ...resulted in inconsistent rivers!")
             return False
-        try:
-            list(hucs.polygons())
-        except AssertionError:
+        if not hucs.is_consistent():
             logging.info("  ...resulted in inconsistent HUCs")
             return False
 
@@ -100,64 +100,125 @@ def _snap_and_cut(point, line, tol=0.1):
         if dist < tol:
             if dist < 1.e-7:
                 # filter case where the point is already there
-                if any(workflow.utils.close(point, c) for c in line.coords):
+                if workflow.utils.any_close([point,], line.coords)[0]:
                     return None 
             return nearest_p
     return None
 
-def _snap_crossing(hucs, river_node, tol=0.1):
-    """Snap a single river node"""
+def _snap_crossing(hucs, river_node, tol=0.1, candidates=None):
+    """Snap a single river node.
+
+    candidates, if provided, is the list of (spine, seg_handle) pairs
+    to check for a crossing, in order.  By default all segments of all
+    spines are checked.
+
+    Once the river is cut at a crossing, the upstream piece is
+    injected as a new node, to be snapped in turn, and the remaining
+    candidates are checked against the downstream piece.
+
+    Returns a list of the crossings found, each a tuple of the handle
+    of the cut segment, the key in its spine of the new segment split
+    from it, and the new, upstream river node.  The latter two are
+    None if the segment or river was not split.
+    """
     r = river_node.segment
     logging.debug("len spine, boundary = {0},{1}".format(len(hucs.intersections), len(hucs.boundaries)))
-    for b,spine in itertools.chain(hucs.intersections.items(), hucs.boundaries.items()):
-        logging.debug("len spine seg = {0}".format(len(spine)))
-        #for b,spine in hucs.intersections.items():
-        for s,seg_handle in spine.items():
-            seg = hucs.segments[seg_handle]
-
-            logging.debug("  - intersection?:")
-            logging.debug(list(r.coords))
-            logging.debug(list(seg.coords))
-
-            if seg.intersects(r):
-                logging.debug("  - YES")
-                try:
-                    new_spine = workflow.utils.cut(seg, r, tol)
-                except RuntimeError as err:
-                    plt.figure()
-                    workflow.plot.hucs(hucs,color='gray')
-                    plt.plot(seg.xy[0], seg.xy[1], 'b-+')
-                    plt.plot(r.xy[0], r.xy[1], 'r-x')
-                    plt.show()
-                    raise err
-
-                try:
-                    new_rivers = workflow.utils.cut(r, seg, tol)
-                except RuntimeError as err:
-                    plt.figure()
-                    workflow.plot.hucs(hucs,color='gray')
-                    plt.plot(seg.xy[0], seg.xy[1], 'b-+')
-                    plt.plot(r.xy[0], r.xy[1], 'r-x')
-                    plt.show()
-                    raise err
-                
-                river_node.segment = new_rivers[-1]
-                if len(new_rivers) > 1:
-                    assert(len(new_rivers) == 2)
-                    river_node.inject(workflow.tree.Tree(new_rivers[0]))
-
-                hucs.segments[seg_handle] = new_spine[0]
-                if len(new_spine) > 1:
-                    assert(len(new_spine) == 2)
-                    new_handle = hucs.segments.add(new_spine[1])
-                    spine.add(new_handle)
-                break
-                    
+    if candidates is None:
+        candidates = [(spine, seg_handle) for b,spine in itertools.chain(hucs.intersections.items(), hucs.boundaries.items())
+                      for s,seg_handle in spine.items()]
+
+    crossings = []
+    for spine,seg_handle in candidates:
+        seg = hucs.segments[seg_handle]
+
+        logging.debug("  - intersection?:")
+        logging.debug(list(r.coords))
+        logging.debug(list(seg.coords))
+
+        if seg.intersects(r):
+            logging.debug("  - YES")
+            try:
+                new_spine = workflow.utils.cut(seg, r, tol)
+            except RuntimeError as err:
+                plt.figure()
+                workflow.plot.hucs(hucs,color='gray')
+                plt.plot(seg.xy[0], seg.xy[1], 'b-+')
+                plt.plot(r.xy[0], r.xy[1], 'r-x')
+                plt.show()
+                raise err
+
+            try:
+                new_rivers = workflow.utils.cut(r, seg, tol)
+            except RuntimeError as err:
+                plt.figure()
+                workflow.plot.hucs(hucs,color='gray')
+                plt.plot(seg.xy[0], seg.xy[1], 'b-+')
+                plt.plot(r.xy[0], r.xy[1], 'r-x')
+                plt.show()
+                raise err
+
+            river_node.segment = new_rivers[-1]
+            new_node = None
+            if len(new_rivers) > 1:
+                assert(len(new_rivers) == 2)
+                new_node = river_node.inject(workflow.tree.Tree(new_rivers[0]))
+
+            hucs.segments[seg_handle] = new_spine[0]
+            new_key = None
+            if len(new_spine) > 1:
+                assert(len(new_spine) == 2)
+                new_handle = hucs.segments.add(new_spine[1])
+                new_key = spine.add(new_handle)
+            crossings.append((seg_handle, new_key, new_node))
+            r = river_node.segment
+    return crossings
+
 def snap_crossings(hucs, rivers, tol=0.1):
-    """Snaps HUC boundaries and rivers to crossings."""
+    """Snaps HUC boundaries and rivers to crossings.
+
+    All river reaches are first queried at once against a spatial
+    index of the HUC segments, so that only segments whose bounds
+    intersect a reach are checked for a crossing.  Cuts are then made
+    in the same order as a full scan: each reach is cut at every
+    crossing, searching intersections then boundaries, and the
+    upstream pieces are checked next.  Pieces of a cut reach or segment
+    lie within the bounds of the original, so they inherit its
+    candidates.
+    """
+    # the order in which segments are checked, by (spine index, key in spine)
+    spines = [spine for b,spine in itertools.chain(hucs.intersections.items(), hucs.boundaries.items())]
+    order = dict()
+    for i,spine in enumerate(spines):
+        for s,seg_handle in spine.items():
+            order[seg_handle] = (i,s)
+    handles = list(order.keys())
+    index = workflow.utils.SpatialIndex([hucs.segments[seg_handle] for seg_handle in handles])
+
+    # pieces that each original segment has been cut into
+    pieces = dict((seg_handle, [seg_handle,]) for seg_handle in handles)
+    original = dict((seg_handle, seg_handle) for seg_handle in handles)
+
+    # bulk query: original segments near each reach, keyed by node id
+    near = dict((id(river_node), [handles[i] for i in index.query(river_node.segment)])
+                for tree in rivers for river_node in tree.preOrder())
+    logging.debug("  found {} candidate crossings".format(sum(len(n) for n in near.values())))
+
     for tree in rivers:
         for river_node in tree.preOrder():
-            _snap_crossing(hucs, river_node, tol)
+            near_handles = near.pop(id(river_node))
+            candidates = sorted((h for o in near_handles for h in pieces[o]), key=order.get)
+            candidates = [(spines[order[h][0]], h) for h in candidates]
+
+            for seg_handle, new_key, new_node in _snap_crossing(hucs, river_node, tol, candidates):
+                if new_key is not None:
+                    i_spine = order[seg_handle][0]
+                    new_handle = spines[i_spine][new_key]
+                    order[new_handle] = (i_spine, new_key)
+                    original[new_handle] = original[seg_handle]
+                    pieces[original[seg_handle]].append(new_handle)
+
+                if new_node is not None:
+                    near[id(new_node)] = near_handles
     
 def snap_polygon_endpoints(hucs, rivers, tol=0.1):
     """Snaps the endpoints of HUC segments to endpoints of rivers."""
@@ -182,84 +243,85 @@ def snap_polygon_endpoints(hucs, rivers, tol=0.1):
                 logging.debug("  Moving HUC segment point -1 to river at %r"%list(new_seg[-1]))
             hucs.segments[seg_handle] = shapely.geometry.LineString(new_seg)
 
+def _snap_endpoint(river, seg, new_coord, end, tol=0.1):
+    """Moves the end (0 or -1) coordinate of river to new_coord on seg,
+    returning the new river.
+    """
+    # move new_coord onto an existing segment coord
+    dist = np.linalg.norm(np.array(seg.coords) - np.expand_dims(new_coord,0), 2, axis=1)
+    assert(len(dist) == len(seg.coords))
+    assert(len(dist.shape) == 1)
+    i = int(np.argmin(dist))
+    if (dist[i] < tol):
+        new_coord = seg.coords[i]
+
+    # remove points that are closer
+    coords = list(river.coords)
+    if end == 0:
+        while len(coords) > 2 and workflow.utils.distance(new_coord, coords[1]) < \
+              workflow.utils.distance(new_coord, coords[0]):
+            coords.pop(0)
+    else:
+        while len(coords) > 2 and workflow.utils.distance(new_coord, coords[-2]) < \
+              workflow.utils.distance(new_coord, coords[-1]):
+            coords.pop(-1)
+    coords[end] = new_coord
+    return shapely.geometry.LineString(coords)
+
 def snap_endpoints(tree, hucs, tol=0.1):
     """Snap river endpoints to huc segments and insert that point into
     the boundary.
 
-    Note this is O(n^2), and could be made more efficient.
+    HUC segments are indexed with an STRtree, so each river endpoint
+    is only checked against segments within tol of it.  Segments are
+    still checked component by component, boundaries first, in the
+    same order as a full scan would.  New breakpoints are collected and
+    inserted into each segment all at once.
     """
+    # flatten the components, in the order they are checked, and index
+    # their segments
+    components = [component for b,component in itertools.chain(hucs.boundaries.items(), hucs.intersections.items())]
+    flat = [(i_comp, seg_handle) for i_comp,component in enumerate(components)
+            for s,seg_handle in component.items()]
+    index = workflow.utils.SpatialIndex([hucs.segments[seg_handle] for (i_comp,seg_handle) in flat])
+
+    def candidates(coord):
+        """Map from component index to handles of segments near coord, in order."""
+        cands = collections.defaultdict(list)
+        for i in index.query(shapely.geometry.Point(coord), tol):
+            cands[flat[i][0]].append(flat[i][1])
+        return cands
+
     to_add = []
     for node in tree.preOrder():
         river = node.segment
-        for b,component in itertools.chain(hucs.boundaries.items(), hucs.intersections.items()):
+        cands = {0 : candidates(river.coords[0]),
+                 -1 : candidates(river.coords[-1])}
+
+        # visit, in order, only the components with a segment near an endpoint
+        i_comp = -1
+        while True:
+            remaining = [i for c in cands.values() for i in c.keys() if i > i_comp]
+            if len(remaining) == 0:
+                break
+            i_comp = min(remaining)
+            component = components[i_comp]
 
             # note, this is done in two stages to allow it deal with both endpoints touching
-            for s,seg_handle in component.items():
-                seg = hucs.segments[seg_handle]
-                #logging.debug("SNAP P0:")
-                #logging.debug("  huc seg: %r"%seg.coords[:])
-                #logging.debug("  river: %r"%river.coords[:])
-                altered = False
-                logging.debug("  - checking river coord: %r"%list(river.coords[0]))
-                logging.debug("  - seg coords: {0}".format(list(seg.coords)))
-                new_coord = _snap_and_cut(river.coords[0], seg, tol)
-                logging.debug("  - new coord: {0}".format(new_coord))
-                if new_coord is not None:
-                    logging.info("    snapped river: %r to %r"%(river.coords[0], new_coord))
-
-                    # move new_coord onto an existing segment coord
-                    dist = np.linalg.norm(np.array(seg.coords) - np.expand_dims(new_coord,0), 2, axis=1)
-                    assert(len(dist) == len(seg.coords))
-                    assert(len(dist.shape) == 1)
-                    i = int(np.argmin(dist))
-                    if (dist[i] < tol):
-                        new_coord = seg.coords[i]
-                    
-                    # remove points that are closer
-                    coords = list(river.coords)
-                    done = False
-                    while len(coords) > 2 and workflow.utils.distance(new_coord, coords[1]) < \
-                          workflow.utils.distance(new_coord, coords[0]):
-                        coords.pop(0)
-                    coords[0] = new_coord
-                    river = shapely.geometry.LineString(coords)
-                    node.segment = river
-                    to_add.append((seg_handle, component, 0, node))
-                    break
-
-            # second stage
-            for s,seg_handle in component.items():
-                seg = hucs.segments[seg_handle]
-                # logging.debug("SNAP P1:")
-                # logging.debug("  huc seg: %r"%seg.coords[:])
-                # logging.debug("  river: %r"%river.coords[:])
-                altered = False
-                logging.debug("  - checking river coord: %r"%list(river.coords[-1]))
-                logging.debug("  - seg coords: {0}".format(list(seg.coords)))
-                new_coord = _snap_and_cut(river.coords[-1], seg, tol)
-                logging.debug("  - new coord: {0}".format(new_coord))
-                if new_coord is not None:
-                    logging.info("  - snapped river: %r to %r"%(river.coords[-1], new_coord))
-
-                    # move new_coord onto an existing segment coord
-                    dist = np.linalg.norm(np.array(seg.coords) - np.expand_dims(new_coord,0), 2, axis=1)
-                    assert(len(dist) == len(seg.coords))
-                    assert(len(dist.shape) == 1)
-                    i = int(np.argmin(dist))
-                    if (dist[i] < tol):
-                        new_coord = seg.coords[i]
-                    
-                    # remove points that are closer
-                    coords = list(river.coords)
-                    done = False
-                    while len(coords) > 2 and workflow.utils.distance(new_coord, coords[-2]) < \
-                          workflow.utils.distance(new_coord, coords[-1]):
-                        coords.pop(-1)
-                    coords[-1] = new_coord
-                    river = shapely.geometry.LineString(coords)
-                    node.segment = river
-                    to_add.append((seg_handle, component, -1, node))
-                    break
+            for end in [0, -1]:
+                for seg_handle in cands[end].get(i_comp, []):
+                    seg = hucs.segments[seg_handle]
+                    logging.debug("  - checking river coord: %r"%list(river.coords[end]))
+                    logging.debug("  - seg coords: {0}".format(list(seg.coords)))
+                    new_coord = _snap_and_cut(river.coords[end], seg, tol)
+                    logging.debug("  - new coord: {0}".format(new_coord))
+                    if new_coord is not None:
+                        logging.info("    snapped river: %r to %r"%(river.coords[end], new_coord))
+                        river = _snap_endpoint(river, seg, new_coord, end, tol)
+                        node.segment = river
+                        to_add.append((seg_handle, component, end, node))
+                        cands[end] = candidates(river.coords[end])
+                        break
 
     # find the list of points to add to a given segment
     to_add_dict = dict()
@@ -268,20 +330,19 @@ def snap_endpoints(tree, hucs, tol=0.1):
             to_add_dict[seg_handle] = list()
         to_add_dict[seg_handle].append((component, endpoint, node))
 
-    # find the set of points to add to each given segment
-    def equal(p1,p2):
-        if workflow.utils.close(p1[2].segment.coords[p1[1]], p2[2].segment.coords[p2[1]], 1.e-5):
-            assert(p1[0] == p2[0])
-            return True
-        else:
-            return False
+    # find the set of points to add to each given segment, keeping the
+    # first of each group of equal points
     to_add_dict2 = dict()
     for seg_handle, insert_list in to_add_dict.items():
-        new_list = []
-        for p1 in insert_list:
-            if (all(not equal(p1, p2) for p2 in new_list)):
-                new_list.append(p1)
-        to_add_dict2[seg_handle] = new_list
+        points = [p[2].segment.coords[p[1]] for p in insert_list]
+        equal = workflow.utils.close_points(points, points, 1.e-5)
+        kept = np.zeros((len(insert_list),), dtype=bool)
+        for i, p1 in enumerate(insert_list):
+            kept_equal = [j for j in equal[i] if kept[j]]
+            if len(kept_equal) > 0:
+                assert(p1[0] == insert_list[min(kept_equal)][0])
+            kept[i] = len(kept_equal) == 0
+        to_add_dict2[seg_handle] = [p for (p, k) in zip(insert_list, kept) if k]
 
     # add these points to the segment
     for seg_handle, insert_list in to_add_dict2.items():
@@ -290,9 +351,11 @@ def snap_endpoints(tree, hucs, tol=0.1):
         # coord, then sort it by arclength along the segment.
         #
         # Note this needs special care if the seg is a loop, or else the endpoint gets sorted twice        
+        #
+        # Note all old coords are kept, even those close to a new coord.
         if not workflow.utils.close(seg.coords[0], seg.coords[-1]):
             new_coords = [[p[2].segment.coords[p[1]],1] for p in insert_list]
-            old_coords = [[c,0] for c in seg.coords if not any(workflow.utils.close(c, nc, tol) for nc in new_coords)]
+            old_coords = [[c,0] for c in seg.coords]
             new_seg_coords = sorted(new_coords+old_coords,
                                     key = lambda a:seg.project(shapely.geometry.Point(a)))
 
@@ -301,7 +364,7 @@ def snap_endpoints(tree, hucs, tol=0.1):
 
         else:
             new_coords = [[p[2].segment.coords[p[1]],1] for p in insert_list]
-            old_coords = [[c,0] for c in seg.coords[:-1] if not any(workflow.utils.close(c, nc, tol) for nc in new_coords)]
+            old_coords = [[c,0] for c in seg.coords[:-1]]
             new_seg_coords = sorted(new_coords+old_coords,
                                     key = lambda a:seg.project(shapely.geometry.Point(a)))
             breakpoint_inds = [i for i,(c,f) in enumerate(new_seg_coords) if f is 1]
@@ -329,8 +392,10 @@ def snap_endpoints(tree, hucs, tol=0.1):
 
     return river
 
+@workflow.profiling.profiled()
 def make_global_tree(rivers, tol=0.1):
     """Sorts shapely river objects into a list of tree structures."""
+    workflow.profiling.record(reaches=len(rivers))
     if len(rivers) is 0:
         return list()
 
@@ -375,8 +440,38 @@ def make_global_tree(rivers, tol=0.1):
     return trees
 
 
+def _filter_reaches_to_shape(shape, reaches):
+    """Returns a boolean mask of reaches that intersect shape in more than a point.
+
+    A bounding box prefilter and a prepared shape classify reaches
+    that are outside or inside of shape cheaply, so the exact (and
+    expensive) intersection is only computed for reaches that cross
+    its boundary.
+    """
+    mask = np.zeros((len(reaches),), bool)
+    if len(reaches) == 0:
+        return mask
+
+    minx, miny, maxx, maxy = shape.bounds
+    bounds = np.array([r.bounds for r in reaches]).reshape(-1,4)
+    near = (bounds[:,0] <= maxx) & (bounds[:,2] >= minx) & \
+           (bounds[:,1] <= maxy) & (bounds[:,3] >= miny)
+
+    prepared = shapely.prepared.prep(shape)
+    for i in np.nonzero(near)[0]:
+        r = reaches[i]
+        if prepared.contains(r):
+            mask[i] = True
+        elif prepared.intersects(r):
+            mask[i] = workflow.utils.non_point_intersection(shape, r)
+    return mask
+
 def filter_rivers_to_shape(shape, rivers, tol):
-    """Filters out rivers not inside the HUCs provided."""
+    """Filters out rivers not inside the HUCs provided.
+
+    For a list of trees, trees that lose no reaches are returned as
+    is; only those that do are rebuilt from their remaining reaches.
+    """
     # removes any rivers that are not at least partial contained in the hucs
     if type(rivers) is list and len(rivers) is 0:
         return list()
@@ -384,10 +479,18 @@ def filter_rivers_to_shape(shape, rivers, tol):
     logging.info("  ...filtering")
     if type(rivers) is shapely.geometry.MultiLineString or \
        (type(rivers) is list and type(rivers[0]) is shapely.geometry.LineString):
-        rivers2 = [r for r in rivers if workflow.utils.non_point_intersection(shape,r)]
+        rivers = list(rivers)
+        mask = _filter_reaches_to_shape(shape, rivers)
+        rivers2 = [r for r,keep in zip(rivers, mask) if keep]
     elif type(rivers) is list and type(rivers[0]) is workflow.tree.Tree:
-        rivers2 = [r for river in rivers for r in river.dfs() if workflow.utils.non_point_intersection(shape,r)]
-        rivers2 = make_global_tree(rivers2)
+        rivers2 = []
+        for river in rivers:
+            reaches = list(river.dfs())
+            mask = _filter_reaches_to_shape(shape, reaches)
+            if mask.all():
+                rivers2.append(river)
+            else:
+                rivers2.extend(make_global_tree([r for r,keep in zip(reaches, mask) if keep]))
     else:
         raise RuntimeError("Unrecognized river shape type?")
     return rivers2
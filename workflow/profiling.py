@@ -0,0 +1,155 @@
+"""Timing and memory instrumentation of workflow stages.
+
+Profiling is off by default, in which case instrumented functions pay
+only the cost of a flag check; counts that are expensive to compute
+should be guarded by enabled().  When enabled (e.g. via the --profile
+flag of the meshing scripts, see workflow.ui.outmesh_args), each stage
+records its wall time, the process's peak resident set size, and any
+counts (points, facets, reaches, HUCs, ...) the stage reports.  Stages nest, so a report shows, for instance,
+the time spent in meshpy.triangle.build within triangulate.
+
+Usage:
+
+    workflow.profiling.enable()
+
+    @workflow.profiling.profiled()
+    def my_stage(shapes):
+        workflow.profiling.record(shapes=len(shapes))
+        ...
+
+    with workflow.profiling.stage('my substage', points=len(points)):
+        ...
+
+    workflow.profiling.write_report('mesh.vtk.profile.json')
+"""
+
+import sys
+import time
+import json
+import logging
+import functools
+import contextlib
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+_enabled = False
+_stack = []
+_records = []
+_start = None
+
+
+def enable(on=True):
+    """Turns profiling on (or off)."""
+    global _enabled
+    _enabled = on
+
+def enabled():
+    """Is profiling on?"""
+    return _enabled
+
+def reset():
+    """Clears all recorded stages."""
+    global _start
+    _stack.clear()
+    _records.clear()
+    _start = None
+
+
+def peak_rss():
+    """Peak resident set size of this process, in MB, or None if unknown."""
+    if resource is None:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        # bytes on OSX, KB elsewhere
+        return rss / 1024.**2
+    return rss / 1024.
+
+
+@contextlib.contextmanager
+def stage(name, **counts):
+    """Context manager recording a stage named name.
+
+    Keyword arguments are counts associated with this stage; more may
+    be added within the stage using record().
+    """
+    global _start
+    if not _enabled:
+        yield None
+        return
+
+    now = time.perf_counter()
+    if _start is None:
+        _start = now
+
+    parent = _stack[-1]['stage']+'/' if len(_stack) > 0 else ''
+    entry = {'stage' : parent+name,
+             'depth' : len(_stack),
+             'start' : now - _start,
+             'counts' : dict(counts)}
+    rss0 = peak_rss()
+    _stack.append(entry)
+    try:
+        yield entry
+    finally:
+        _stack.pop()
+        entry['wall_time'] = time.perf_counter() - now
+        entry['peak_rss_mb'] = peak_rss()
+        if rss0 is not None:
+            entry['peak_rss_growth_mb'] = entry['peak_rss_mb'] - rss0
+        _records.append(entry)
+
+def record(**counts):
+    """Adds counts to the innermost active stage, if profiling."""
+    if _enabled and len(_stack) > 0:
+        _stack[-1]['counts'].update(counts)
+
+def profiled(name=None):
+    """Decorator recording each call of the function as a stage.
+
+    The stage is named name, or the function's name by default.
+    """
+    def decorator(func):
+        stage_name = func.__name__ if name is None else name
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return func(*args, **kwargs)
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def report():
+    """Returns a dictionary of all recorded stages, and totals by stage."""
+    stages = sorted(_records, key=lambda r : r['start'])
+    totals = dict()
+    for r in stages:
+        total = totals.setdefault(r['stage'], {'calls':0, 'wall_time':0.})
+        total['calls'] += 1
+        total['wall_time'] += r['wall_time']
+
+    return {'total_wall_time' : sum(r['wall_time'] for r in stages if r['depth'] == 0),
+            'peak_rss_mb' : peak_rss(),
+            'totals' : totals,
+            'stages' : stages}
+
+def write_report(filename):
+    """Writes report() to filename as JSON."""
+    logging.info("Saving profile: %s"%filename)
+    with open(filename, 'w') as fid:
+        json.dump(report(), fid, indent=2)
+
+def log_report(level=logging.INFO):
+    """Logs a summary of time spent in each stage."""
+    logging.log(level, "")
+    logging.log(level, "Profile")
+    logging.log(level, "-"*30)
+    for name, total in report()['totals'].items():
+        logging.log(level, "  {:<50s} {:4d} calls {:10.3f}s".format(name, total['calls'], total['wall_time']))
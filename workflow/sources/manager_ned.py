@@ -1,10 +1,13 @@
 """Manager for interacting with NED datasets.
 """
 import os,sys
+import math
 import logging
+import tempfile
 import numpy as np
 import shapely
 import rasterio.merge
+import rasterio.windows
 import requests
 import requests.exceptions
 
@@ -17,6 +20,33 @@ import workflow.sources.names
 
 
 
+def _output_grid(bounds, res):
+    """The grid, at resolution res, that covers bounds.
+
+    The grid's origin is the upper left corner of bounds, and, as in
+    rasterio.merge.merge (through 1.0), it takes the ceiling of the
+    number of pixels so that it covers bounds completely.  Returns
+    the transform, width and height of the grid, and its bounds, which
+    lie on pixel edges so that passing them back to
+    rasterio.merge.merge gives this same grid whether it rounds or
+    takes the ceiling of the number of pixels.
+    """
+    west, south, east, north = bounds
+    width = int(math.ceil((east - west) / res[0]))
+    height = int(math.ceil((north - south) / res[1]))
+    transform = rasterio.Affine.translation(west, north) * rasterio.Affine.scale(res[0], -res[1])
+
+    # pull the far edges in by roundoff, if needed, so that the ceiling
+    # does not add a pixel
+    east = west + width * res[0]
+    while (east - west) / res[0] > width:
+        east = np.nextafter(east, west)
+    south = north - height * res[1]
+    while (north - south) / res[1] > height:
+        south = np.nextafter(south, north)
+    return transform, width, height, (west, south, east, north)
+
+
 class FileManagerNED:
     def __init__(self, resolution='1/3 arc-second', file_format='IMG'):
         self.name = 'National Elevation Dataset (NED)'
@@ -35,8 +65,18 @@ class FileManagerNED:
                                                   self.short_res+"_raw")
 
 
-    def get_raster(self, shape, crs):
-        """Download and read a DEM for this shape, clipping to the shape."""
+    def get_raster(self, shape, crs, method='windowed', memmap=False, block_rows=1024):
+        """Download and read a DEM for this shape, clipping to the shape.
+
+        method      | 'windowed' (default) reads only the window of each tile
+                    | that covers the shape, block_rows rows at a time, into a
+                    | single preallocated array.  'merge' uses
+                    | rasterio.merge.merge.
+        memmap      | if True, back the output array by a temporary file in the
+                    | data directory; if a filename, by that file.  Only
+                    | valid with method='windowed'.
+        block_rows  | max number of rows read from a tile at once
+        """
         if type(shape) is dict:
             shape = workflow.utils.shply(shape)
         
@@ -52,12 +92,24 @@ class FileManagerNED:
         feather_bounds[3] = feather_bounds[3] + .01
         files = self.download(feather_bounds)
 
+        if method == 'windowed':
+            return self._read_windowed(files, feather_bounds, memmap, block_rows)
+        elif method != 'merge':
+            raise ValueError("{}: invalid method '{}', must be one of 'windowed' or 'merge'".format(self.name, method))
+        if memmap:
+            raise ValueError("{}: memmap output requires method='windowed'".format(self.name))
+
         # merge into a single raster
         datasets = [rasterio.open(f) for f in files]
         profile = datasets[0].profile
-        dest, output_transform = rasterio.merge.merge(datasets, bounds=feather_bounds, nodata=np.nan,
+        res = datasets[0].res
+        grid_bounds = _output_grid(feather_bounds, res)[3]
+        dest, output_transform = rasterio.merge.merge(datasets, bounds=grid_bounds, res=res, nodata=np.nan,
                                                       precision=workflow.conf.rcParams['digits'])
-        dest = np.where(dest < -1.e-10, np.nan, dest)
+        for dset in datasets:
+            dset.close()
+        with np.errstate(invalid='ignore'):
+            dest[dest < -1.e-10] = np.nan
 
         # set the profile
         profile['transform'] = output_transform
@@ -67,6 +119,78 @@ class FileManagerNED:
         profile['nodata'] = np.nan
         return profile, dest[0]
 
+    def _read_windowed(self, files, bounds, memmap=False, block_rows=1024):
+        """Mosaics the first band of files over bounds, reading only needed windows.
+
+        The output grid (see _output_grid()) and first-file-wins
+        compositing match rasterio.merge.merge, but tiles are read in
+        blocks of rows directly into the (optionally memory-mapped)
+        output, and negative values are masked to NaN in place.  Each
+        tile is placed at whole-pixel offsets in the output, so the
+        result is identical to merge's when tiles are aligned with the
+        output grid, and otherwise shifted by less than a pixel.
+        """
+        with rasterio.open(files[0]) as first:
+            profile = first.profile
+            res = first.res
+        dtype = np.result_type(profile['dtype'], np.float32)
+
+        transform, width, height, out_bounds = _output_grid(bounds, res)
+
+        if memmap is True:
+            fid = tempfile.TemporaryFile(dir=self.names.data_dir())
+            dest = np.memmap(fid, dtype=dtype, mode='w+', shape=(height, width))
+        elif memmap:
+            dest = np.memmap(memmap, dtype=dtype, mode='w+', shape=(height, width))
+        else:
+            dest = np.empty((height, width), dtype=dtype)
+        dest.fill(np.nan)
+
+        for filename in files:
+            with rasterio.open(filename) as src:
+                # window of the output covered by this tile
+                left = max(src.bounds.left, out_bounds[0])
+                right = min(src.bounds.right, out_bounds[2])
+                bottom = max(src.bounds.bottom, out_bounds[1])
+                top = min(src.bounds.top, out_bounds[3])
+                if left >= right or bottom >= top:
+                    logging.info("Skipping tile '{}', does not intersect bounds".format(filename))
+                    continue
+
+                src_win = rasterio.windows.from_bounds(left, bottom, right, top, src.transform)
+                src_win = src_win.round_offsets().round_lengths()
+                dst_win = rasterio.windows.from_bounds(left, bottom, right, top, transform)
+                dst_win = dst_win.round_offsets().round_lengths()
+                if dst_win.width == 0 or dst_win.height == 0:
+                    logging.info("Skipping tile '{}', covers less than a pixel".format(filename))
+                    continue
+                scale = src_win.height / dst_win.height
+
+                # read in blocks of rows, filling only pixels not yet filled
+                for row in range(0, dst_win.height, block_rows):
+                    nrows = min(block_rows, dst_win.height - row)
+                    src_blk = rasterio.windows.Window(src_win.col_off, src_win.row_off + row*scale,
+                                                      src_win.width, nrows*scale)
+                    data = src.read(1, out_shape=(nrows, dst_win.width), window=src_blk, masked=True)
+                    i = dst_win.row_off + row
+                    region = dest[i:i+nrows, dst_win.col_off:dst_win.col_off+dst_win.width]
+                    np.copyto(region, data.data, casting='unsafe',
+                              where=np.isnan(region) & ~np.ma.getmaskarray(data))
+
+        # mask negative values in place
+        with np.errstate(invalid='ignore'):
+            for row in range(0, height, block_rows):
+                blk = dest[row:row+block_rows]
+                blk[blk < -1.e-10] = np.nan
+
+        profile['transform'] = transform
+        profile['height'] = height
+        profile['width'] = width
+        profile['count'] = 1
+        profile['dtype'] = dtype.name
+        profile['nodata'] = np.nan
+        return profile, dest
+
     def request(self, bounds):
         """Forms the REST API get to find URLs."""
         rest_url = 'https://viewer.nationalmap.gov/tnmaccess/api/products'
@@ -52,3 +52,45 @@ def test_ned4():
     assert((3581, 3723) == dem.shape)
 
     
+
+@pytest.fixture
+def ned_tiles(tmp_path):
+    """Writes a 2x2 set of small, overlapping NED-named tiles to a temporary data dir."""
+    import rasterio
+    ddir = workflow.conf.rcParams['data dir']
+    workflow.conf.rcParams['data dir'] = str(tmp_path)
+    ned = workflow.sources.manager_ned.FileManagerNED('1 arc-second')
+    os.makedirs(ned.names.folder_name(), exist_ok=True)
+
+    np.random.seed(0)
+    res = 0.01
+    for north in [36,37]:
+        for west in [84,85]:
+            data = np.random.rand(106,106).astype(np.float32) * 100 + north + west
+            data[0:5,0:5] = -1.
+            data[50,50] = -9999.
+            transform = rasterio.Affine.translation(-west-0.03, north+0.03) * rasterio.Affine.scale(res, -res)
+            with rasterio.open(ned.names.file_name(north, west), 'w', driver='GTiff',
+                               height=106, width=106, count=1, dtype='float32',
+                               crs=workflow.conf.latlon_crs(), transform=transform,
+                               nodata=-9999.) as fid:
+                fid.write(data, 1)
+    yield ned
+    workflow.conf.rcParams['data dir'] = ddir
+
+def test_ned_windowed(ned_tiles):
+    # once feathered, the bounds lie on tile pixel edges, so tiles are
+    # aligned with the output grid and merge does not resample
+    shp = shapely.geometry.box(-84.63, 35.47, -83.42, 36.58)
+    crs = workflow.conf.latlon_crs()
+    prof_m, dem_m = ned_tiles.get_raster(shp, crs, method='merge')
+    prof_w, dem_w = ned_tiles.get_raster(shp, crs, block_rows=7)
+    assert(dem_m.shape == dem_w.shape)
+    assert(prof_m['transform'] == prof_w['transform'])
+    assert(np.isnan(dem_w).sum() > 0)
+    assert(np.nanmin(dem_w) >= 0)
+    np.testing.assert_array_equal(dem_m, dem_w)
+
+    prof_mm, dem_mm = ned_tiles.get_raster(shp, crs, memmap=True)
+    assert(type(dem_mm) is np.memmap)
+    np.testing.assert_array_equal(dem_m, dem_mm)
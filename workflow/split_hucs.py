@@ -1,16 +1,28 @@
 """A module for working with multi-polys, a MultiLine that together forms a Polygon"""
 
+import collections
+
 import shapely.geometry
 import shapely.ops
 
 import workflow.utils
+import workflow.profiling
 
 class HandledCollection:
-    """A collection of of objects and handles for those objects."""
+    """A collection of of objects and handles for those objects.
+
+    Changes are tracked by a version number, which is incremented by
+    every change to the collection.  The version at which each handle
+    was last set is also stored, so that things built from a few
+    objects (e.g. polygons from segments) can tell whether they are
+    stale.
+    """
     def __init__(self, objs=None):
         """Create"""
         self._store = dict()
         self._key = 0
+        self._version = 0
+        self._versions = dict()
 
         if objs is not None:
             self.add_many(objs)
@@ -22,12 +34,18 @@ class HandledCollection:
     def __setitem__(self, key, val):
         """Set an object"""
         self._store[key] = val
+        self._touch(key)
+
+    def _touch(self, key):
+        self._version += 1
+        self._versions[key] = self._version
     
     def add(self, value):
         """Adds a object, returning a handle to that object"""
         self._store[self._key] = value
         ret = self._key
         self._key += 1
+        self._touch(ret)
         return ret
 
     def add_many(self, values):
@@ -36,7 +54,16 @@ class HandledCollection:
     
     def pop(self, key):
         """Removes a handle and its object."""
-        return self._store.pop(key)
+        val = self._store.pop(key)
+        self._version += 1
+        self._versions.pop(key)
+        return val
+
+    def version(self, key=None):
+        """Version of the collection, or the version at which handle key was last set."""
+        if key is None:
+            return self._version
+        return self._versions[key]
 
     def __iter__(self):
         """Generator for the collection."""
@@ -105,28 +132,28 @@ class SplitHUCs:
                 raise RuntimeError("Uniques from intersect_and_split is not None, LineString, or MultiLineString?")
 
         intersection_gon = [HandledCollection() for i in range(len(shapes))]
-        for i in range(len(shapes)):
-            for j in range(len(shapes)):
-                inter = intersections[i][j]
-                if inter is None:
-                    pass
-                elif type(inter) is shapely.geometry.LineString:
-                    #print("Adding linestring intersection")
-                    handle = self.segments.add(inter)
-                    ihandle = self.intersections.add(HandledCollection([handle,]))
-                    intersection_gon[i].add(ihandle)
-                    intersection_gon[j].add(ihandle)
-                elif type(inter) is shapely.geometry.MultiLineString:
-                    handles = self.segments.add_many(list(inter))
-                    ihandles = self.intersections.add_many([HandledCollection([h,]) for h in handles])
-                    intersection_gon[i].add_many(ihandles)
-                    intersection_gon[j].add_many(ihandles)
-                else:
-                    raise RuntimeError("Intersections from intersect_and_split is not None, LineString, or MultiLineString?")
+        for (i,j), inter in sorted(intersections.items()):
+            if type(inter) is shapely.geometry.LineString:
+                #print("Adding linestring intersection")
+                handle = self.segments.add(inter)
+                ihandle = self.intersections.add(HandledCollection([handle,]))
+                intersection_gon[i].add(ihandle)
+                intersection_gon[j].add(ihandle)
+            elif type(inter) is shapely.geometry.MultiLineString:
+                handles = self.segments.add_many(list(inter))
+                ihandles = self.intersections.add_many([HandledCollection([h,]) for h in handles])
+                intersection_gon[i].add_many(ihandles)
+                intersection_gon[j].add_many(ihandles)
+            else:
+                raise RuntimeError("Intersections from intersect_and_split is not None, LineString, or MultiLineString?")
 
         # the list of shapes, each entry in the list is a tuple
         self.gons = [(u,i) for u,i in zip(boundary_gon, intersection_gon)]
 
+        # cache of constructed polygons and exterior, see _signature()
+        self._polygon_cache = dict()
+        self._exterior_cache = None
+
         # save the property dictionaries to give back upon request
         self.properties = []
         for s in shapes:
@@ -136,21 +163,50 @@ class SplitHUCs:
                 self.properties.append(None)
         
 
-    def polygon(self, i):
-        """Construct polygon i and return a copy."""
-        segs = []
+    def _spine_handles(self, i):
+        """Lists of the boundary and intersection spine handles forming polygon i."""
         boundary, inter = self.gons[i]
-        for h_boundary in boundary:
-            for s in self.boundaries[h_boundary]:
-                segs.append(self.segments[s])
+        return list(boundary), list(inter)
 
-        for h_intersection in inter:
-            for s in self.intersections[h_intersection]:
-                segs.append(self.segments[s])
+    def _signature(self, spines, h_spines):
+        """The version of everything a shape built from these spines depends on.
+
+        If this has not changed, neither has the shape.
+        """
+        sig = [spines.version()]
+        for h in h_spines:
+            spine = spines[h]
+            sig.append((h, spine.version()))
+            sig.extend((s, self.segments.version(s)) for s in spine)
+        return tuple(sig)
+
+    def _segments(self, spines, h_spines):
+        return [self.segments[s] for h in h_spines for s in spines[h]]
+
+    def polygon(self, i):
+        """Construct polygon i.
+
+        Polygons are cached, and only rebuilt if one of the segments
+        (or spines) forming them has changed.  The returned polygon is
+        shared with the cache, and must not be modified; its
+        properties are reset to those of HUC i on every call.
+        """
+        boundary, inter = self._spine_handles(i)
+        sig = (self.gons[i][0].version(), self.gons[i][1].version(),
+               self._signature(self.boundaries, boundary),
+               self._signature(self.intersections, inter))
+        try:
+            cached_sig, poly = self._polygon_cache[i]
+        except KeyError:
+            cached_sig = None
+
+        if cached_sig != sig:
+            segs = self._segments(self.boundaries, boundary) + self._segments(self.intersections, inter)
+            ml = shapely.ops.linemerge(segs)
+            assert(type(ml) is shapely.geometry.LineString)
+            poly = shapely.geometry.Polygon(ml)
+            self._polygon_cache[i] = (sig, poly)
 
-        ml = shapely.ops.linemerge(segs)
-        assert(type(ml) is shapely.geometry.LineString)
-        poly = shapely.geometry.Polygon(ml)
         poly.properties = self.properties[i]
         return poly
 
@@ -167,24 +223,86 @@ class SplitHUCs:
             yield i
 
     def exterior(self):
-        """Construct boundary polygon and return a copy."""
-        segs = []
-        for b in self.boundaries:
-            for s in b:
-                segs.append(self.segments[s])
-        ml = shapely.ops.linemerge(segs)
-        assert(type(ml) is shapely.geometry.LineString)
-        return shapely.geometry.Polygon(ml)                
+        """Construct boundary polygon.
+
+        As with polygon(), this is cached, and the returned polygon is
+        shared and must not be modified.
+        """
+        boundary = list(self.boundaries.handles())
+        sig = self._signature(self.boundaries, boundary)
+        if self._exterior_cache is None or self._exterior_cache[0] != sig:
+            ml = shapely.ops.linemerge(self._segments(self.boundaries, boundary))
+            assert(type(ml) is shapely.geometry.LineString)
+            self._exterior_cache = (sig, shapely.geometry.Polygon(ml))
+        return self._exterior_cache[1]
+
+    def is_consistent(self):
+        """Checks that all polygons can be formed.
+
+        This is true exactly when polygon() would succeed for all
+        polygons.  A cheap, topology-only check of the endpoints of
+        each polygon's segments is tried first, and linemerge is only
+        called for polygons that it cannot confirm.
+        """
+        for i in range(len(self.gons)):
+            boundary, inter = self._spine_handles(i)
+            segs = self._segments(self.boundaries, boundary) + self._segments(self.intersections, inter)
+            if not _is_single_line(segs):
+                return False
+        return True
 
     def __len__(self):
         return len(self.gons)
 
 
+def _is_single_line(segs):
+    """Does shapely.ops.linemerge(segs) give a single LineString?
+
+    Zero-length segments, such as those left by snapping, are ignored
+    as linemerge ignores them.  If the endpoints of the remaining
+    segments link them into a single line, linemerge is not called.
+    """
+    segs = [seg for seg in segs if not seg.is_empty and seg.length > 0]
+    if len(segs) == 0:
+        return False
+    if _endpoints_form_line(segs):
+        return True
+    return type(shapely.ops.linemerge(segs)) is shapely.geometry.LineString
+
+def _endpoints_form_line(segs):
+    """Do the endpoints of these segments join them into a single line?"""
+    # no endpoint may be shared by more than two segment ends, and
+    # only the two ends of the line (if it is not a loop) are unshared
+    ends = collections.Counter()
+    for seg in segs:
+        ends[seg.coords[0]] += 1
+        ends[seg.coords[-1]] += 1
+    if any(count > 2 for count in ends.values()) or \
+       sum(1 for count in ends.values() if count == 1) not in [0,2]:
+        return False
+
+    # and the segments must be connected, walking from the first
+    neighbors = collections.defaultdict(list)
+    for j,seg in enumerate(segs):
+        neighbors[seg.coords[0]].append(j)
+        neighbors[seg.coords[-1]].append(j)
+    found = set([0,])
+    stack = [0,]
+    while len(stack) > 0:
+        seg = segs[stack.pop()]
+        for p in [seg.coords[0], seg.coords[-1]]:
+            for j in neighbors[p]:
+                if j not in found:
+                    found.add(j)
+                    stack.append(j)
+    return len(found) == len(segs)
+
 def simplify(hucs, tol=0.1):
     """Simplify, IN PLACE, all segments in the polygon representation."""
     for i,seg in hucs.segments.items():
         hucs.segments[i] = seg.simplify(tol)
 
+@workflow.profiling.profiled()
 def intersect_and_split(list_of_shapes):
     """Given a list of shapes which share boundaries (i.e. they partition
     some space), return a compilation of their segments.
@@ -194,15 +312,22 @@ def intersect_and_split(list_of_shapes):
     uniques             | An N-length-list of either None, LineString,
                         |  or MultiLineString, describing the exterior 
                         |  boundary
-    intersections       | A NxN list of lists of either None, LineString, 
-                        |  or MultiLineString, describing the interior
-                        |  boundary.
+    intersections       | A sparse adjacency dictionary, mapping pairs
+                        |  (i,j) with i > j of neighboring shapes to
+                        |  either a LineString or MultiLineString 
+                        |  describing their shared, interior boundary.
+
+    Only pairs of shapes whose bounding boxes overlap are intersected,
+    so this scales with the number of neighbors rather than N^2.
     """
-    intersections = [[None for i in range(len(list_of_shapes))] for j in range(len(list_of_shapes))]
+    workflow.profiling.record(hucs=len(list_of_shapes))
+    intersections = dict()
     uniques = [shapely.geometry.LineString(list(sh.exterior.coords)) for sh in list_of_shapes]
+    index = workflow.utils.SpatialIndex(list_of_shapes)
 
     for i, s1 in enumerate(list_of_shapes):
-        for j, s2 in enumerate(list_of_shapes):
+        for j in index.query(s1):
+            s2 = list_of_shapes[j]
             if i != j and s1.intersects(s2):
                 inter = s1.intersection(s2)
                 if type(inter) is shapely.geometry.collection.GeometryCollection:
@@ -223,7 +348,7 @@ def intersect_and_split(list_of_shapes):
 
                 # only save once!
                 if i > j:
-                    intersections[i][j] = inter
+                    intersections[i,j] = inter
 
     # merge uniques, as we have a bunch of segments.
     for i,u in enumerate(uniques):
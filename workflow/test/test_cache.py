@@ -0,0 +1,106 @@
+import pytest
+import os
+import fiona.crs
+
+import workflow
+import workflow.conf
+import workflow.cache
+import workflow.sources.names
+
+
+@pytest.fixture
+def data_dir(tmp_path):
+    old = dict(workflow.conf.rcParams)
+    workflow.conf.rcParams['data dir'] = str(tmp_path)
+    workflow.conf.rcParams['cache'] = True
+    yield tmp_path
+    workflow.conf.rcParams.clear()
+    workflow.conf.rcParams.update(old)
+
+
+class FakeSource:
+    """Provides two HUCs and a reach, counting reads."""
+    name = 'fake source'
+
+    def __init__(self):
+        self.reads = 0
+
+    def get_hucs(self, huc, level):
+        self.reads += 1
+        hus = [{'geometry' : {'type' : 'Polygon',
+                              'coordinates' : [[(0,0), (1.123456789,0), (1,1), (0,1), (0,0)]]},
+                'properties' : {'HUC12' : '060102020101', 'name' : 'a'}},
+               {'geometry' : {'type' : 'Polygon',
+                              'coordinates' : [[(1.123456789,0), (2,0), (2,1), (1,1), (1.123456789,0)]]},
+                'properties' : {'HUC12' : '060102020102', 'name' : 'b'}}]
+        return {'crs' : fiona.crs.from_epsg(5070)}, hus
+
+    def get_hydro(self, huc, bounds=None, bounds_crs=None):
+        self.reads += 1
+        reaches = [{'geometry' : {'type' : 'LineString',
+                                  'coordinates' : [(0.5,0.5), (1.5,0.5)]},
+                    'properties' : {'ID' : 1}}]
+        return {'crs' : fiona.crs.from_epsg(5070)}, reaches
+
+
+def test_get_hucs(data_dir):
+    source = FakeSource()
+    crs, hucs = workflow.get_hucs(source, '0601020201', 12, digits=3)
+    assert(source.reads == 1)
+
+    crs2, hucs2 = workflow.get_hucs(source, '0601020201', 12, digits=3)
+    assert(source.reads == 1)
+    assert(crs2 == crs)
+    assert(len(hucs2) == 2)
+    for h, h2 in zip(hucs, hucs2):
+        assert(h.equals_exact(h2, 0.))
+        assert(dict(h.properties) == h2.properties)
+    assert(hucs2[0].exterior.coords[1] == (1.123, 0.))
+
+    # a different key misses the cache
+    crs3, hucs3 = workflow.get_hucs(source, '0601020201', 12, digits=5)
+    assert(source.reads == 2)
+    assert(hucs3[0].exterior.coords[1] == (1.12346, 0.))
+
+
+def test_get_reaches(data_dir):
+    source = FakeSource()
+    crs, reaches = workflow.get_reaches(source, '0601020201', merge=False)
+    crs2, reaches2 = workflow.get_reaches(source, '0601020201', merge=False)
+    assert(source.reads == 1)
+    assert(reaches2[0].equals_exact(reaches[0], 0.))
+    assert(reaches2[0].properties == {'ID' : 1})
+
+    workflow.cache.clear('reaches')
+    crs3, reaches3 = workflow.get_reaches(source, '0601020201', merge=False)
+    assert(source.reads == 2)
+
+
+def test_disabled(data_dir):
+    workflow.conf.rcParams['cache'] = False
+    source = FakeSource()
+    workflow.get_hucs(source, '0601020201', 12)
+    workflow.get_hucs(source, '0601020201', 12)
+    assert(source.reads == 2)
+    assert(not (data_dir / 'cache').exists())
+
+
+def test_key_source_file(data_dir):
+    source = FakeSource()
+    source.file_level = 4
+    source.name_manager = workflow.sources.names.Names('fake', 'fake', None, 'fake_{}.txt')
+    crs = workflow.conf.default_crs()
+    k1 = workflow.cache.key('hucs', source, huc='0601020201', level=12, crs=crs)
+
+    # (re-)downloading or editing the source file changes the key
+    os.makedirs(source.name_manager.data_dir())
+    with open(source.name_manager.file_name('0601'), 'w') as fid:
+        fid.write('a')
+    k2 = workflow.cache.key('hucs', source, huc='0601020201', level=12, crs=crs)
+    assert(k2 != k1)
+    assert(k2 == workflow.cache.key('hucs', source, huc='0601020201', level=12, crs=crs))
+
+    with open(source.name_manager.file_name('0601'), 'w') as fid:
+        fid.write('ab')
+    k3 = workflow.cache.key('hucs', source, huc='0601020201', level=12, crs=crs)
+    assert(k3 != k2)
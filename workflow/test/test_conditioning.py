@@ -3,6 +3,7 @@ import numpy as np
 import logging
 
 import workflow.condition
+import workflow.extrude
 
 def make_points_1D(elevs):
     points = {}
@@ -17,7 +18,21 @@ def make_points_1D(elevs):
         points[i] = workflow.condition.Point(coords, neighbors)
     return points
 
+def make_csr_1D(elevs):
+    neighbors = [[1,],] + [[i-1,i+1] for i in range(1,len(elevs)-1)] + [[len(elevs)-2,],]
+    offsets = np.cumsum([0,]+[len(n) for n in neighbors])
+    return offsets, np.array([n for ns in neighbors for n in ns])
+
 def run_test_1D(elev_in, elev_out, alg):
+    if alg == 4:
+        elev = np.array(elev_in, 'd')
+        offsets, neighbors = make_csr_1D(elev_in)
+        workflow.condition.condition4(elev, offsets, neighbors, 0)
+        print("GOT COORDS:")
+        print(elev)
+        assert(np.all(elev == np.array(elev_out)))
+        return
+
     points = make_points_1D(elev_in)
     if alg == 1:
         workflow.condition.condition1(points, 0)
@@ -36,32 +51,80 @@ def test_null():
     run_test_1D([0,1,2,3,4,5], [0,1,2,3,4,5], 1)
     run_test_1D([0,1,2,3,4,5], [0,1,2,3,4,5], 2)
     run_test_1D([0,1,2,3,4,5], [0,1,2,3,4,5], 3)
+    run_test_1D([0,1,2,3,4,5], [0,1,2,3,4,5], 4)
 
 def test_one_pit():
     run_test_1D([0,1,3,2,4,5], [0,1,3,3,4,5], 1)
     run_test_1D([0,1,3,2,4,5], [0,1,3,3,4,5], 2)
     run_test_1D([0,1,3,2,4,5], [0,1,3,3,4,5], 3)
+    run_test_1D([0,1,3,2,4,5], [0,1,3,3,4,5], 4)
 
 def test_two_pit():
     run_test_1D([0,1,3,2,1,4], [0,1,3,3,3,4], 1)
     run_test_1D([0,1,3,2,1,4], [0,1,3,3,3,4], 2)
     run_test_1D([0,1,3,2,1,4], [0,1,3,3,3,4], 3)
+    run_test_1D([0,1,3,2,1,4], [0,1,3,3,3,4], 4)
 
 def test_two_pit_backwards():
     run_test_1D([0,1,3,1,2,4], [0,1,3,3,3,4], 1)
     run_test_1D([0,1,3,1,2,4], [0,1,3,3,3,4], 2)
     run_test_1D([0,1,3,1,2,4], [0,1,3,3,3,4], 3)
+    run_test_1D([0,1,3,1,2,4], [0,1,3,3,3,4], 4)
 
 def test_double_pit():
     run_test_1D([0,1,2,1,3,1,3,5], [0,1,2,2,3,3,3,5], 1)
     run_test_1D([0,1,2,1,3,1,3,5], [0,1,2,2,3,3,3,5], 2)
     run_test_1D([0,1,2,1,3,1,3,5], [0,1,2,2,3,3,3,5], 3)
+    run_test_1D([0,1,2,1,3,1,3,5], [0,1,2,2,3,3,3,5], 4)
 
 def test_bad_outlet_pit():
     run_test_1D([0,1,3,-1,4,5], [0,1,3,3,4,5], 1)
     run_test_1D([0,1,3,-1,4,5], [0,1,3,3,4,5], 2)
     run_test_1D([0,1,3,-1,4,5], [0,1,3,3,4,5], 3)
-    
+    run_test_1D([0,1,3,-1,4,5], [0,1,3,3,4,5], 4)
 
 
-    
+class Mesh:
+    """A minimal stand-in for a surface mesh."""
+    def __init__(self, coords, conn):
+        self.coords = coords
+        self.conn = conn
+
+def test_neighbors_from_mesh():
+    # two triangles and a quad
+    coords = np.zeros((6,3),'d')
+    m2 = Mesh(coords, [[0,1,2], [1,3,2], [2,3,5,4]])
+    offsets, neighbors = workflow.condition.neighbors_from_mesh(m2)
+    points = workflow.condition.points_from_mesh(m2)
+    for i in range(6):
+        assert(set(neighbors[offsets[i]:offsets[i+1]]) == points[i].neighbors)
+
+def test_condition_mesh():
+    # a 3x3 grid of nodes with a pit in the middle
+    x, y = np.meshgrid(np.arange(3), np.arange(3))
+    z = np.array([5., 2, 0, 2, -1, 4, 3, 4, 5])
+    coords = np.array([x.ravel(), y.ravel(), z]).transpose()
+    conn = [[0,1,4], [0,4,3], [1,2,5], [1,5,4], [3,4,7], [3,7,6], [4,5,8], [4,8,7]]
+    m2 = Mesh(coords.copy(), conn)
+    workflow.condition.condition(m2, 2, algorithm=4)
+
+    m2_3 = Mesh(coords.copy(), conn)
+    workflow.condition.condition(m2_3, 2, algorithm=3)
+    assert(np.allclose(m2.coords, m2_3.coords))
+    assert(m2.coords[4,2] == 2)
+
+def test_condition_mesh_hole():
+    # a 3x3 grid of squares with the center removed, the lowest node on
+    # the hole, which is not an outlet
+    x, y = np.meshgrid(np.arange(4.), np.arange(4.))
+    z = 10. - x - y
+    z[1,1] = -3.
+    coords = np.array([x.ravel(), y.ravel(), z.ravel()]).transpose()
+    conn = [[j*4+i, j*4+i+1, (j+1)*4+i+1, (j+1)*4+i] for j in range(3) for i in range(3)
+            if (i,j) != (1,1)]
+    m2 = workflow.extrude.Mesh2D(coords, conn)
+    workflow.condition.condition(m2)
+
+    # the outlet is the lowest node on the outer boundary
+    assert(m2.coords[15,2] == 4.)
+    assert(m2.coords[5,2] > 4.)
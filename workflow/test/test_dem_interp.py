@@ -47,3 +47,26 @@ def test_interp(dem_and_points):
     vals = workflow.values_from_raster(xy, dem_profile['crs'], dem, dem_profile,'piecewise bilinear')
     assert(np.allclose(np.array([1,1,3.5,3.5,3.5,10,10,2,1]), vals, 1.e-4))
     
+
+def test_interp_nodata(dem_and_points):
+    dem, dem_profile, xy = dem_and_points
+    dem[1,1] = np.nan
+    vals = workflow.values_from_raster(xy, dem_profile['crs'], dem, dem_profile,'piecewise bilinear')
+    # the nodata pixel is dropped and the remaining weights renormalized
+    assert(np.allclose(np.array([1,1,4./3,4./3,4./3,1.5,1.5,2,1]), vals, 1.e-4))
+
+def test_bicubic(dem_and_points):
+    dem, dem_profile, xy = dem_and_points
+
+    # bicubic reproduces linear functions
+    dem = np.array([[0.,1,2,3],[1,2,3,4],[2,3,4,5],[3,4,5,6]])
+    dem_profile['height'] = 4
+    dem_profile['width'] = 4
+    xy = np.array([(1.5,1.5), (1.75,2.), (2.1,1.7), (2.5,2.5)])
+    vals = workflow.values_from_raster(xy, dem_profile['crs'], dem, dem_profile,'bicubic')
+    assert(np.allclose(xy[:,0] + xy[:,1] - 1, vals))
+
+    # and falls back to bilinear near nodata
+    dem[0,0] = np.nan
+    vals = workflow.values_from_raster(xy, dem_profile['crs'], dem, dem_profile,'bicubic')
+    assert(np.allclose(xy[:,0] + xy[:,1] - 1, vals))
@@ -0,0 +1,320 @@
+import pytest
+import numpy as np
+
+import workflow.extrude
+
+
+@pytest.fixture
+def mixed():
+    """A unit square and a right triangle, the triangle clockwise."""
+    coords = np.array([[0.,0.], [1.,0.], [1.,1.], [0.,1.], [2.,0.]])
+    conn = [[0,1,2,3], [1,2,4]]
+    return coords, conn
+
+
+def test_handedness(mixed):
+    coords, conn = mixed
+    m2 = workflow.extrude.Mesh2D(coords, conn)
+    assert(m2.conn == [[0,1,2,3], [4,2,1]])
+    assert(np.allclose(m2.signed_areas(), [1., 0.5]))
+
+    # padded arrays are fixed in place
+    padded, sizes = workflow.extrude._pad_connectivity(mixed[1])
+    m2 = workflow.extrude.Mesh2D(coords, padded)
+    assert(m2.conn is padded)
+    assert(np.all(padded == [[0,1,2,3], [4,2,1,-1]]))
+    assert(np.allclose(m2.signed_areas(), [1., 0.5]))
+
+
+def test_quality(mixed):
+    coords, conn = mixed
+    m2 = workflow.extrude.Mesh2D(coords, conn)
+
+    assert(np.allclose(m2.centroids(), [[0.5,0.5,0.], [4./3,1./3,0.]]))
+    lengths = m2.edge_lengths()
+    assert(np.allclose(lengths[0], 1.))
+    assert(np.allclose(lengths[1,0:3], [np.sqrt(2), 1., 1.]))
+    assert(np.isnan(lengths[1,3]))
+
+    assert(np.allclose(m2.min_angles(), [90., 45.]))
+    assert(np.allclose(m2.max_angles(), [90., 90.]))
+    assert(np.allclose(m2.aspect_ratios()[0], 1.))
+    assert(m2.aspect_ratios()[1] > 1.)
+
+
+def test_quality_nonconvex():
+    # an L-shape has one reflex angle, and a flat triangle is degenerate
+    coords = np.array([[0.,0.], [2.,0.], [2.,1.], [1.,1.], [1.,2.], [0.,2.], [3.,0.], [4.,0.]])
+    m2 = workflow.extrude.Mesh2D(coords, [[0,1,2,3,4,5], [1,6,7]])
+    assert(np.allclose(m2.max_angles()[0], 270.))
+    assert(np.allclose(np.nansum(m2.angles()[0]), 720.))
+    assert(m2.aspect_ratios()[1] == np.inf)
+
+
+def test_boundary_loops():
+    # a 3x3 grid of squares with the center removed, and a disjoint triangle
+    x, y = np.meshgrid(np.arange(4.), np.arange(4.))
+    coords = np.concatenate([np.stack([x.ravel(), y.ravel()], axis=1),
+                             [[10.,0.], [11.,0.], [10.,1.]]])
+    conn = [[j*4+i, j*4+i+1, (j+1)*4+i+1, (j+1)*4+i] for j in range(3) for i in range(3)
+            if (i,j) != (1,1)] + [[16,17,18],]
+    m2 = workflow.extrude.Mesh2D(coords, conn)
+
+    loops = m2.boundary_loops()
+    assert(len(loops) == 3)
+    assert([len(l) for l in loops] == [12, 4, 3])
+    for loop in loops:
+        for e, e_next in zip(loop, loop[1:]+loop[:1]):
+            assert(e[1] == e_next[0])
+    assert(set(loops[1][0]) == {5,6})
+    assert(m2.boundary_loops() is loops)
+
+    # the outer boundary is the loop enclosing the most area
+    assert(m2.boundary_edges() == loops[0])
+    assert(m2.boundary_nodes() == [0,1,2,3,7,11,15,14,13,12,8,4])
+
+
+@pytest.mark.parametrize('binary', [True, False])
+def test_read_vtk(tmp_path, binary):
+    from workflow_tpls import vtk_io
+    coords = np.array([[0.,0.,1.], [1.,0.,2.], [1.,1.,3.], [0.,1.,4.]])
+    tris = np.array([[0,1,2], [0,3,2]])
+    filename = str(tmp_path / 'tris.vtk')
+    vtk_io.write(filename, coords, {'triangle':tris}, point_data={'z':coords[:,2]},
+                 write_binary=binary)
+
+    points, cells, point_data, _, _ = vtk_io.read(filename)
+    assert(np.all(points == coords))
+    assert(np.all(cells['triangle'] == tris))
+    assert(np.all(point_data['z'] == coords[:,2]))
+
+    m2 = workflow.extrude.Mesh2D.read_VTK(filename)
+    assert(np.all(m2.coords == coords))
+    assert(m2.conn == [[0,1,2], [2,3,0]])
+
+
+def test_read_vtk_polygons(tmp_path):
+    coords = np.array([[0.,0.,0.], [1.,0.,0.], [1.,1.,0.], [0.,1.,0.], [2.,0.,0.]])
+    polygons = np.array([4, 0,3,2,1, 3, 1,2,4], dtype='>i4')
+    filename = str(tmp_path / 'polygons.vtk')
+    with open(filename, 'wb') as fid:
+        fid.write(b'# vtk DataFile Version 3.0\npolygons\nBINARY\nDATASET POLYDATA\n')
+        fid.write(b'POINTS 5 double\n' + coords.astype('>f8').tobytes() + b'\n')
+        fid.write(b'POLYGONS 2 9\n' + polygons.tobytes() + b'\n')
+
+    m2 = workflow.extrude.Mesh2D.read_VTK(filename)
+    assert(m2.conn == [[1,2,3,0], [4,2,1]])
+    assert(np.allclose(m2.signed_areas(), [1., 0.5]))
+
+
+def read_vtu_arrays(filename):
+    """Decodes the appended arrays of a .vtu file, by name."""
+    import re
+    import zlib
+    with open(filename, 'rb') as fid:
+        contents = fid.read()
+    header, data = contents.split(b'<AppendedData encoding="raw">\n_', 1)
+    header = header.decode('utf-8')
+    compressed = 'compressor="vtkZLibDataCompressor"' in header
+    types = {'Float64':'<f8', 'Int64':'<i8', 'Int32':'<i4', 'UInt8':'u1'}
+
+    arrays = {}
+    for attrs in re.findall(r'<DataArray ([^>]*)/>', header):
+        attrs = dict(re.findall(r'(\w+)="([^"]*)"', attrs))
+        offset = int(attrs['offset'])
+        if compressed:
+            nblocks = int(np.frombuffer(data, '<u8', 1, offset)[0])
+            sizes = np.frombuffer(data, '<u8', 3+nblocks, offset)[3:].tolist()
+            pos = offset + 8*(3+nblocks)
+            raw = b''
+            for size in sizes:
+                raw += zlib.decompress(data[pos:pos+size])
+                pos += size
+        else:
+            nbytes = int(np.frombuffer(data, '<u8', 1, offset)[0])
+            raw = data[offset+8:offset+8+nbytes]
+        array = np.frombuffer(raw, types[attrs['type']])
+        if 'NumberOfComponents' in attrs:
+            array = array.reshape(-1, int(attrs['NumberOfComponents']))
+        arrays[attrs.get('Name', 'points')] = array
+    return arrays
+
+
+@pytest.mark.parametrize('compression', [None, 'zlib'])
+def test_write_vtu(tmp_path, compression):
+    from workflow_tpls import vtk_io
+    coords = np.array([[0.,0.,1.], [1.,0.,2.], [1.,1.,3.], [0.,1.,4.]])
+    cells = {'triangle' : np.array([[0,1,2], [0,2,3]]),
+             'quad' : np.array([[0,1,2,3],])}
+    filename = str(tmp_path / 'mesh.vtu')
+    vtk_io.write_vtu(filename, coords, cells, point_data={'z':coords[:,2]},
+                     cell_data={'triangle':{'id':np.array([1,2])}, 'quad':{'id':np.array([3,])}},
+                     compression=compression, block_size=20, chunk_size=2)
+
+    arrays = read_vtu_arrays(filename)
+    assert(np.all(arrays['points'] == coords))
+    assert(np.all(arrays['z'] == coords[:,2]))
+    assert(np.all(arrays['id'] == [1,2,3]))
+    assert(np.all(arrays['connectivity'] == [0,1,2,0,2,3,0,1,2,3]))
+    assert(np.all(arrays['offsets'] == [3,6,10]))
+    assert(np.all(arrays['types'] == [5,5,9]))
+
+
+def test_extrude(mixed):
+    coords, conn = mixed
+    m2 = workflow.extrude.Mesh2D(coords, conn)
+    m3 = workflow.extrude.Mesh3D.extruded_Mesh2D(m2, ['constant','constant'], [2.,3.], [2,1], [1001,1002])
+
+    # nodes are numbered by 2D node, then depth
+    assert(m3.num_nodes() == 20)
+    assert(np.allclose(m3.coords[:,0:2], np.repeat(coords, 4, axis=0)))
+    assert(np.allclose(m3.coords[:,2], np.tile([0.,-1.,-2.,-5.], 5)))
+
+    # horizontal faces by column, then depth, then vertical faces by 2D edge, then depth
+    faces, nodes_per_face = workflow.extrude._pad_connectivity(m3.face_to_node_conn)
+    assert(workflow.extrude._unpad_connectivity(faces, nodes_per_face) ==
+           [[0,4,8,12], [1,5,9,13], [2,6,10,14], [3,7,11,15],
+            [16,8,4], [17,9,5], [18,10,6], [19,11,7],
+            [0,4,5,1], [1,5,6,2], [2,6,7,3],
+            [4,8,9,5], [5,9,10,6], [6,10,11,7],
+            [8,12,13,9], [9,13,14,10], [10,14,15,11],
+            [0,12,13,1], [1,13,14,2], [2,14,15,3],
+            [8,16,17,9], [9,17,18,10], [10,18,19,11],
+            [4,16,17,5], [5,17,18,6], [6,18,19,7]])
+
+    # cells by column, then depth: top, bottom, then vertical faces
+    elems, faces_per_elem = workflow.extrude._pad_connectivity(m3.elem_to_face_conn)
+    assert(workflow.extrude._unpad_connectivity(elems, faces_per_elem) ==
+           [[0,1,8,11,14,17], [1,2,9,12,15,18], [2,3,10,13,16,19],
+            [4,5,20,11,23], [5,6,21,12,24], [6,7,22,13,25]])
+
+    assert([(ss.name, ss.setid) for ss in m3.side_sets] ==
+           [('bottom',1), ('surface',2), ('external_sides',3)])
+    bottom, surface, sides = m3.side_sets
+    assert(list(bottom.elem_list) == [2,5])
+    assert(list(bottom.side_list) == [1,1])
+    assert(list(surface.elem_list) == [0,3])
+    assert(list(surface.side_list) == [0,0])
+    assert(list(sides.elem_list) == [0,1,2,0,1,2,0,1,2,3,4,5,3,4,5])
+    assert(list(sides.side_list) == [2,2,2,4,4,4,5,5,5,2,2,2,4,4,4])
+    assert(m3.labeled_sets == [])
+
+    assert(list(m3.material_ids) == [1001,1001,1002,1001,1001,1002])
+    assert(list(m3.material_id_list) == [1001,1002])
+
+    # the same mesh from padded 2D connectivity
+    padded, sizes = workflow.extrude._pad_connectivity(conn)
+    m3p = workflow.extrude.Mesh3D.extruded_Mesh2D(workflow.extrude.Mesh2D(coords, padded),
+                                                  ['constant','constant'], [2.,3.], [2,1], [1001,1002])
+    assert(np.all(m3p.face_to_node_conn == m3.face_to_node_conn))
+    assert(np.all(m3p.elem_to_face_conn == m3.elem_to_face_conn))
+
+
+def test_mesh3D_padded():
+    # two tets sharing a face, given as lists and as padded arrays
+    coords = np.array([[0.,0.,0.], [1.,0.,0.], [0.,1.,0.], [0.,0.,1.], [1.,1.,1.]])
+    faces = [[0,1,2], [0,1,3], [1,2,3], [0,2,3], [1,2,4], [1,3,4], [2,3,4]]
+    elems = [[0,1,2,3], [2,4,5,6]]
+    sides = [workflow.extrude.SideSet('side', 1, [1,], [3,])]
+    m3 = workflow.extrude.Mesh3D(coords, faces, elems, side_sets=sides)
+
+    padded_faces, _ = workflow.extrude._pad_connectivity(faces)
+    padded_elems, _ = workflow.extrude._pad_connectivity(elems)
+    m3p = workflow.extrude.Mesh3D(coords, padded_faces, padded_elems, side_sets=sides,
+                                  material_ids=np.array([2,1]))
+    assert(m3p.num_faces() == m3.num_faces() == 7)
+    assert(m3p.num_cells() == m3.num_cells() == 2)
+    assert(m3p.material_id_list == [2,1])
+
+    # padding only at the end of a row, and no repeated entries
+    bad = padded_elems.copy()
+    bad[0,1] = -1
+    with pytest.raises(AssertionError):
+        workflow.extrude.Mesh3D(coords, padded_faces, bad)
+    bad = padded_elems.copy()
+    bad[0,1] = 0
+    with pytest.raises(AssertionError):
+        workflow.extrude.Mesh3D(coords, padded_faces, bad)
+
+    # side sets must refer to faces of the elem
+    with pytest.raises(AssertionError):
+        workflow.extrude.Mesh3D(coords, padded_faces, padded_elems,
+                                side_sets=[workflow.extrude.SideSet('side', 1, [1,], [4,])])
+
+
+@pytest.fixture
+def exodus_calls(monkeypatch):
+    """Replaces the exodus module with a stub recording all calls to the file."""
+    import sys
+    import types
+    calls = []
+
+    def record(name):
+        def put(*args):
+            calls.append((name,) + tuple(a.tolist() if type(a) is np.ndarray else a for a in args))
+        return put
+
+    class ExodusFile:
+        def __getattr__(self, name):
+            return record(name)
+
+    def ex_init_params(title, **kwargs):
+        calls.append(('ex_init_params', kwargs))
+
+    stub = types.ModuleType('exodus')
+    stub.ex_init_params = ex_init_params
+    stub.exodus = lambda *args, **kwargs: ExodusFile()
+    monkeypatch.setitem(sys.modules, 'exodus', stub)
+    return calls
+
+
+# a triangle extruded 3 cells deep, with material ids 1, 2, 1 from the top
+_faces_all = [1,5,9, 2,6,10, 3,7,11, 4,8,12,
+              1,5,6,2, 2,6,7,3, 3,7,8,4, 5,9,10,6, 6,10,11,7, 7,11,12,8, 1,9,10,2, 2,10,11,3, 3,11,12,4]
+_counts_all = [3,]*4 + [4,]*9
+_faces_blk1 = [1,5,9, 2,6,10, 1,5,6,2, 5,9,10,6, 1,9,10,2,
+               3,7,11, 4,8,12, 3,7,8,4, 7,11,12,8, 3,11,12,4]
+_counts_blk1 = [3,3,4,4,4,3,3,4,4,4]
+
+@pytest.mark.parametrize('mode, face_blks, elem_face_conns', [
+    ('one block',
+     [(_counts_all, _faces_all),],
+     [[1,2,5,8,11, 3,4,7,10,13], [2,3,6,9,12]]),
+    ('n blocks, not duplicated',
+     [(_counts_blk1, _faces_blk1), ([4,4,4], [2,6,7,3, 6,10,11,7, 2,10,11,3])],
+     [list(range(1,11)), [2,6,11,12,13]]),
+    ('n blocks, duplicated',
+     [(_counts_blk1, _faces_blk1), ([3,3,4,4,4], [2,6,10, 3,7,11, 2,6,7,3, 6,10,11,7, 2,10,11,3])],
+     [list(range(1,11)), [1,2,3,4,5]]),
+    ('one block, repeated',
+     [(_counts_all, _faces_all), (_counts_all, _faces_all)],
+     [[1,2,5,8,11, 3,4,7,10,13], [2,3,6,9,12]]),
+    ])
+def test_write_exodus(exodus_calls, mode, face_blks, elem_face_conns):
+    m2 = workflow.extrude.Mesh2D(np.array([[0.,0.], [1.,0.], [0.,1.]]), [[0,1,2],])
+    m3 = workflow.extrude.Mesh3D.extruded_Mesh2D(m2, ['constant',]*3, [1.,1.,1.], [1,1,1], [1,2,1])
+    m3.write_exodus('mesh.exo', mode, chunk_size=2)
+
+    calls = [c for c in exodus_calls if c[0] not in ['put_coord_names', 'put_coords', 'close']]
+    expected = [('ex_init_params', {'num_dim':3, 'num_nodes':12,
+                                    'num_face':sum(len(counts) for counts, _ in face_blks),
+                                    'num_face_blk':len(face_blks),
+                                    'num_elem':3, 'num_elem_blk':2, 'num_side_sets':3})]
+    for i, (counts, conn) in enumerate(face_blks):
+        expected.extend([('put_polyhedra_face_blk', i+1, len(counts), len(conn), 0),
+                         ('put_node_count_per_face', i+1, counts),
+                         ('put_face_node_conn', i+1, conn)])
+    for m_id, n_elems, conn in zip([1,2], [2,1], elem_face_conns):
+        expected.extend([('put_polyhedra_elem_blk', m_id, n_elems, len(conn), 0),
+                         ('put_elem_blk_name', m_id, 'MATERIAL_ID_%d'%m_id),
+                         ('put_face_count_per_polyhedra', m_id, [5,]*n_elems),
+                         ('put_elem_face_conn', m_id, conn)])
+    # elems are renumbered 0, 2, 1 by block
+    expected.extend([('put_side_set_names', ['bottom', 'surface', 'external_sides']),
+                     ('put_side_set_params', 1, 1, 0),
+                     ('put_side_set', 1, [2,], [2,]),
+                     ('put_side_set_params', 2, 1, 0),
+                     ('put_side_set', 2, [1,], [1,]),
+                     ('put_side_set_params', 3, 9, 0),
+                     ('put_side_set', 3, [1,3,2]*3, [3,3,3,4,4,4,5,5,5])])
+    assert(calls == expected)
@@ -36,19 +36,22 @@ def test_intersect_and_split(two_boxes):
         assert type(b) is shapely.geometry.LineString
         assert len(b.coords) == 4
 
-    assert(len(intersections) is 2)
-    for i,row in enumerate(intersections):
-        assert(len(row) is 2)
-        for j,entry in enumerate(row):
-            print("At i,j=%d,%d type is %r"%(i,j,type(entry)))
-            if i <= j:
-                assert entry is None
-            else:
-                assert type(entry) is shapely.geometry.LineString
-                assert len(entry.coords) is 2
-                workflow.utils.close(entry.coords[0], (10,-5))
-                workflow.utils.close(entry.coords[1], (10,5))
+    assert(len(intersections) == 1)
+    assert(list(intersections.keys()) == [(1,0),])
+    entry = intersections[1,0]
+    assert type(entry) is shapely.geometry.LineString
+    assert len(entry.coords) is 2
+    workflow.utils.close(entry.coords[0], (10,-5))
+    workflow.utils.close(entry.coords[1], (10,5))
         
+
+def test_intersect_and_split_sparse(three_boxes):
+    boundaries, intersections = workflow.split_hucs.intersect_and_split(three_boxes)
+    assert(len(boundaries) == 3)
+
+    # boxes 0 and 2 are not neighbors, so get no entry
+    assert(sorted(intersections.keys()) == [(1,0), (2,1)])
+    
     
 def test_hucs(two_boxes):
     # test construction
@@ -172,3 +175,59 @@ def test_hucs_triple():
     spine3 = hucs.segments[intersections[2]]
     assert(workflow.utils.close(spine3, shapely.geometry.LineString([(10,5), (20,5)])))
     
+
+
+def test_hc_versions():
+    hc = workflow.split_hucs.HandledCollection(['a','b'])
+    v = hc.version()
+    assert(hc.version(0) < hc.version(1) == v)
+    hc[0] = 'c'
+    assert(hc.version() > v)
+    assert(hc.version(0) == hc.version())
+    assert(hc.version(1) == v)
+
+
+def test_polygon_cache(two_boxes):
+    tb = workflow.split_hucs.SplitHUCs(two_boxes)
+    assert(tb.is_consistent())
+    poly0 = tb.polygon(0)
+    poly1 = tb.polygon(1)
+    exterior = tb.exterior()
+
+    # nothing changed, nothing is rebuilt
+    assert(tb.polygon(0) is poly0)
+    assert(tb.exterior() is exterior)
+
+    # add a point to the shared segment, which changes both polygons
+    # but not the exterior
+    h = next(s for i in tb.intersections for s in i)
+    coords = list(tb.segments[h].coords)
+    coords.insert(1, (11,0))
+    tb.segments[h] = shapely.geometry.LineString(coords)
+    assert(tb.is_consistent())
+    assert(tb.polygon(0) is not poly0)
+    assert(tb.polygon(1) is not poly1)
+    assert(len(tb.polygon(0).exterior.coords) == len(poly0.exterior.coords)+1)
+    assert(tb.exterior() is exterior)
+
+    # moving both endpoints breaks the topology
+    tb.segments[h] = shapely.geometry.LineString([(11,-4), (11,4)])
+    assert(not tb.is_consistent())
+    with pytest.raises(AssertionError):
+        tb.polygon(0)
+
+
+def test_is_consistent_zero_length():
+    # snapping a river endpoint onto an existing HUC coordinate, as in
+    # test_hydrography.py::test_snap0d, can leave a zero-length segment
+    b1 = [(0, -5), (10,-5), (10,0.), (10,5), (0,5)]
+    hucs = workflow.split_hucs.SplitHUCs([shapely.geometry.Polygon(b1),])
+    spine = next(iter(hucs.boundaries))
+    h = next(iter(spine))
+    coords = list(hucs.segments[h].coords)
+    i = coords.index((10.,0.))
+    hucs.segments[h] = shapely.geometry.LineString(coords[i:] + coords[1:i+1])
+    spine.add(hucs.segments.add(shapely.geometry.LineString([(10.,0.), (10.,0.)])))
+
+    assert(hucs.is_consistent())
+    assert(hucs.polygon(0).equals(shapely.geometry.Polygon(b1)))
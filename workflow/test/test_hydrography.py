@@ -23,6 +23,26 @@ def test_close_cleanup(rivers):
     rivers_clean = workflow.hydrography.quick_cleanup(rivers_wextra)
     assert_close(rivers_clean, rivers, 0.1)
 
+def test_filter_rivers_to_shape(rivers):
+    """Tests that filtering removes reaches outside or touching at a point"""
+    shape = shapely.geometry.box(5,-5,20,5)
+    filtered = workflow.hydrography.filter_rivers_to_shape(shape, rivers, 0.1)
+    assert(len(filtered) == 4)
+    assert_close(shapely.geometry.MultiLineString(filtered),
+                 shapely.geometry.MultiLineString(list(rivers)[1:]))
+
+    # the outlet is removed, so its tree is split into two trees
+    trees = workflow.hydrography.make_global_tree(rivers)
+    assert(len(trees) == 1)
+    filtered = workflow.hydrography.filter_rivers_to_shape(shape, trees, 0.1)
+    assert(len(filtered) == 2)
+    assert(sum(len(tree) for tree in filtered) == 4)
+
+    # nothing is removed, so the tree is not rebuilt
+    filtered = workflow.hydrography.filter_rivers_to_shape(shapely.geometry.box(-1,-5,20,5), trees, 0.1)
+    assert(len(filtered) == 1)
+    assert(filtered[0] is trees[0])
+
 def data(poly_hucs,river_segs):
     hucs = workflow.split_hucs.SplitHUCs(poly_hucs)
     rivers = workflow.hydrography.make_global_tree(river_segs)
@@ -431,3 +451,39 @@ def test_snap8():
     check2b(hucs,rivers)
 
     
+
+def test_snap_crossings(two_boxes):
+    # a reach crossing the inner boundary is cut, as is the boundary
+    rs = [shapely.geometry.LineString([(5.,0.), (15,0)]),]
+    hucs, rivers = data(two_boxes, rs)
+    workflow.hydrography.snap_crossings(hucs, rivers, 0.1)
+
+    riverlist = list(rivers[0].dfs())
+    assert(len(riverlist) == 2)
+    assert(workflow.utils.close(riverlist[0], shapely.geometry.LineString([(10,0), (15,0)])))
+    assert(workflow.utils.close(riverlist[1], shapely.geometry.LineString([(5,0), (10,0)])))
+    assert(workflow.tree.is_consistent(rivers[0]))
+
+    inter = sorted((hucs.segments[h] for spine in hucs.intersections for h in spine), key=lambda l:l.bounds[1])
+    assert(len(inter) == 2)
+    assert(workflow.utils.close(inter[0], shapely.geometry.LineString([(10,0), (10,-5)])))
+    assert(workflow.utils.close(inter[1], shapely.geometry.LineString([(10,5), (10,0)])))
+    assert(hucs.is_consistent())
+
+def test_snap_crossings_twice(two_boxes):
+    # a reach crossing the outer boundary upstream of the inner boundary
+    # is cut at both, not just the first crossing found
+    rs = [shapely.geometry.LineString([(-5.,0.), (15,0)]),]
+    hucs, rivers = data(two_boxes, rs)
+    workflow.hydrography.snap_crossings(hucs, rivers, 0.1)
+
+    riverlist = list(rivers[0].dfs())
+    assert(len(riverlist) == 3)
+    assert(workflow.utils.close(riverlist[0], shapely.geometry.LineString([(10,0), (15,0)])))
+    assert(workflow.utils.close(riverlist[1], shapely.geometry.LineString([(0,0), (10,0)])))
+    assert(workflow.utils.close(riverlist[2], shapely.geometry.LineString([(-5,0), (0,0)])))
+    assert(workflow.tree.is_consistent(rivers[0]))
+
+    assert(len(hucs.segments) == 5)
+    assert(hucs.is_consistent())
+    assert(workflow.utils.close(hucs.polygon(0), shapely.geometry.Polygon([(0,-5), (10,-5), (10,0), (10,5), (0,5), (0,0)])))
@@ -0,0 +1,47 @@
+import pytest
+import json
+
+import workflow.profiling
+
+
+@pytest.fixture
+def profiling():
+    workflow.profiling.reset()
+    workflow.profiling.enable()
+    yield workflow.profiling
+    workflow.profiling.enable(False)
+    workflow.profiling.reset()
+
+
+@workflow.profiling.profiled()
+def outer(n):
+    workflow.profiling.record(things=n)
+    with workflow.profiling.stage('inner', points=2*n):
+        pass
+    return n
+
+
+def test_disabled():
+    workflow.profiling.reset()
+    assert(not workflow.profiling.enabled())
+    assert(outer(3) == 3)
+    assert(len(workflow.profiling.report()['stages']) == 0)
+
+
+def test_stages(profiling, tmp_path):
+    assert(outer(3) == 3)
+    assert(outer(4) == 4)
+
+    rep = profiling.report()
+    assert([s['stage'] for s in rep['stages']] == ['outer', 'outer/inner', 'outer', 'outer/inner'])
+    assert(rep['stages'][0]['counts'] == {'things':3})
+    assert(rep['stages'][1]['counts'] == {'points':6})
+    assert(rep['stages'][1]['depth'] == 1)
+    assert(rep['totals']['outer']['calls'] == 2)
+    assert(all(s['wall_time'] >= 0 for s in rep['stages']))
+    assert(rep['total_wall_time'] >= rep['totals']['outer/inner']['wall_time'])
+
+    filename = str(tmp_path / 'mesh.vtk.profile.json')
+    profiling.write_report(filename)
+    with open(filename) as fid:
+        assert(json.load(fid)['totals']['outer']['calls'] == 2)
@@ -76,3 +76,14 @@ def test_to_list(y_with_junction):
     
 
     
+def test_deep():
+    # deeper than the recursion limit
+    n = 5000
+    ml = shapely.geometry.MultiLineString([[(i+1,0), (i,0)] for i in range(n)])
+    trees = workflow.tree.make_trees(ml)
+    assert(len(trees) == 1)
+    assert(len(trees[0]) == n)
+    riverlist = list(trees[0].dfs())
+    assert(riverlist[0] == ml[0])
+    assert(riverlist[-1] == ml[n-1])
+    assert(workflow.tree.is_consistent(trees[0].children[0]))
@@ -7,6 +7,7 @@ Not sure how to test them..."""
 
 import pytest
 import shapely
+import numpy as np
 from matplotlib import pyplot as plt
 
 import workflow.triangulation
@@ -58,3 +59,67 @@ def test_triangulate_distance(hucs_rivers):
     # workflow.plot.hucs(hucs,'r')
     # workflow.plot.rivers(rivers,'b')
     # plt.show()
+
+def test_nodes_edges_array():
+    segments = [shapely.geometry.Polygon([(0,0), (10,0), (10,10), (0,10)]),
+                shapely.geometry.LineString([(5.,0.), (5.0001,5.), (10,10)]),
+                shapely.geometry.LineString([(0,10), (5.00001,5.)])]
+    ne = workflow.triangulation.NodesEdges(segments)
+    nea = workflow.triangulation.NodesEdgesArray(segments)
+
+    assert(nea.nodes.dtype == np.float64)
+    assert(nea.edges.dtype == np.int32)
+    assert(np.allclose(np.array(list(ne.nodes)), nea.nodes))
+    assert(set(ne.edges) == set(tuple(e) for e in nea.edges))
+    nea.check(tol=1.e-3)
+
+def test_triangulate_distance_tol(hucs_rivers):
+    hucs,rivers = hucs_rivers
+    func = workflow.triangulation.refine_from_river_distance(1., 0.5, 4, 2, rivers, tol=0.1)
+    points, tris = workflow.triangulation.triangulate(hucs, rivers, refinement_func=func)
+    assert(len(tris) > 0)
+
+    # the mesh covers the domain, and no triangle needs refinement (up
+    # to roundoff between Triangle's areas and ours)
+    quality = workflow.triangulation.triangle_quality(points, tris)
+    assert(np.isclose(quality['areas'].sum(), hucs.exterior().area))
+    assert(not np.any(func.vectorized(quality['vertices'], quality['areas'] * (1 - 1.e-10))))
+
+def test_river_distance():
+    rs = [shapely.geometry.LineString([(5.,0.), (10.,5),]),
+          shapely.geometry.LineString([(15.,0.), (10.,5),]),
+          shapely.geometry.LineString([(10.,5.), (10,10)]),
+    ]
+    rivers = workflow.hydrography.make_global_tree(rs)
+    xy = np.random.RandomState(0).uniform(0, 20, (100,2))
+
+    exact = workflow.triangulation.river_distance(rivers)(xy)
+    for tol in [1., 0.1, 0.01]:
+        approx = workflow.triangulation.river_distance(rivers, tol)(xy)
+        assert(np.all(approx >= exact - 1.e-12))
+        assert(np.all(approx <= exact + tol))
+
+def test_triangle_quality(hucs_rivers):
+    hucs,rivers = hucs_rivers
+    funcs = [workflow.triangulation.refine_from_max_area(1.),
+             workflow.triangulation.refine_from_river_distance(1., 0.5, 4, 2, rivers),
+             workflow.triangulation.refine_from_max_edge_length(2.)]
+    points, tris = workflow.triangulation.triangulate(hucs, rivers)
+    quality = workflow.triangulation.triangle_quality(points, tris)
+
+    assert(np.allclose(quality['areas'], [workflow.utils.triangle_area(points[t]) for t in tris]))
+    assert(np.isclose(quality['areas'].sum(), hucs.exterior().area))
+    assert(np.allclose(quality['centroids'], points[tris].mean(axis=1)))
+    assert(np.all(quality['min_angles'] > 0))
+    assert(np.all(quality['min_angles'] <= 60 + 1.e-10))
+    assert(np.all(quality['max_angles'] >= 60 - 1.e-10))
+
+    # vectorized refinement criteria match the per-triangle functions
+    for func in funcs:
+        expected = [func(points[t], a) for (t,a) in zip(tris, quality['areas'])]
+        assert(list(func.vectorized(quality['vertices'], quality['areas'])) == expected)
+
+    # precomputed distances are used rather than recomputed
+    distances = np.zeros(len(tris))
+    assert(np.all(funcs[1].vectorized(quality['vertices'], quality['areas'], distances) ==
+                  (quality['areas'] > 0.5)))
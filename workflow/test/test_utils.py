@@ -169,6 +169,27 @@ def test_cut_two_ways():
     
     
     
+def test_cut_overlap_raises():
+    line = shapely.geometry.LineString([(0,0), (1,0), (2,0)])
+    cut = shapely.geometry.LineString([(0.5,-1), (0.5,0), (0.7,0), (0.7,1)])
+    with pytest.raises(RuntimeError):
+        workflow.utils.cut(line, cut)
+
+def test_segment_intersections():
+    # crossings at a shared vertex are found exactly, from each pair of segments
+    coords = [(0,0), (1,0), (2,0), (3,0)]
+    cutcoords = [(0.5,-1), (0.5,1), (2,0), (2.5,-1)]
+    inds, points = workflow.utils.segment_intersections(coords, cutcoords)
+    assert(list(inds) == [0, 1, 1, 2, 2])
+    assert(np.all(points == [(0.5,0), (2,0), (2,0), (2,0), (2,0)]))
+
+    # a 10k vertex ring is cut in one pass
+    theta = np.linspace(0, 2*np.pi, 10001)
+    ring = shapely.geometry.LineString(np.stack([np.cos(theta), np.sin(theta)], axis=1))
+    lines = workflow.utils.cut(ring, shapely.geometry.LineString([(-2,0.01), (2,0.03)]))
+    assert(len(lines) == 3)
+    assert(np.isclose(sum(l.length for l in lines), ring.length))
+
 
 def test_raises():
     line = shapely.geometry.LineString([(0,0), (1,0)])
@@ -388,3 +409,58 @@ def test_generate_multipolygons():
         
     
 
+
+
+def test_shplys():
+    features = [{'geometry' : {'type' : 'Point', 'coordinates' : (0.123456, 1.)},
+                 'properties' : {'ID' : 0}},
+                {'geometry' : {'type' : 'LineString', 'coordinates' : [(0.123456, 0.), (1.,1.)]},
+                 'properties' : {'ID' : 1}},
+                {'geometry' : {'type' : 'MultiPolygon',
+                               'coordinates' : [[[(0,0), (1.123456,0), (1,1), (0,0)],
+                                                 [(0.1,0.05), (0.9,0.05), (0.8,0.1), (0.1,0.05)]]]},
+                 'properties' : {'ID' : 2}},
+                {'geometry' : {'type' : 'MultiLineString',
+                               'coordinates' : [[(0,0), (1,0)], [(1,0), (2,0)]]}}]
+    shps = workflow.utils.shplys(features, 3)
+    assert(type(shps[0]) is shapely.geometry.Point)
+    assert(shps[0].coords[0] == (0.123, 1.))
+    assert(shps[1].coords[0] == (0.123, 0.))
+    # length-1 multi-shapes are collapsed, as in shply()
+    assert(type(shps[2]) is shapely.geometry.Polygon)
+    assert(len(shps[2].interiors) == 1)
+    assert(shps[2].exterior.coords[1] == (1.123, 0.))
+    assert(type(shps[3]) is shapely.geometry.MultiLineString)
+    assert([s.properties for s in shps] == [{'ID' : 0}, {'ID' : 1}, {'ID' : 2}, None])
+
+    # the same as round + shply, without modifying the features
+    assert(features[1]['geometry']['coordinates'][0] == (0.123456, 0.))
+    workflow.utils.round(features, 3)
+    for f, shp in zip(features, shps):
+        assert(workflow.utils.shply(f).equals_exact(shp, 0.))
+
+
+def test_close_points():
+    points = [(0.,0.), (1.,0.), (5.,5.)]
+    others = [(1.,1.e-8), (0.,0.), (1.e-8,0.)]
+    assert(workflow.utils.close_points(points, others) == [[1,2], [0,], []])
+    assert(list(workflow.utils.any_close(points, others)) == [True, True, False])
+    assert(list(workflow.utils.close_pairwise(points, others)) == [False, False, False])
+    assert(list(workflow.utils.close_pairwise(points, others[1:]+others[:1])) == [True, False, False])
+
+    # the KD-tree path agrees with brute force
+    many = np.random.RandomState(0).uniform(size=(200,2))
+    assert(list(workflow.utils.any_close(many, many[::2], 1.e-3)) == [i % 2 == 0 for i in range(200)])
+
+
+def test_close_rings():
+    theta = np.linspace(0, 2*np.pi, 1000, endpoint=False)
+    ring = np.stack([np.cos(theta), np.sin(theta)], axis=1)
+    p1 = shapely.geometry.Polygon(ring)
+    p2 = shapely.geometry.Polygon(np.roll(ring, 317, 0))
+    p3 = shapely.geometry.Polygon(np.flipud(np.roll(ring, 11, 0)))
+    assert(workflow.utils.close(p1, p2))
+    assert(workflow.utils.close(p1, p3))
+
+    ring[500] += 1.e-3
+    assert(not workflow.utils.close(p1, shapely.geometry.Polygon(ring)))
@@ -0,0 +1,65 @@
+import pytest
+import copy
+import numpy as np
+import shapely.geometry
+
+import workflow.conf
+import workflow.warp
+
+
+@pytest.fixture
+def features():
+    return [{'geometry' : {'type' : 'Point', 'coordinates' : (-85., 35.)}},
+            {'geometry' : {'type' : 'LineString', 'coordinates' : [(-85., 35.), (-84.5, 35.2), (-84., 35.)]}},
+            {'geometry' : {'type' : 'Polygon', 'coordinates' : [[(-85,35), (-84,35), (-84,36), (-85,35)],
+                                                               [(-84.8,35.1), (-84.5,35.1), (-84.5,35.5), (-84.8,35.1)]]}},
+            {'geometry' : {'type' : 'MultiPolygon', 'coordinates' : [[[(-85,35), (-84,35), (-84,36), (-85,35)]],
+                                                                    [[(-83,35), (-82,35), (-82,36), (-83,35)]]]}}]
+
+
+def test_transformer_cache():
+    latlon = workflow.conf.latlon_crs()
+    crs = workflow.conf.default_crs()
+    t1 = workflow.warp.get_transformer(latlon, crs)
+    assert(t1 is workflow.warp.get_transformer(latlon, crs))
+    assert(t1 is not workflow.warp.get_transformer(crs, latlon))
+    assert(workflow.warp.get_transformer(crs, crs) is None)
+
+    # x,y is lon,lat, and round-trips
+    x,y = workflow.warp.warp_xy(np.array([-85.,]), np.array([35.,]), latlon, crs)
+    assert(900000 < x[0] < 1100000)
+    assert(1300000 < y[0] < 1500000)
+    x2,y2 = workflow.warp.warp_xy(x, y, crs, latlon)
+    assert(np.allclose([x2[0],y2[0]], [-85.,35.]))
+
+
+def test_warp_shapes(features):
+    latlon = workflow.conf.latlon_crs()
+    crs = workflow.conf.default_crs()
+
+    # bulk is the same as one at a time
+    bulk = copy.deepcopy(features)
+    workflow.warp.warp_shapes(bulk, latlon, crs)
+    for f, fb in zip(features, bulk):
+        workflow.warp.warp_shape(f, latlon, crs)
+        assert(f == fb)
+    assert(len(bulk[3]['geometry']['coordinates'][1][0]) == 4)
+
+
+def test_warp_shapelys(features):
+    latlon = workflow.conf.latlon_crs()
+    crs = workflow.conf.default_crs()
+    shps = [shapely.geometry.shape(f['geometry']) for f in features]
+    shps[1].properties = {'ID' : 1}
+
+    warped = workflow.warp.warp_shapelys(shps, latlon, crs)
+    assert([type(s) for s in warped] == [type(s) for s in shps])
+    assert(warped[1].properties == {'ID' : 1})
+    assert(len(warped[2].interiors) == 1)
+
+    workflow.warp.warp_shapes(features, latlon, crs)
+    for f, s in zip(features, warped):
+        assert(shapely.geometry.shape(f['geometry']).equals_exact(s, 1.e-6))
+
+    # no-op warps return the same objects
+    assert(workflow.warp.warp_shapely(shps[0], crs, crs) is shps[0])
@@ -3,6 +3,7 @@ import logging
 import collections
 import numpy as np
 import itertools
+import scipy.spatial
 
 import shapely.geometry
 import shapely.ops
@@ -32,6 +33,32 @@ class Tree(workflow.tinytree.Tree):
             super(Tree,self).addChild(type(self)(segment))
         return self.children[-1]
 
+    def preOrder(self):
+        """Generator for all subnodes in pre-order.
+
+        Iterative, unlike tinytree's, so deep river networks do not hit
+        the recursion limit.  As in tinytree, each node's children are
+        copied before they are traversed, making this robust under
+        modification.
+        """
+        stack = [self,]
+        while len(stack) > 0:
+            node = stack.pop()
+            yield node
+            stack.extend(reversed(node.children[:]))
+
+    def postOrder(self):
+        """Generator for all subnodes in post-order, iteratively."""
+        stack = [(self, iter(self.children[:])),]
+        while len(stack) > 0:
+            node, children = stack[-1]
+            child = next(children, None)
+            if child is None:
+                stack.pop()
+                yield node
+            else:
+                stack.append((child, iter(child.children[:])))
+
     def dfs(self):
         for node in self.preOrder():
             if node.segment is not None:
@@ -72,20 +99,38 @@ class Tree(workflow.tinytree.Tree):
         return inconsistent
     
             
-def _get_matches(seg, segments, segment_found):
-    """Find segments attached to seg amongst those not already found"""
-    matches = [i for i in range(len(segments)) if not segment_found[i]
-               and workflow.utils.close(segments[i].coords[-1], seg.coords[0])]
+def _coords_array(segments, end):
+    """Array of the first (end=0) or last (end=-1) coordinate of each segment."""
+    return np.array([seg.coords[end] for seg in segments], 'd')
+
+def _get_matches(seg, kdtree, segment_found, tol=_tol):
+    """Find segments attached to seg amongst those not already found.
+
+    kdtree is built on the last coordinate of each segment.
+    """
+    matches = sorted(i for i in kdtree.query_ball_point(seg.coords[0], tol) if not segment_found[i])
     segment_found[matches] = True
     return matches
 
-def _go(i_seg, tree, segments, segments_found):
-    """Recursive helper function for generating a tree based on a matching function."""
+def _go(i_seg, tree, segments, segments_found, kdtree=None):
+    """Generates a tree, rooted at segment i_seg, of all segments upstream of it.
+
+    The new node is added as a child of tree, and the number of segments
+    added is returned.  Traversal is iterative, in pre-order, so deep
+    networks do not hit the recursion limit.
+    """
+    if kdtree is None:
+        kdtree = scipy.spatial.cKDTree(_coords_array(segments, -1))
+
     count = 0
-    tree.addChild(segments[i_seg])
-    for m in _get_matches(segments[i_seg], segments, segments_found):
-        count += _go(m, tree, segments, segments_found)
-    return count + 1
+    stack = [(i_seg, tree),]
+    while len(stack) > 0:
+        i, parent = stack.pop()
+        node = parent.addChild(segments[i])
+        count += 1
+        for m in reversed(_get_matches(segments[i], kdtree, segments_found)):
+            stack.append((m, node))
+    return count
 
 def make_trees(segments):
     """Forms tree(s) from a list of segments."""
@@ -96,23 +141,24 @@ def make_trees(segments):
         logging.debug("    at: %r"%list(segments[endp].coords[-1]))
 
     # check if any endpoint lives on another segment
+    index = workflow.utils.SpatialIndex(segments)
     segs_to_remove = []
     segs_to_add = []
     for endpoint_index in endpoint_indices:
         endpoint_seg = shapely.geometry.LineString(segments[endpoint_index].coords[-2:])
         try:
-            inter = next(i for i,seg in enumerate(segments)
-                         if endpoint_seg.intersects(seg)
-                         and i is not endpoint_index
-                         and workflow.utils.close(endpoint_seg.intersection(seg).coords[0], endpoint_seg.coords[-1], 1.e-5))
+            inter = next(i for i in index.query(endpoint_seg)
+                         if i != endpoint_index
+                         and endpoint_seg.intersects(segments[i])
+                         and workflow.utils.close(endpoint_seg.intersection(segments[i]).coords[0], endpoint_seg.coords[-1], 1.e-5))
         except StopIteration:
             logging.debug("   outlet %i is not faux"%endpoint_index)
         else:
             logging.debug("   faux outlet: %i segment: %i"%(endpoint_index, inter))
             segs_to_remove.append(inter)
             
-            print("splitting segment: %r"%list(segments[inter].coords))
-            print("   at: %r"%list(segments[endpoint_index].coords[-1]))
+            logging.debug("splitting segment: %r"%list(segments[inter].coords))
+            logging.debug("   at: %r"%list(segments[endpoint_index].coords[-1]))
             segs_to_add.extend(workflow.utils.cut(segments[inter], endpoint_seg))
             
     if len(segs_to_remove) is not 0:
@@ -128,29 +174,27 @@ def make_trees(segments):
 
     # generate all trees
     segment_found = np.zeros((len(segments),), bool)
+    kdtree = scipy.spatial.cKDTree(_coords_array(segments, -1))
     gcount = 0
     trees = []
     for endpoint_index in endpoint_indices:
         tree = Tree()
-        gcount += _go(endpoint_index, tree, segments, segment_found)
+        gcount += _go(endpoint_index, tree, segments, segment_found, kdtree)
         trees.append(tree)
     assert(gcount == len(segments))
     return trees
 
-def find_endpoints(segments):
+def find_endpoints(segments, tol=_tol):
     """Finds a list of indices of all segments whose endpoint is not a beginpoint.
 
     Note these may truely be the tree root, or they may end at a
     midpoint on another segment (mistake in input data).
     """
-    endpoints = []
-    for i,s in enumerate(segments):
-        c = s.coords[-1]
-        try:
-            next(s2 for s2 in segments if workflow.utils.close(s2.coords[0], c))
-        except StopIteration:
-            endpoints.append(i)
-    return endpoints
+    if len(segments) == 0:
+        return []
+    kdtree = scipy.spatial.cKDTree(_coords_array(segments, 0))
+    dist, _ = kdtree.query(_coords_array(segments, -1), distance_upper_bound=tol)
+    return [int(i) for i in np.nonzero(np.isinf(dist))[0]]
 
 def tree_to_list(tree):
     return shapely.geometry.MultiLineString(list(tree.dfs()))
@@ -160,8 +204,14 @@ def forest_to_list(forest):
     return shapely.geometry.MultiLineString([r for tree in forest for r in tree.dfs()])
 
 def is_consistent(tree, tol=1.e-8):
-    """Checks the geometric consistency of the tree."""
-    return not any(not node.check_child_consistency(tol) for node in tree.preOrder())
+    """Checks the geometric consistency of the tree.
+
+    Equivalent to calling check_child_consistency() on every node, but
+    compares all child/parent coordinates in one operation.
+    """
+    ends = [child.segment.coords[-1] for node in tree.preOrder() for child in node.children]
+    starts = [node.segment.coords[0] for node in tree.preOrder() for child in node.children]
+    return bool(workflow.utils.close_pairwise(ends, starts).all())
 
 def get_inconsistent(tree, tol=1.e-8):
     """Gets a list of inconsistent nodes of the tree."""
@@ -11,6 +11,7 @@ import meshpy.triangle
 
 import workflow.tree
 import workflow.split_hucs
+import workflow.profiling
 
 
 class Nodes:
@@ -106,7 +107,70 @@ class NodesEdges:
         assert(min_edge_node == 0)
         assert(max_edge_node == len(self.nodes)-1)
 
-        
+
+
+class NodesEdgesArray:
+    """A collection of nodes and edges, stored as contiguous arrays.
+
+    This is an array-based equivalent of NodesEdges.  All segment
+    coordinates are concatenated and rounded at once, duplicates are
+    collapsed with np.unique, and edges are stored as an int32 array of
+    shape (n_edges, 2), oriented so that edges[:,0] < edges[:,1].
+    Nodes are numbered in the order they are first encountered, just
+    as in Nodes.
+    """
+    def __init__(self, objlist, decimals=3):
+        self.decimals = decimals
+
+        coords = []
+        for obj in objlist:
+            if type(obj) is shapely.geometry.LineString:
+                coords.append(np.asarray(obj.coords, dtype=np.float64)[:,0:2])
+            elif type(obj) is shapely.geometry.Polygon:
+                # the closing coordinate collapses onto the first,
+                # closing the loop
+                coords.append(np.asarray(obj.exterior.coords, dtype=np.float64)[:,0:2])
+            else:
+                raise TypeError("Invalid type for add, %r"%type(obj))
+
+        if len(coords) == 0:
+            self.nodes = np.zeros((0,2), dtype=np.float64)
+            self.edges = np.zeros((0,2), dtype=np.int32)
+            return
+
+        # consecutive coordinates within each object form an edge
+        lengths = np.array([len(c) for c in coords])
+        is_start = np.ones((lengths.sum(),), bool)
+        is_start[np.cumsum(lengths)-1] = False
+        starts = np.nonzero(is_start)[0]
+
+        # dedup the nodes, numbering them by first appearance
+        keys = np.concatenate(coords).round(self.decimals)
+        keys, first, inverse = np.unique(keys, axis=0, return_index=True, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        order = np.argsort(first)
+        renumber = np.empty_like(order)
+        renumber[order] = np.arange(len(order))
+
+        self.nodes = np.ascontiguousarray(keys[order])
+        inds = renumber[inverse]
+
+        # orient, remove degenerate, and dedup the edges
+        edges = np.sort(np.stack([inds[starts], inds[starts+1]], axis=1), axis=1)
+        edges = edges[edges[:,0] != edges[:,1]]
+        self.edges = np.ascontiguousarray(np.unique(edges, axis=0), dtype=np.int32)
+
+    def check(self, tol=0.1):
+        """Checks consistency of the internal representation."""
+        logging.info(" checking graph consistency")
+        kdtree = scipy.spatial.cKDTree(self.nodes)
+        bad_pairs = kdtree.query_pairs(tol)
+        assert(len(bad_pairs) == 0)
+
+        assert(self.edges.min() == 0)
+        assert(self.edges.max() == len(self.nodes)-1)
+
+
 def triangulate(hucs, rivers, **kwargs):
     """Triangulates HUCs and rivers.
 
@@ -129,19 +193,15 @@ def triangulate(hucs, rivers, **kwargs):
     if rivers is not None:
         segments = segments + list(workflow.tree.forest_to_list(rivers))
 
-    nodes_edges = NodesEdges(segments)
+    nodes_edges = NodesEdgesArray(segments)
 
     logging.info("   %i points and %i facets"%(len(nodes_edges.nodes), len(nodes_edges.edges)))
     nodes_edges.check(tol=1)
     
     logging.info(" building graph data structures")
     info = meshpy.triangle.MeshInfo()
-    nodes = np.array(list(nodes_edges.nodes), dtype=np.float64)
-    
-    pdata = [tuple([float(c) for c in p]) for p in nodes]
-    info.set_points(pdata)
-    fdata = [[int(i) for i in f] for f in nodes_edges.edges]
-    info.set_facets(fdata)
+    info.set_points(nodes_edges.nodes)
+    info.set_facets(nodes_edges.edges)
 
     logging.info(" triangle.build...")
 
@@ -150,35 +210,45 @@ def triangulate(hucs, rivers, **kwargs):
     if 'enforce_delaunay' in kwargs.keys() and not kwargs['enforce_delaunay']:
         kwargs.pop('enforce_delaunay')
 
-    try:
-        mesh = meshpy.triangle.build(info, **kwargs)
-    except TypeError as err:
+    with workflow.profiling.stage('meshpy.triangle.build', points=len(nodes_edges.nodes),
+                                  facets=len(nodes_edges.edges)):
         try:
-            # our modification to meshpy.triangle is not present, try without it
-            kwargs.pop('enforce_delaunay')
-        except KeyError:
-            raise err
-        else:
-            logging.warning("Triangulate: '--enforce-delaunay' option requires a hacked `meshpy.triangle`.  Proceeding without this option because it is not recognized.  See documentation at https://github.com/amanzi/meshing_workflow")
             mesh = meshpy.triangle.build(info, **kwargs)
+        except TypeError as err:
+            try:
+                # our modification to meshpy.triangle is not present, try without it
+                kwargs.pop('enforce_delaunay')
+            except KeyError:
+                raise err
+            else:
+                logging.warning("Triangulate: '--enforce-delaunay' option requires a hacked `meshpy.triangle`.  Proceeding without this option because it is not recognized.  See documentation at https://github.com/amanzi/meshing_workflow")
+                mesh = meshpy.triangle.build(info, **kwargs)
             
-    mesh_points = np.array(mesh.points)
-    mesh_tris = np.array(mesh.elements)
+        mesh_points = np.array(mesh.points)
+        mesh_tris = np.array(mesh.elements)
+        workflow.profiling.record(mesh_points=len(mesh_points), triangles=len(mesh_tris))
     logging.info("  ...built: %i mesh points and %i triangles"%(len(mesh_points),len(mesh_tris)))
     return mesh_points, mesh_tris
 
 
 def refine_from_max_area(max_area):
-    """Returns a refinement function based on max area, for use with Triangle."""
+    """Returns a refinement function based on max area, for use with Triangle.
+
+    The function's vectorized attribute evaluates it on arrays of
+    (n_tris, 3, 2) vertices and (n_tris,) areas.
+    """
     def refine(vertices, area):
         """A function for use with workflow.triangulate.triangulate's refinement_func argument based on a global max area."""
         res = bool(area > max_area)
         # if area < 1.e-5:
         #     raise RuntimeError("TinyTriangle Error")
         return res
+    def refine_all(vertices, areas):
+        return np.asarray(areas) > max_area
+    refine.vectorized = refine_all
     return refine
 
-def refine_from_river_distance(near_distance, near_area, away_distance, away_area, rivers):
+def refine_from_river_distance(near_distance, near_area, away_distance, away_area, rivers, tol=None):
     """Returns a graded refinement function based upon a distance function from rivers, for use with Triangle.
 
     Triangle area must be smaller than near_area when the triangle
@@ -189,6 +259,16 @@ def refine_from_river_distance(near_distance, near_area, away_distance, away_are
     near_area and away_area when between
     near_distance and away_distance from the river
     network.
+
+    If tol is provided, distances are approximated through a KD-tree
+    over the river network, densified so that the approximate distance
+    is never more than tol larger than the exact distance.  This makes
+    each call O(log n) rather than a distance calculation against the
+    full river network.  See river_distance().
+
+    The function's vectorized attribute also accepts the distances of
+    the triangle centroids from the river network, if they have
+    already been computed.
     """
     def max_area_valid(distance):
         """A function to make sure max area scales with distance from river network
@@ -203,24 +283,156 @@ def refine_from_river_distance(near_distance, near_area, away_distance, away_are
             area = near_area + (distance - near_distance) / (away_distance - near_distance) * (away_area - near_area)
         return area
 
-    river_multiline = workflow.tree.forest_to_list(rivers)
+    distance_func = river_distance(rivers, tol)
     def refine(vertices, area):
         """A function for use with workflow.triangulate.triangulate's refinement_func argument based on size gradation from a river."""
         bary = np.sum(np.array(vertices), axis=0)/3
-        bary_p = shapely.geometry.Point(bary[0], bary[1])
-        distance = bary_p.distance(river_multiline)
+        distance = distance_func(bary)
         max_area = max_area_valid(distance)
         res = bool(area > max_area_valid(distance))
         #logging.debug("refine? area = %g, distance = %g, max_area = %g: refine = %r"%(area,distance,max_area,res))
         return res
+    def refine_all(vertices, areas, distances=None):
+        if distances is None:
+            distances = distance_func(np.asarray(vertices).sum(axis=1)/3)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            max_areas = np.where(distances > away_distance, away_area,
+                                 np.where(distances < near_distance, near_area,
+                                          near_area + (distances - near_distance) / (away_distance - near_distance) * (away_area - near_area)))
+        return np.asarray(areas) > max_areas
+    refine.vectorized = refine_all
 
     return refine
 
+def river_distance(rivers, tol=None):
+    """Returns a function that computes the distance from points to a river network.
+
+    The returned function accepts either a single point, returning a
+    float, or an array of shape (n_points, 2), returning an array of
+    distances.
+
+    If tol is None, distances are exact, computed with shapely against
+    the full river network.  Otherwise, the river network is densified
+    so that no two consecutive vertices are more than 2*tol apart, and
+    distances are to the nearest densified vertex, found through a
+    KD-tree.  These distances are never smaller than the exact
+    distance, and never larger by more than tol.
+    """
+    if tol is None:
+        river_multiline = workflow.tree.forest_to_list(rivers)
+        def distance(xy):
+            xy = np.asarray(xy, dtype=np.float64)
+            if xy.ndim == 1:
+                return shapely.geometry.Point(xy[0], xy[1]).distance(river_multiline)
+            return np.array([shapely.geometry.Point(p[0], p[1]).distance(river_multiline) for p in xy])
+        return distance
+
+    if tol <= 0:
+        raise ValueError("river_distance: tol must be positive, got {}".format(tol))
+    coords = [np.asarray(r.coords, dtype=np.float64)[:,0:2] for tree in rivers for r in tree.dfs()]
+    kdtree = scipy.spatial.cKDTree(densify_coords(coords, 2*tol))
+    def distance(xy):
+        return kdtree.query(np.asarray(xy, dtype=np.float64))[0]
+    return distance
+
+def densify_coords(coords, spacing):
+    """Densifies a list of polylines, returning all of their vertices.
+
+    Each segment of each polyline, given as an array of shape
+    (n_coords, 2), is subdivided uniformly so that no sub-segment is
+    longer than spacing.  Returns an array of shape (n_points, 2)
+    including all original and added vertices.
+    """
+    coords = [c for c in coords if len(c) > 0]
+    if len(coords) == 0:
+        return np.zeros((0,2), 'd')
+
+    starts = np.concatenate([c[:-1] for c in coords])
+    ends = np.concatenate([c[1:] for c in coords])
+    lasts = np.array([c[-1] for c in coords])
+
+    # number of sub-segments of each segment
+    lengths = np.linalg.norm(ends - starts, axis=1)
+    nsub = np.maximum(np.ceil(lengths / spacing), 1).astype(int)
+
+    # parametric coordinate of each new point along its segment
+    seg = np.repeat(np.arange(len(starts)), nsub)
+    k = np.arange(nsub.sum()) - np.repeat(np.cumsum(nsub) - nsub, nsub)
+    t = k / nsub[seg]
+    points = starts[seg] + np.expand_dims(t, 1) * (ends[seg] - starts[seg])
+    return np.concatenate([points, lasts])
+
 def refine_from_max_edge_length(edge_length):
     """Returns a refinement function based on max edge length, for use with Triangle."""
     def refine(vertices, area):
         verts4 = np.array([vertices[0], vertices[1], vertices[2], vertices[0]])
         edge_lengths = la.norm(verts4[1:] - verts4[:-1], 2, 1)
         return bool(edge_lengths.max() > edge_length)
+    def refine_all(vertices, areas):
+        vertices = np.asarray(vertices)
+        edge_lengths = la.norm(np.roll(vertices, -1, axis=1) - vertices, 2, 2)
+        return edge_lengths.max(axis=1) > edge_length
+    refine.vectorized = refine_all
     return refine
 
+
+def triangle_quality(points, tris):
+    """Computes, as arrays, quality measures of all triangles of a mesh.
+
+    Returns a dictionary with the following entries, each an array
+    with one entry (or row) per triangle:
+
+    vertices            | (n_tris, 3, 2) coordinates of the vertices
+    areas               | signed areas, positive for counter-clockwise
+                        |  triangles
+    centroids           | (n_tris, 2) centroids
+    edge_lengths        | (n_tris, 3) lengths of edge i, from vertex
+                        |  i to vertex i+1
+    min_angles          | minimum interior angle, in degrees
+    max_angles          | maximum interior angle, in degrees
+    """
+    vertices = np.asarray(points, dtype=np.float64)[np.asarray(tris, dtype=int)][:,:,0:2]
+    edges = np.roll(vertices, -1, axis=1) - vertices
+    edge_lengths = la.norm(edges, 2, 2)
+
+    # interior angle at vertex i is between edge i and the reverse of edge i-1
+    prev_edges = -np.roll(edges, 1, axis=1)
+    cross = edges[:,:,0]*prev_edges[:,:,1] - edges[:,:,1]*prev_edges[:,:,0]
+    dot = (edges*prev_edges).sum(axis=2)
+    angles = np.degrees(np.arctan2(np.abs(cross), dot))
+
+    areas = 0.5 * (edges[:,0,0]*(-edges[:,2,1]) - edges[:,0,1]*(-edges[:,2,0]))
+    return {'vertices' : vertices,
+            'areas' : areas,
+            'centroids' : vertices.sum(axis=1)/3,
+            'edge_lengths' : edge_lengths,
+            'min_angles' : angles.min(axis=1),
+            'max_angles' : angles.max(axis=1)}
+
+def log_triangle_quality(quality, distances=None, needs_refine=None, level=logging.INFO):
+    """Logs summary statistics and histograms from triangle_quality()."""
+    def log_hist(name, values, bins):
+        counts, edges = np.histogram(values, bins)
+        logging.log(level, "  {} histogram:".format(name))
+        for count, lower, upper in zip(counts, edges[:-1], edges[1:]):
+            logging.log(level, "    [{:10.4g}, {:10.4g}): {:d}".format(lower, upper, count))
+
+    def log_stats(name, values):
+        logging.log(level, "  {:<20s} min = {:10.4g}, mean = {:10.4g}, max = {:10.4g}".format(
+            name, values.min(), values.mean(), values.max()))
+
+    areas = quality['areas']
+    if len(areas) == 0:
+        return
+    logging.log(level, "  {} triangles".format(len(areas)))
+    log_stats("area [m^2]:", areas)
+    log_stats("edge length [m]:", quality['edge_lengths'])
+    log_stats("min angle [deg]:", quality['min_angles'])
+    log_hist("min angle [deg]", quality['min_angles'], [0,5,10,15,20,25,30,40,50,60])
+    log_hist("area [m^2]", areas, 10)
+    if distances is not None:
+        log_stats("river distance [m]:", distances)
+        log_hist("river distance [m]", distances, 10)
+    if needs_refine is not None:
+        logging.log(level, "  {} triangles still meet a refinement criteria".format(int(np.count_nonzero(needs_refine))))
+
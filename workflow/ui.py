@@ -5,6 +5,7 @@ import argparse
 import fiona
 
 import workflow.conf
+import workflow.profiling
 import workflow.sources.utils
 import workflow.source_list
 
@@ -52,6 +53,15 @@ def setup_logging(verbosity, logfile=None):
         logging.basicConfig(level=level,
                             format='%(asctime)s - %(name)s - %(levelname)s: %(message)s')
 
+class _EnableProfiling(argparse.Action):
+    """Argparse action which turns on workflow.profiling when the flag is given."""
+    def __init__(self, option_strings, dest, **kwargs):
+        super().__init__(option_strings, dest, nargs=0, default=False, **kwargs)
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        setattr(namespace, self.dest, True)
+        workflow.profiling.enable()
+
 def get_basic_argparse(docstring):
     """Gets a basic argparse class with basic options for all scripts."""
     doclines = docstring.split('\n')
@@ -156,6 +166,7 @@ def default_triangulate_options():
 
     args = Struct(refine_max_area=None,
                   refine_distance=None,
+                  refine_distance_tol=None,
                   refine_min_angle=None,
                   refine_max_edge_length=None,
                   enforce_delaunay=False,
@@ -192,6 +203,8 @@ def refine_distance_options(parser):
                                         ' when its distance is less than CLOSE_DISTANCE, or',
                                         ' FAR_AREA if its distance is greater than FAR_DISTANCE,',
                                         ' or a linear interpolant between those two otherwise.']))
+    parser.add_argument('--refine-distance-tol', type=float,
+                        help='Approximate distances for --refine-distance to within this tolerance [m], which is much faster on large river networks.')
 def refine_min_angle(parser):
     parser.add_argument('--refine-min-angle', type=float,
                         help='Refine to set a minimum angle constraint in [degrees]')
@@ -214,9 +227,19 @@ def inshape_args(parser):
 def outmesh_args(parser):
     """Sets output filename and format options."""
     parser.add_argument('output_file', type=str,
-                        help='VTK Filename for mesh output.')
+                        help='VTK Filename for mesh output, VTK XML if it ends in .vtu.')
     parser.add_argument('-p', '--plot', action='store_true',
                         help='Save mesh image to file.')
+    parser.add_argument('--profile', action=_EnableProfiling,
+                        help='Record time and memory used by each stage, writing a JSON report next to the output mesh.')
+
+def batch_options(parser):
+    """Adds options for meshing many HUCs as independent domains."""
+    group = parser.add_argument_group('Batch Mode')
+    group.add_argument('--batch-level', type=int,
+                       help='Mesh each HUC at this level contained in HUC as an independent domain, i.e. 12 for all HUC12s in a HUC4.  Output files are named by HUC code, and a summary report is written.')
+    group.add_argument('--processes', type=int,
+                       help='Number of worker processes in batch mode.  (default = number of cores)')
 
 def huc_hint_options(parser):
     """Adds a HUC hint option for searching for shapes in HUCs"""
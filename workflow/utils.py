@@ -1,10 +1,13 @@
 """Shape utilities not provided by shapely."""
+import copy
 import logging
 import subprocess
 import numpy as np
+import scipy.spatial
 import shapely.geometry
 import shapely.ops
 import shapely.affinity
+import shapely.strtree
 
 import workflow.conf
 
@@ -87,17 +90,145 @@ def shply(shape, properties=None, flip=False):
         raise ValueError('Converting to shapely got error: "%s"  Maybe you forgot to do shp["geometry"]?')
 
 
+# nesting depth of the coordinates of each fiona geometry type
+_depths = {'Point' : 0,
+           'MultiPoint' : 1,
+           'LineString' : 1,
+           'MultiLineString' : 2,
+           'Polygon' : 2,
+           'MultiPolygon' : 3}
+
+def _geometry(shape):
+    if 'geometry' in shape:
+        return shape['geometry']
+    return shape
+
+def _rings(coordinates, depth):
+    """List of the rings (lists of coordinates) of fiona coordinates."""
+    if depth == 0:
+        return [[coordinates,],]
+    elif depth == 1:
+        return [coordinates,]
+    elif depth == 2:
+        return list(coordinates)
+    else:
+        return [ring for part in coordinates for ring in part]
+
+def _is_bulk_convertible(geometries):
+    """Can all geometries go through _coordinate_arrays()?  Not empties or collections."""
+    return all(g['type'] in _depths and len(g['coordinates']) > 0 for g in geometries)
+
+def _coordinate_arrays(geometries, digits=None, flip=False):
+    """All coordinates of a list of fiona geometries, as arrays.
+
+    Coordinates of all geometries are gathered into one array, which
+    is rounded (and/or flipped) in one operation.
+
+    Returns an iterator over the (NCOORDS, NDIMS) arrays of each ring,
+    in order.  These are views into the one array.
+    """
+    rings = [_rings(g['coordinates'], _depths[g['type']]) for g in geometries]
+    flat = [c for g_rings in rings for ring in g_rings for c in ring]
+    coords = np.array(flat, 'd')
+    if flip and len(coords) > 0:
+        coords[:,[0,1]] = coords[:,[1,0]]
+    if digits is not None:
+        coords.round(digits, out=coords)
+
+    sizes = [len(ring) for g_rings in rings for ring in g_rings]
+    return iter(np.split(coords, np.cumsum(sizes)[:-1]))
+
+def _fiona_coordinates(coordinates, depth, arrays):
+    """Rebuilds fiona coordinates like coordinates, from an iterator over ring arrays."""
+    if depth == 0:
+        return tuple(next(arrays)[0].tolist())
+    elif depth == 1:
+        return [tuple(c) for c in next(arrays).tolist()]
+    else:
+        return [_fiona_coordinates(part, depth-1, arrays) for part in coordinates]
+
+def _shapely_geometry(geometry, arrays):
+    """Builds a shapely shape from an iterator over ring arrays, collapsing length-1 multi-shapes."""
+    gtype = geometry['type']
+    if gtype == 'Point':
+        return shapely.geometry.Point(next(arrays)[0])
+    elif gtype == 'LineString':
+        return shapely.geometry.LineString(next(arrays))
+    elif gtype == 'Polygon':
+        rings = [next(arrays) for ring in geometry['coordinates']]
+        return shapely.geometry.Polygon(rings[0], rings[1:])
+    elif gtype == 'MultiPoint':
+        points = next(arrays)
+        if len(points) == 1:
+            return shapely.geometry.Point(points[0])
+        return shapely.geometry.MultiPoint(points)
+    elif gtype == 'MultiLineString':
+        lines = [next(arrays) for line in geometry['coordinates']]
+        if len(lines) == 1:
+            return shapely.geometry.LineString(lines[0])
+        return shapely.geometry.MultiLineString(lines)
+    else:
+        polys = []
+        for poly in geometry['coordinates']:
+            rings = [next(arrays) for ring in poly]
+            polys.append((rings[0], rings[1:]))
+        if len(polys) == 1:
+            return shapely.geometry.Polygon(*polys[0])
+        return shapely.geometry.MultiPolygon(polys)
+
+def shplys(shapes, digits=None, flip=False):
+    """Converts a list of fiona style shapes to shapely shapes, in bulk.
+
+    This is equivalent to calling shply() on each shape, after
+    round(shapes, digits), but rounds all coordinates at once and
+    builds the shapely shapes directly from coordinate arrays.  The
+    input shapes are not modified.  Properties of each shape, if any,
+    are kept.
+    """
+    geometries = [_geometry(shp) for shp in shapes]
+    if not _is_bulk_convertible(geometries):
+        if digits is not None:
+            shapes = round(copy.deepcopy(shapes), digits)
+        return [shply(shp, flip=flip) for shp in shapes]
+
+    arrays = _coordinate_arrays(geometries, digits, flip)
+    things = []
+    for shp, geometry in zip(shapes, geometries):
+        thing = _shapely_geometry(geometry, arrays)
+        thing.properties = shp.get('properties', None) if 'geometry' in shp else None
+        things.append(thing)
+    return things
+
+
 def round(list_of_things, digits):
-    """Rounds coordinates in things or shapes to a given digits."""
-    for shp in list_of_things:
-        for ring in generate_rings(shp):
-            ring[:] = list(np.array(ring).round(digits))
+    """Rounds coordinates in things or shapes to a given digits.
+
+    All coordinates are rounded at once, and the coordinates of each
+    shape are replaced, IN PLACE.
+    """
+    geometries = [_geometry(shp) for shp in list_of_things]
+    if not _is_bulk_convertible(geometries):
+        for shp in list_of_things:
+            for ring in generate_rings(shp):
+                ring[:] = list(np.array(ring).round(digits))
+        return list_of_things
+
+    arrays = _coordinate_arrays(geometries, digits)
+    for geometry in geometries:
+        geometry['coordinates'] = _fiona_coordinates(geometry['coordinates'],
+                                                     _depths[geometry['type']], arrays)
     return list_of_things
 
 
 _tol = 1.e-7
 def close(s1, s2, tol=_tol):
     """Are two shapes topologically equivalent and geometrically close"""
+    # fast path for the most common case, two coordinate tuples
+    if type(s1) is tuple and type(s2) is tuple:
+        if len(s1) != len(s2):
+            return False
+        return sum((p1 - p2)**2 for p1,p2 in zip(s1,s2)) < tol**2
+
     # points get compared as tuples
     if isinstance(s1, shapely.geometry.Point):
         return close(s1.coords[0], s2, tol)
@@ -137,11 +268,9 @@ def close(s1, s2, tol=_tol):
         # note, this does not correctly deal with nonequal holes...
         if len(s1.boundary.coords) != len(s2.boundary.coords):
             return False
-        ls1 = s1.boundary.coords[:-1]
+        ls1 = np.array(s1.boundary.coords[:-1])
         ls2 = np.array(s2.boundary.coords[:-1])
-        ls2f = np.flipud(ls2)
-        return any(np.allclose(ls1, np.roll(ls2, i, 0), tol, tol) for i in range(len(ls2))) or \
-            any(np.allclose(ls1, np.roll(ls2f, i, 0), tol, tol) for i in range(len(ls2)))
+        return rings_close(ls1, ls2, tol) or rings_close(ls1, np.flipud(ls2), tol)
 
     # compare multi-shapes by checking if each one has a match in the
     # other and lengths are the same
@@ -166,11 +295,180 @@ def close(s1, s2, tol=_tol):
         raise NotImplementedError("Not implemented for type '%r'"%type(s1))                
 
 
+def rings_close(ring1, ring2, tol=_tol):
+    """Are two rings, given as (N,DIM) arrays without the repeated endpoint, close?
+
+    The rings are close if some rotation of ring2 is np.allclose() to
+    ring1.  Rather than trying every rotation, ring2 is only rotated
+    so that each of its points that is close to the first point of
+    ring1 comes first, which is usually only one point.
+    """
+    if ring1.shape != ring2.shape:
+        return False
+    if len(ring1) == 0:
+        return True
+    starts = np.nonzero(np.all(np.abs(ring1[0] - ring2) <= tol + tol * np.abs(ring2), axis=1))[0]
+    return any(np.allclose(ring1, np.roll(ring2, -i, 0), tol, tol) for i in starts)
+
+
+def close_pairwise(points1, points2, tol=_tol):
+    """Is each point in points1 close to the corresponding point in points2?
+
+    points1, points2 are (N,DIM) arrays, or lists of coordinate
+    tuples.  Returns an (N,) boolean array.
+    """
+    points1 = np.asarray(points1, 'd')
+    points2 = np.asarray(points2, 'd')
+    if len(points1) == 0:
+        return np.zeros((0,), dtype=bool)
+    if points1.shape[1] != points2.shape[1]:
+        return np.zeros((len(points1),), dtype=bool)
+    return ((points1 - points2)**2).sum(axis=1) < tol**2
+
+
+def close_points(points, others, tol=_tol):
+    """For each point, the indices of all points in others that are close to it.
+
+    This is a many-to-many version of close() for coordinates, using
+    a KD-tree on others.  Returns a list of lists of indices.
+    """
+    points = np.asarray(points, 'd')
+    others = np.asarray(others, 'd')
+    if len(points) == 0:
+        return []
+    if len(others) == 0 or points.shape[1] != others.shape[1]:
+        return [[] for p in points]
+
+    kdtree = scipy.spatial.cKDTree(others)
+    candidates = kdtree.query_ball_point(points, tol)
+    return [[int(j) for j in cands if ((others[j] - p)**2).sum() < tol**2]
+            for p, cands in zip(points, candidates)]
+
+
+def any_close(points, others, tol=_tol):
+    """Is each point close to any point in others?
+
+    Equivalent to [any(close(p, o, tol) for o in others) for p in
+    points] on coordinate tuples, but issues one query.  Returns an
+    (N,) boolean array.
+    """
+    points = np.asarray(points, 'd')
+    others = np.asarray(others, 'd')
+    if len(points) == 0:
+        return np.zeros((0,), dtype=bool)
+    if len(others) == 0 or points.shape[1] != others.shape[1]:
+        return np.zeros((len(points),), dtype=bool)
+
+    if len(points) * len(others) < 10000:
+        # small problems are cheaper by brute force
+        dist2 = ((points[:,None,:] - others[None,:,:])**2).sum(axis=2)
+        return (dist2 < tol**2).any(axis=1)
+    kdtree = scipy.spatial.cKDTree(others)
+    dist, _ = kdtree.query(points, distance_upper_bound=tol)
+    return dist < tol
+
+
 def contains(s1, s2, tol=_tol):
     """A contains algorithm that deals with close/roundoff issues"""
     return s1.buffer(tol,2).contains(s2)
 
 
+def segment_intersections(coords, cutcoords, eps=1.e-10, chunk_size=1000000):
+    """Finds all intersections of the segments of two polylines.
+
+    All pairs of segments are intersected in array operations, in
+    chunks of at most chunk_size pairs.  Intersections within eps (in
+    the parametric coordinate along a segment) of a vertex are snapped
+    to that vertex, so that a crossing at a shared vertex is found as
+    exactly the same point from each segment it touches.  Collinear,
+    overlapping segments intersect at both ends of the overlap.
+
+    Parameters
+    ----------
+    coords : np.ndarray
+        (N,2+) array of the coordinates of the first polyline.
+    cutcoords : np.ndarray
+        (M,2+) array of the coordinates of the second polyline.
+
+    Returns
+    -------
+    np.ndarray
+        (K,) sorted indices of the segments of coords, i.e. segment i
+        is coords[i:i+2], that intersect.
+    np.ndarray
+        (K,2) intersection points, sorted within each segment.  A point
+        is repeated once for each segment of cutcoords it lies on.
+    """
+    p = np.asarray(coords, 'd')[:,0:2]
+    q = np.asarray(cutcoords, 'd')[:,0:2]
+    p0, r = p[:-1], p[1:] - p[:-1]
+    q0, s = q[:-1], q[1:] - q[:-1]
+
+    def cross(a, b):
+        return a[...,0]*b[...,1] - a[...,1]*b[...,0]
+
+    inds = []
+    points = []
+    chunk = max(1, chunk_size // max(1, len(q0)))
+    for start in range(0, len(p0), chunk):
+        p0c = p0[start:start+chunk,None,:]
+        rc = r[start:start+chunk,None,:]
+        qp = q0[None,:,:] - p0c
+
+        # bounding boxes must overlap
+        bbox = ((np.minimum(p0c, p0c+rc) - np.maximum(q0, q0+s)[None] <= 0).all(axis=2) &
+                (np.maximum(p0c, p0c+rc) - np.minimum(q0, q0+s)[None] >= 0).all(axis=2))
+        ii, jj = np.nonzero(bbox)
+        if len(ii) == 0:
+            continue
+        pa, ra, qa, sa, qpa = p0c[ii,0], rc[ii,0], q0[jj], s[jj], qp[ii,jj]
+
+        denom = cross(ra, sa)
+        scale = np.sqrt((ra**2).sum(axis=1) * (sa**2).sum(axis=1))
+        parallel = np.abs(denom) <= eps * scale
+
+        # proper intersections, parametric coordinates t along p, u along q;
+        # these are NaN or inf for parallel segments
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = cross(qpa, sa) / denom
+            u = cross(qpa, ra) / denom
+            pts = pa + t[:,None] * ra
+            hit = ~parallel & (t >= -eps) & (t <= 1+eps) & (u >= -eps) & (u <= 1+eps)
+            pts = np.where((np.abs(u) <= eps)[:,None], qa, pts)
+            pts = np.where((np.abs(u-1) <= eps)[:,None], qa+sa, pts)
+            pts = np.where((np.abs(t) <= eps)[:,None], pa, pts)
+            pts = np.where((np.abs(t-1) <= eps)[:,None], pa+ra, pts)
+        inds.append(start + ii[hit])
+        points.append(pts[hit])
+
+        # collinear segments intersect at the ends of their overlap
+        rr = (ra**2).sum(axis=1)
+        collinear = parallel & (rr > 0) & \
+            (np.abs(cross(qpa, ra)) <= eps * np.sqrt(rr * (qpa**2).sum(axis=1)))
+        if collinear.any():
+            ra, pa, qpa, sa = ra[collinear], pa[collinear], qpa[collinear], sa[collinear]
+            rr = rr[collinear]
+            t0 = (qpa * ra).sum(axis=1) / rr
+            t1 = t0 + (sa * ra).sum(axis=1) / rr
+            overlap = (np.maximum(np.minimum(t0, t1), 0.) <=
+                       np.minimum(np.maximum(t0, t1), 1.) + eps)
+            for tt, qend in [(t0, qa[collinear]), (t1, qa[collinear]+sa)]:
+                # each end of the overlap is an end of one of the two segments
+                pts = np.where((tt <= 0.)[:,None], pa, qend)
+                pts = np.where((tt >= 1.)[:,None], pa+ra, pts)
+                pts = np.where((np.abs(tt) <= eps)[:,None], pa, pts)
+                pts = np.where((np.abs(tt-1) <= eps)[:,None], pa+ra, pts)
+                inds.append(start + ii[collinear][overlap])
+                points.append(pts[overlap])
+
+    if len(inds) == 0:
+        return np.zeros((0,), dtype=int), np.zeros((0,2), 'd')
+    inds = np.concatenate(inds)
+    points = np.concatenate(points)
+    order = np.lexsort((points[:,1], points[:,0], inds))
+    return inds[order], points[order]
+
+
 def cut(line, cutline, tol=1.e-5):
     """Cuts a line at all intersections with cutline."""
 
@@ -183,57 +481,57 @@ def cut(line, cutline, tol=1.e-5):
     assert(type(cutline) is shapely.geometry.LineString)
     assert(line.intersects(cutline))
 
-    segs = []
     coords = list(line.coords)
+    inds, points = segment_intersections(coords, cutline.coords)
 
+    # a point found from several segments of cutline counts once
+    distinct = np.ones((len(inds),), dtype=bool)
+    distinct[1:] = (inds[1:] != inds[:-1]) | (points[1:] != points[:-1]).any(axis=1)
+    inds, points = inds[distinct], points[distinct]
+    multiple = np.zeros((len(inds),), dtype=bool)
+    multiple[:-1] = inds[1:] == inds[:-1]
+
+    # walk the line, splitting coordinates at each intersected segment
+    segs = []
     segcoords = [coords[0],]
     i = 0
-    while i < len(coords)-1:
-        seg = shapely.geometry.LineString(coords[i:i + 2])
-        #logging.debug("Intersecting seg %d"%i)
-        point = seg.intersection(cutline)
-        if type(point) is shapely.geometry.GeometryCollection and len(point) is 0:
-            #logging.debug("Cut seg no intersection")
-            segcoords.append(seg.coords[-1])
-            i += 1
-        elif type(point) is shapely.geometry.Point:
-            #logging.debug("Cut intersected at point")
-            #logging.debug("  inter point: %r"%list(point.coords[0]))
-            #logging.debug("  seg final point: %r"%list(seg.coords[-1]))
-            #logging.debug("  close? = %r"%(close(point, seg.coords[-1], tol)))
-            if close(point, seg.coords[-1], tol):
-                # intersects at the far point
-                segs.append(shapely.geometry.LineString(segcoords+[point,]))
-                #logging.debug("  appended full segment: %r"%(list(segs[-1].coords)))
-
-                if (i < len(coords)-2):
-                    #logging.debug("    (not the end)")
-                    segcoords = [point,coords[i+2]]
-                else:
-                    #logging.debug("    (the end)")
-                    segcoords = [point,]
-                i += 2 # also skip the next seg, which would also
-                       # intersect at that seg's start point
-            elif close(point, seg.coords[0], tol):
-                # intersects at the near point
-                if i is not 0:
-                    assert(len(segcoords) > 1)
-                    segs.append(shapely.geometry.LineString(segcoords[:-1]+[point,]))
-                    segcoords = [point,]
-                else:
-                    assert(len(segcoords) is 1)
-                    segcoords[0] = point
-                segcoords.append(seg.coords[-1])
-                i += 1
+    for k, ipoint in enumerate(inds):
+        if ipoint < i:
+            # the segment after a cut at a far point is skipped
+            continue
+        if multiple[k]:
+            raise RuntimeError("Dual/multiple intersection in a single seg... ugh!")
+        segcoords.extend(coords[i+1:ipoint+1])
+        i = ipoint
+        point = tuple(points[k])
+
+        if close(point, coords[i+1], tol):
+            # intersects at the far point
+            segs.append(shapely.geometry.LineString(segcoords+[point,]))
+            if (i < len(coords)-2):
+                segcoords = [point,coords[i+2]]
             else:
-                # intersects in the middle
-                segs.append(shapely.geometry.LineString(segcoords+[point,]))
-                #logging.debug("  appended partial segment: %r"%(list(segs[-1].coords)))
-                segcoords = [point,seg.coords[-1]]
-                i += 1
+                segcoords = [point,]
+            i += 2 # also skip the next seg, which would also
+                   # intersect at that seg's start point
+        elif close(point, coords[i], tol):
+            # intersects at the near point
+            if i != 0:
+                assert(len(segcoords) > 1)
+                segs.append(shapely.geometry.LineString(segcoords[:-1]+[point,]))
+                segcoords = [point,]
+            else:
+                assert(len(segcoords) == 1)
+                segcoords[0] = point
+            segcoords.append(coords[i+1])
+            i += 1
         else:
-            raise RuntimeError("Dual/multiple intersection in a single seg... ugh!")
+            # intersects in the middle
+            segs.append(shapely.geometry.LineString(segcoords+[point,]))
+            segcoords = [point,coords[i+1]]
+            i += 1
 
+    segcoords.extend(coords[i+1:])
     if len(segcoords) > 1:
         segs.append(shapely.geometry.LineString(segcoords))
     return segs
@@ -258,6 +556,47 @@ def in_neighborhood(obj1, obj2, tol=0.1):
     return True
 
 
+class SpatialIndex:
+    """A bounding-box index over a list of shapes.
+
+    Queries return indices into the list of shapes whose bounding
+    boxes intersect the query, which is a superset of the shapes that
+    actually intersect it.  Wraps shapely's STRtree, hiding the
+    differences in its query interface across shapely versions.
+    """
+    def __init__(self, shapes):
+        self.shapes = list(shapes)
+        if len(self.shapes) > 0:
+            self._tree = shapely.strtree.STRtree(self.shapes)
+        else:
+            self._tree = None
+        self._ids = None
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def query(self, shape, tol=0.):
+        """Returns the sorted list of indices of shapes in the neighborhood of shape."""
+        if self._tree is None:
+            return []
+        if tol > 0:
+            minx, miny, maxx, maxy = shape.bounds
+            shape = shapely.geometry.box(minx-tol, miny-tol, maxx+tol, maxy+tol)
+
+        if hasattr(self._tree, 'query_items'):
+            # shapely 1.8
+            return sorted(self._tree.query_items(shape))
+
+        result = self._tree.query(shape)
+        if len(result) > 0 and isinstance(result[0], shapely.geometry.base.BaseGeometry):
+            # shapely < 1.8 returns the geometries themselves
+            if self._ids is None:
+                self._ids = dict((id(s), i) for i,s in enumerate(self.shapes))
+            return sorted(self._ids[id(r)] for r in result)
+        # shapely >= 2.0 returns indices
+        return sorted(int(i) for i in result)
+
+
 def intersect_point_to_segment(point, line_start, line_end):
     """Finds the nearest point on a line segment to a point"""
     line_magnitude = line_end.distance(line_start)
@@ -409,7 +748,9 @@ def non_point_intersection(shp1, shp2):
     """Checks whether an intersection is larger than a point."""
     inter = shp1.intersection(shp2)
     int_type = type(inter)
-    if int_type == shapely.geometry.Point:
+    if inter.is_empty:
+        return False
+    elif int_type == shapely.geometry.Point:
         return False
     elif int_type == shapely.geometry.GeometryCollection and len(inter) is 0:
         return False
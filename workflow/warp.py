@@ -15,14 +15,80 @@ import warnings
 import workflow.conf
 import workflow.utils
 
+_transformers = dict()
+
+def _crs_key(crs):
+    """A hashable key for a crs."""
+    if isinstance(crs, dict):
+        return tuple(sorted((k, str(v)) for k,v in crs.items()))
+    return str(crs)
+
+class _ProjTransformer:
+    """A stand-in for pyproj.Transformer for pyproj < 2, which lacks it.
+
+    Wraps a pair of Proj objects and pyproj.transform, which for these
+    versions of pyproj always work in x,y (i.e. lon,lat) order.
+    """
+    def __init__(self, old_crs_proj, new_crs_proj):
+        self.old_crs_proj = old_crs_proj
+        self.new_crs_proj = new_crs_proj
+
+    def transform(self, x, y):
+        return pyproj.transform(self.old_crs_proj, self.new_crs_proj, x, y)
+
+def _make_transformer(old_crs, new_crs):
+    """Constructs a transformer from old_crs to new_crs, or None if they are the same."""
+    if hasattr(pyproj, 'Transformer'):
+        old_crs_proj = pyproj.CRS.from_user_input(old_crs)
+        new_crs_proj = pyproj.CRS.from_user_input(new_crs)
+        if old_crs_proj == new_crs_proj:
+            return None
+        return pyproj.Transformer.from_crs(old_crs_proj, new_crs_proj, always_xy=True)
+    else:
+        old_crs_proj = pyproj.Proj(old_crs)
+        new_crs_proj = pyproj.Proj(new_crs)
+        if old_crs_proj.srs == new_crs_proj.srs:
+            return None
+        return _ProjTransformer(old_crs_proj, new_crs_proj)
+
+def get_transformer(old_crs, new_crs):
+    """Returns a (cached) transformer from old_crs to new_crs.
+
+    Transformers are expensive to construct, so one is made per pair
+    of coordinate systems and reused.  This is a pyproj Transformer,
+    or for pyproj < 2, an object providing the same transform(x,y)
+    method.  Coordinates are always in x,y (i.e. lon,lat) order.
+    Returns None if the two are the same crs.
+    """
+    key = (_crs_key(old_crs), _crs_key(new_crs))
+    try:
+        return _transformers[key]
+    except KeyError:
+        transformer = _make_transformer(old_crs, new_crs)
+        _transformers[key] = transformer
+        return transformer
+
 def warp_xy(x, y, old_crs, new_crs):
     """Warps a set of points from old_crs to new_crs."""
     if old_crs == new_crs:
         return x,y
 
-    old_crs_proj = pyproj.Proj(old_crs)
-    new_crs_proj = pyproj.Proj(new_crs)
-    return pyproj.transform(old_crs_proj, new_crs_proj, x,y)
+    transformer = get_transformer(old_crs, new_crs)
+    if transformer is None:
+        return x,y
+    return transformer.transform(x,y)
+
+def _warp_arrays(arrays, old_crs, new_crs):
+    """Warps a list of (n_i,2+) coordinate arrays in one transform."""
+    transformer = get_transformer(old_crs, new_crs)
+    if transformer is None or len(arrays) == 0:
+        return arrays
+
+    coords = np.concatenate(arrays, axis=0)
+    x,y = transformer.transform(coords[:,0], coords[:,1])
+    coords[:,0] = x
+    coords[:,1] = y
+    return np.split(coords, np.cumsum([len(a) for a in arrays])[:-1])
 
 def warp_bounds(bounds, old_crs, new_crs):
     """Uses proj to reproject bounds, NOT IN PLACE"""
@@ -33,23 +99,64 @@ def warp_bounds(bounds, old_crs, new_crs):
     # x2,y2 = warp_xy(x,y,old_crs, new_crs)
     # return [x2[0],y2[0],x2[1],y2[1]]
 
+
+def _shapely_arrays(shp):
+    """List of coordinate arrays of a shapely shape, in order."""
+    if shp.is_empty:
+        return []
+    elif type(shp) in [shapely.geometry.Point, shapely.geometry.LineString, shapely.geometry.LinearRing]:
+        return [np.array(shp.coords, 'd'),]
+    elif type(shp) is shapely.geometry.Polygon:
+        return [np.array(shp.exterior.coords, 'd'),] + [np.array(r.coords, 'd') for r in shp.interiors]
+    else:
+        return [a for part in shp.geoms for a in _shapely_arrays(part)]
+
+def _shapely_from_arrays(shp, arrays):
+    """Rebuilds a shape like shp from an iterator over the output of _shapely_arrays()."""
+    if shp.is_empty:
+        return shp
+    elif type(shp) in [shapely.geometry.Point, shapely.geometry.LineString, shapely.geometry.LinearRing]:
+        coords = next(arrays)
+        return type(shp)(coords[0] if type(shp) is shapely.geometry.Point else coords)
+    elif type(shp) is shapely.geometry.Polygon:
+        exterior = next(arrays)
+        return shapely.geometry.Polygon(exterior, [next(arrays) for r in shp.interiors])
+    else:
+        return type(shp)([_shapely_from_arrays(part, arrays) for part in shp.geoms])
+
 def warp_shapely(shp, old_crs, new_crs):
     """Uses proj to reproject shapes, NOT IN PLACE"""
-    old_crs_proj = pyproj.Proj(old_crs)
-    new_crs_proj = pyproj.Proj(new_crs)
-    if old_crs_proj == new_crs_proj:
-        return shp
-    
-    return shapely.ops.transform(lambda x,y:pyproj.transform(old_crs_proj, new_crs_proj, x,y), shp)
+    return warp_shapelys([shp,], old_crs, new_crs)[0]
 
 def warp_shapelys(shps, old_crs, new_crs):
-    return [warp_shapely(shp, old_crs, new_crs) for shp in shps]
+    """Uses proj to reproject a list of shapes, NOT IN PLACE.
 
-def warp_shape(feature, old_crs, new_crs):
-    """Uses proj to reproject shapes, IN PLACE"""
-    # find the dimension -- can't trust the shape
+    The coordinates of all shapes are warped in one vectorized
+    transform.  Properties, if any, are kept.
+    """
+    shps = list(shps)
+    if get_transformer(old_crs, new_crs) is None:
+        return shps
+
+    arrays = [_shapely_arrays(shp) for shp in shps]
+    warped = iter(_warp_arrays([a for shp_arrays in arrays for a in shp_arrays], old_crs, new_crs))
+    new_shps = []
+    for shp in shps:
+        new_shp = _shapely_from_arrays(shp, warped)
+        if hasattr(shp, 'properties'):
+            new_shp.properties = shp.properties
+        new_shps.append(new_shp)
+    return new_shps
+
+
+def _depth(coordinates):
+    """Nesting depth of a fiona coordinate list: 0 for a point, 1 for a
+    line, 2 for a polygon or multi-line, 3 for a multi-polygon.
+
+    Note, can't trust the shape's type.
+    """
     dim = -1
-    ptr = feature['geometry']['coordinates']
+    ptr = coordinates
     done = False
     while not done:
         if hasattr(ptr, '__len__'):        
@@ -58,42 +165,50 @@ def warp_shape(feature, old_crs, new_crs):
             ptr = ptr[0]
         else:
             done = True
+    return dim
 
+def _fiona_arrays(coordinates, dim):
+    """List of coordinate arrays of a fiona geometry of depth dim."""
     if dim == 0:
-        # point
-        x,y = warp_xy(np.array([feature['geometry']['coordinates'][0],]), np.array([feature['geometry']['coordinates'][1],]), old_crs, new_crs)
-        feature['geometry']['coordinates'] = (x[0], y[0])
+        return [np.array([coordinates,], 'd'),]
+    elif dim == 1:
+        return [np.array(coordinates, 'd'),]
+    else:
+        return [a for part in coordinates for a in _fiona_arrays(part, dim-1)]
 
+def _fiona_from_arrays(coordinates, dim, arrays):
+    """Rebuilds fiona coordinates from an iterator over the output of _fiona_arrays()."""
+    if dim == 0:
+        xy = next(arrays)[0]
+        return (xy[0], xy[1])
     elif dim == 1:
-        # line-like or polygon with no holes
-        coords = np.array(feature['geometry']['coordinates'],'d')
-        assert(len(coords.shape) is 2 and coords.shape[1] in [2,3] )
-        x,y = warp_xy(coords[:,0], coords[:,1], old_crs, new_crs)
-        new_coords = [xy for xy in zip(x,y)]
-        feature['geometry']['coordinates'] = new_coords
-
-    elif dim == 2:
-        # multi-line or polygon with holes
-        new_rings = []
-        for i in range(len(feature['geometry']['coordinates'])):
-            coords = np.array(feature['geometry']['coordinates'][i],'d')
-            assert(len(coords.shape) is 2 and coords.shape[1] in [2,3])
-            x,y = warp_xy(coords[:,0], coords[:,1], old_crs, new_crs)
-            new_coords = list(zip(x,y))
-            new_rings.append(new_coords)
-        feature['geometry']['coordinates'] = new_rings
-        
-    elif dim == 3:
-        # multi-polygon
-        for i in range(len(feature['geometry']['coordinates'])):
-            for j in range(len(feature['geometry']['coordinates'][i])):
-                coords = np.array(feature['geometry']['coordinates'][i][j],'d')
-                assert(len(coords.shape) is 2 and coords.shape[1] in [2,3])
-                x,y = warp_xy(coords[:,0], coords[:,1], old_crs, new_crs)
-                new_coords = [xy for xy in zip(x,y)]
-                feature['geometry']['coordinates'][i][j] = new_coords
-            
-                    
+        coords = next(arrays)
+        return list(zip(coords[:,0], coords[:,1]))
+    else:
+        return [_fiona_from_arrays(part, dim-1, arrays) for part in coordinates]
+
+def warp_shapes(features, old_crs, new_crs):
+    """Uses proj to reproject a list of fiona shapes, IN PLACE.
+
+    The coordinates of all shapes are warped in one vectorized
+    transform.
+    """
+    if get_transformer(old_crs, new_crs) is None:
+        return
+
+    dims = [_depth(feature['geometry']['coordinates']) for feature in features]
+    arrays = [_fiona_arrays(feature['geometry']['coordinates'], dim) for (feature, dim) in zip(features, dims)]
+    for shp_arrays in arrays:
+        for a in shp_arrays:
+            assert(len(a.shape) == 2 and a.shape[1] in [2,3])
+
+    warped = iter(_warp_arrays([a for shp_arrays in arrays for a in shp_arrays], old_crs, new_crs))
+    for feature, dim in zip(features, dims):
+        feature['geometry']['coordinates'] = _fiona_from_arrays(feature['geometry']['coordinates'], dim, warped)
+
+def warp_shape(feature, old_crs, new_crs):
+    """Uses proj to reproject shapes, IN PLACE"""
+    warp_shapes([feature,], old_crs, new_crs)
     
 def warp_shapefile(infile, outfile, epsg=None):
     """Changes the projection of a shapefile."""
@@ -35,6 +35,8 @@ SOFTWARE.
 
 '''
 import logging
+import mmap
+import zlib
 import numpy
 
 
@@ -108,13 +110,231 @@ numpy_to_vtk_dtype = {v: k for k, v in vtk_to_numpy_dtype_name.items()}
 
 
 def read(filename):
-    '''Reads a Gmsh msh file.
+    '''Reads a VTK file.
+
+    Binary files are read by memory-mapping them, see read_binary().
     '''
+    if is_binary(filename):
+        return read_binary(filename)
     with open(filename, 'rb') as f:
         out = read_buffer(f)
     return out
 
 
+def is_binary(filename):
+    '''Is filename a binary legacy VTK file?'''
+    with open(filename, 'rb') as f:
+        f.readline()
+        f.readline()
+        return f.readline().strip() == b'BINARY'
+
+
+def read_binary(filename):
+    '''Reads a binary VTK UNSTRUCTURED_GRID file.
+
+    Returns the same as read_buffer().
+    '''
+    raw = read_raw(filename)
+    assert raw['dataset'] == 'UNSTRUCTURED_GRID', \
+        'Only VTK UNSTRUCTURED_GRID supported.'
+    assert raw['cells'] is not None, \
+        'Required section CELLS not found.'
+    assert raw['cell_types'] is not None, \
+        'Required section CELL_TYPES not found.'
+
+    offsets = cell_offsets(raw['cells'], len(raw['cell_types']))
+    cells, cell_data = translate_cells(raw['cells'], offsets, raw['cell_types'],
+                                       raw['cell_data'])
+    return raw['points'], cells, raw['point_data'], cell_data, raw['field_data']
+
+
+def read_raw(filename):
+    '''Reads the sections of a binary legacy VTK file, as stored.
+
+    The file is memory-mapped, and only the section headers are parsed
+    line by line.  Each binary section is decoded with a single
+    numpy.frombuffer() call on the map, and converted from big endian
+    in bulk.
+
+    Returns a dictionary with keys:
+
+    dataset     | 'UNSTRUCTURED_GRID' or 'POLYDATA'
+    points      | (NPOINTS, 3) array
+    cells       | the CELLS array, (n0, p0, ..., n1, p0, ...), or None
+    cell_types  | the CELL_TYPES array, or None
+    polygons    | the POLYGONS array, laid out like cells, or None
+    point_data  | dictionary of point data arrays
+    cell_data   | dictionary of cell data arrays
+    field_data  | dictionary of field data arrays
+    '''
+    with open(filename, 'rb') as f:
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        return _read_mmap(mm)
+    finally:
+        mm.close()
+
+
+class _MappedFile(object):
+    '''Line and array access to a memory-mapped file.'''
+    def __init__(self, mm):
+        self.mm = mm
+        self.pos = 0
+
+    def readline(self):
+        end = self.mm.find(b'\n', self.pos)
+        if end < 0:
+            end = len(self.mm)
+        line = self.mm[self.pos:end].decode('utf-8')
+        self.pos = min(end + 1, len(self.mm))
+        return line
+
+    def read_array(self, dtype, count):
+        # Binary data is big endian, see
+        # <https://www.vtk.org/Wiki/VTK/Writing_VTK_files_using_python#.22legacy.22>.
+        dtype = numpy.dtype(dtype).newbyteorder('>')
+        data = numpy.frombuffer(self.mm, dtype=dtype, count=count, offset=self.pos)
+        self.pos += count * dtype.itemsize
+        # copy out of the map, in native byte order
+        data = data.astype(dtype.newbyteorder('='))
+        line = self.readline()
+        assert line == '', \
+            'Expected a newline after binary data.'
+        return data
+
+
+def _read_mmap(mm):
+    f = _MappedFile(mm)
+    raw = {'dataset': None,
+           'points': None,
+           'cells': None,
+           'cell_types': None,
+           'polygons': None,
+           'point_data': {},
+           'cell_data': {},
+           'field_data': {}}
+
+    # skip header and title
+    f.readline()
+    f.readline()
+
+    data_type = f.readline().strip()
+    assert data_type == 'BINARY', \
+        'Expected a BINARY VTK file, not \'{}\'.'.format(data_type)
+
+    active = None
+    while f.pos < len(mm):
+        line = f.readline().strip()
+        if len(line) == 0:
+            continue
+
+        split = line.split()
+        section = split[0]
+
+        if section == 'DATASET':
+            raw['dataset'] = split[1]
+            assert raw['dataset'] in ['UNSTRUCTURED_GRID', 'POLYDATA'], \
+                'Only VTK UNSTRUCTURED_GRID and POLYDATA supported.'
+
+        elif section == 'POINTS':
+            active = 'POINTS'
+            num_points = int(split[1])
+            dtype = vtk_to_numpy_dtype_name[split[2]]
+            raw['points'] = f.read_array(dtype, num_points*3).reshape((num_points, 3))
+
+        elif section in ['CELLS', 'POLYGONS']:
+            active = section
+            key = 'cells' if section == 'CELLS' else 'polygons'
+            raw[key] = f.read_array('i4', int(split[2]))
+
+        elif section == 'CELL_TYPES':
+            active = 'CELL_TYPES'
+            raw['cell_types'] = f.read_array('i4', int(split[1]))
+
+        elif section in ['POINT_DATA', 'CELL_DATA']:
+            active = section
+            num_items = int(split[1])
+
+        else:
+            assert section in ['SCALARS', 'VECTORS', 'TENSORS', 'FIELD'], \
+                'Unknown section \'{}\'.'.format(section)
+            if active == 'POINT_DATA':
+                d = raw['point_data']
+            elif active == 'CELL_DATA':
+                d = raw['cell_data']
+            else:
+                assert section == 'FIELD', \
+                    'Illegal {} in section \'{}\'.'.format(section, active)
+                d = raw['field_data']
+
+            if section == 'SCALARS':
+                try:
+                    num_comp = int(split[3])
+                except IndexError:
+                    num_comp = 1
+                lt = f.readline().split()
+                assert lt[0] == 'LOOKUP_TABLE'
+                data = f.read_array(vtk_to_numpy_dtype_name[split[2]], num_items*num_comp)
+                if num_comp > 1:
+                    data = data.reshape(-1, num_comp)
+                d[split[1]] = data
+            elif section == 'VECTORS':
+                d[split[1]] = f.read_array(vtk_to_numpy_dtype_name[split[2]],
+                                           3*num_items).reshape(-1, 3)
+            elif section == 'TENSORS':
+                d[split[1]] = f.read_array(vtk_to_numpy_dtype_name[split[2]],
+                                           9*num_items).reshape(-1, 3, 3)
+            else:
+                for _ in range(int(split[2])):
+                    name, shape0, shape1, dtype = f.readline().split()
+                    shape0 = int(shape0)
+                    shape1 = int(shape1)
+                    data = f.read_array(vtk_to_numpy_dtype_name[dtype], shape0*shape1)
+                    if shape0 != 1:
+                        data = data.reshape((shape1, shape0))
+                    d[name] = data
+
+    return raw
+
+
+def cell_offsets(data, num_cells=None):
+    '''Start of each cell in a legacy cell array (n0, p0, ..., n1, p0, ...).
+
+    If every cell has the same number of nodes, which is the case for
+    triangulations, this is found without walking the array.
+    '''
+    if len(data) == 0:
+        return numpy.zeros((0,), dtype=int)
+
+    n = data[0]
+    if num_cells is not None and len(data) == num_cells * (n+1):
+        offsets = numpy.arange(num_cells) * (n+1)
+        if (data[offsets] == n).all():
+            return offsets
+
+    # mixed sizes, walk the array
+    offsets = []
+    data_list = data.tolist()
+    o = 0
+    while o < len(data_list):
+        offsets.append(o)
+        o += data_list[o] + 1
+    return numpy.array(offsets)
+
+
+def padded_cells(data, offsets):
+    '''Cells of a legacy cell array as a fixed-stride array.
+
+    Returns the (NCELLS, MAX_SIZE) array of node indices, padded with
+    -1, and the (NCELLS,) array of the number of nodes in each cell.
+    '''
+    sizes = data[offsets]
+    local = numpy.arange(sizes.max() if len(sizes) > 0 else 0)
+    valid = local[None,:] < sizes[:,None]
+    indices = numpy.where(valid, offsets[:,None] + 1 + local[None,:], 0)
+    return numpy.where(valid, data[indices], -1), sizes
+
+
 def read_buffer(f):
     # initialize output data
     points = None
@@ -199,12 +419,7 @@ def read_buffer(f):
                 line = f.readline().decode('utf-8')
                 assert line == '\n'
 
-            offsets = []
-            if len(c) > 0:
-                offsets.append(0)
-                while offsets[-1] + c[offsets[-1]] + 1 < len(c):
-                    offsets.append(offsets[-1] + c[offsets[-1]] + 1)
-            offsets = numpy.array(offsets)
+            offsets = cell_offsets(c, int(split[1]))
 
         elif section == 'CELL_TYPES':
             active = 'CELL_TYPES'
@@ -390,9 +605,7 @@ def translate_cells(data, offsets, types, cell_data_raw):
         meshio_type = vtk_to_meshio_type[tpe]
         n = data[offsets[b[0]]]
         assert (data[offsets[b]] == n).all()
-        indices = numpy.array([
-            numpy.arange(1, n+1) + o for o in offsets[b]
-            ])
+        indices = offsets[b][:,None] + numpy.arange(1, n+1)
         cells[meshio_type] = data[indices]
         cell_data[meshio_type] = \
             {key: value[b] for key, value in cell_data_raw.items()}
@@ -525,3 +738,185 @@ def _write_field_data(f, data, write_binary):
             # numpy.savetxt(f, points)
         f.write('\n'.encode('utf-8'))
     return
+
+
+# numpy to VTK XML data type names
+numpy_to_vtu_type = {
+    'bool': 'UInt8',
+    'int8': 'Int8',
+    'uint8': 'UInt8',
+    'int16': 'Int16',
+    'uint16': 'UInt16',
+    'int32': 'Int32',
+    'uint32': 'UInt32',
+    'int64': 'Int64',
+    'uint64': 'UInt64',
+    'float32': 'Float32',
+    'float64': 'Float64',
+    }
+
+vtu_compressors = {
+    'zlib': 'vtkZLibDataCompressor',
+    'lz4': 'vtkLZ4DataCompressor',
+    }
+
+
+def write_vtu(filename,
+              points,
+              cells,
+              point_data=None,
+              cell_data=None,
+              compression=None,
+              block_size=32768,
+              chunk_size=1000000):
+    '''Writes a VTK XML UnstructuredGrid (.vtu) file with appended raw data.
+
+    Arguments are as in write(), plus:
+
+    compression | None, 'zlib', or 'lz4' (requires the lz4 package)
+    block_size  | size, in bytes, of each compressed block
+    chunk_size  | max number of entries converted at once
+
+    Connectivity, offsets and cell types are written straight from each
+    cell type's array, a chunk at a time, so no copy of the full
+    connectivity is made.  Indices are 32 bit unless the mesh is too
+    large for them.  Compressed arrays are compressed block by block and
+    held in memory until the header is written.
+    '''
+    if compression is not None and compression not in vtu_compressors:
+        raise ValueError('Unknown compression \'{}\', valid are: {}'.format(
+            compression, list(vtu_compressors.keys())))
+
+    if points.shape[1] == 2:
+        points = numpy.column_stack([points, numpy.zeros((len(points),))])
+    num_cells = sum([len(c) for c in cells.values()])
+
+    def from_arrays(sources, dtype):
+        # the concatenation of sources, raveled and converted to dtype in chunks
+        dtype = numpy.dtype(dtype).newbyteorder('<')
+        for source in sources:
+            flat = source.reshape(-1)
+            for i in range(0, len(flat), chunk_size):
+                yield numpy.ascontiguousarray(flat[i:i+chunk_size], dtype=dtype)
+
+    def cell_offsets():
+        # end of each cell in the connectivity
+        start = 0
+        for c in cells.values():
+            n = c.shape[1]
+            for i in range(0, len(c), chunk_size):
+                yield start + n * numpy.arange(i+1, min(i+chunk_size, len(c))+1, dtype=index_type.newbyteorder('<'))
+            start += c.size
+
+    def cell_types():
+        for key, c in cells.items():
+            for i in range(0, len(c), chunk_size):
+                yield numpy.full((min(chunk_size, len(c)-i),), meshio_to_vtk_type[key], dtype='u1')
+
+    # each array is (xml section, attributes, dtype, number of entries, chunk generator)
+    arrays = []
+    if point_data is not None:
+        for name, values in point_data.items():
+            arrays.append(('PointData', _vtu_attributes(name, values), values.dtype, values.size,
+                           lambda values=values: from_arrays([values,], values.dtype)))
+    if cell_data is not None:
+        for name, values in raw_from_cell_data(cell_data).items():
+            arrays.append(('CellData', _vtu_attributes(name, values), values.dtype, values.size,
+                           lambda values=values: from_arrays([values,], values.dtype)))
+    arrays.append(('Points', _vtu_attributes(None, points), points.dtype, points.size,
+                   lambda: from_arrays([points,], points.dtype)))
+    # 32 bit indices, unless the connectivity is too large for them
+    num_conn = sum([c.size for c in cells.values()])
+    index_type = numpy.dtype('int32') if max(num_conn, len(points)) < 2**31 else numpy.dtype('int64')
+    arrays.append(('Cells', [('Name', 'connectivity')], index_type, num_conn,
+                   lambda: from_arrays(cells.values(), index_type)))
+    arrays.append(('Cells', [('Name', 'offsets')], index_type, num_cells, cell_offsets))
+    arrays.append(('Cells', [('Name', 'types')], numpy.dtype('uint8'), num_cells, cell_types))
+
+    # find the offset of each array, compressing if requested
+    encoded = []
+    offset = 0
+    for section, attrs, dtype, size, chunks in arrays:
+        if compression is None:
+            data = None
+            nbytes = 8 + size * dtype.itemsize
+        else:
+            data = _vtu_compress(chunks(), compression, block_size)
+            nbytes = sum([len(d) for d in data])
+        attrs = [('type', numpy_to_vtu_type[dtype.name]),] + attrs \
+            + [('format', 'appended'), ('offset', str(offset))]
+        encoded.append((attrs, data))
+        offset += nbytes
+
+    with open(filename, 'wb') as f:
+        compressor = ''
+        if compression is not None:
+            compressor = ' compressor="{}"'.format(vtu_compressors[compression])
+        header = ['<?xml version="1.0"?>',
+                  '<VTKFile type="UnstructuredGrid" version="1.0" byte_order="LittleEndian" '
+                  'header_type="UInt64"{}>'.format(compressor),
+                  '<UnstructuredGrid>',
+                  '<Piece NumberOfPoints="{}" NumberOfCells="{}">'.format(len(points), num_cells)]
+        for section in ['PointData', 'CellData', 'Points', 'Cells']:
+            header.append('<{}>'.format(section))
+            for (sec, _, _, _, _), (attrs, _) in zip(arrays, encoded):
+                if sec == section:
+                    header.append('<DataArray {}/>'.format(
+                        ' '.join('{}="{}"'.format(k, v) for k, v in attrs)))
+            header.append('</{}>'.format(section))
+        header += ['</Piece>',
+                   '</UnstructuredGrid>',
+                   '<AppendedData encoding="raw">']
+        f.write(('\n'.join(header) + '\n_').encode('utf-8'))
+
+        for (_, _, dtype, size, chunks), (_, data) in zip(arrays, encoded):
+            if data is None:
+                f.write(numpy.array([size * dtype.itemsize,], dtype='<u8').tobytes())
+                for c in chunks():
+                    f.write(c.data)
+            else:
+                for d in data:
+                    f.write(d)
+
+        f.write('\n</AppendedData>\n</VTKFile>\n'.encode('utf-8'))
+    return
+
+
+def _vtu_attributes(name, values):
+    attrs = []
+    if name is not None:
+        attrs.append(('Name', name))
+    if len(values.shape) > 1:
+        attrs.append(('NumberOfComponents', str(numpy.prod(values.shape[1:]))))
+    return attrs
+
+
+def _vtu_compress(chunks, compression, block_size):
+    '''Compresses a stream of arrays into VTK XML blocks.
+
+    Returns a list of bytes: the header, of the number of blocks, the
+    uncompressed block size, the size of the last block and the
+    compressed size of each block, followed by the compressed blocks.
+    '''
+    if compression == 'lz4':
+        import lz4.block
+        compress = lambda b: lz4.block.compress(b, store_size=False)
+    else:
+        compress = zlib.compress
+
+    blocks = []
+    buf = bytearray()
+    for c in chunks:
+        buf += c.data
+        full = len(buf) // block_size * block_size
+        for i in range(0, full, block_size):
+            blocks.append(compress(bytes(buf[i:i+block_size])))
+        del buf[:full]
+    last = len(buf)
+    if last > 0:
+        blocks.append(compress(bytes(buf)))
+    elif len(blocks) > 0:
+        last = block_size
+
+    header = numpy.array([len(blocks), block_size, last] + [len(b) for b in blocks], dtype='<u8')
+    return [header.tobytes(),] + blocks